@@ -27,6 +27,15 @@
 		margin-left: auto;
 		margin-right: auto;
 	}
+	#job-progress {
+		display: none;
+		width: 100px;
+		margin-left: auto;
+		margin-right: auto;
+	}
+	.preset-switch {
+		display: none;
+	}
 	.panel-hidden {
 		display: none;
 	}
@@ -103,19 +112,26 @@
 			<div class="cell large-2">
 				<div class="has-tip left" data-tooltip title="Grayscale image used to create the 3D illusion. Upload an image or input some text.">Depthmap</div>
 				<div class="switch">
-				<input class="switch-input" id="dm-file-switch" type="radio" checked value="file" name="dm_switches" onchange="radio_changed(this, 'dm-file-input-panel', ['dm-text-panel']);">
+				<input class="switch-input" id="dm-file-switch" type="radio" checked value="file" name="dm_switches" onchange="radio_changed(this, 'dm-file-input-panel', ['dm-text-panel', 'dm-preset-panel']);">
 				<label class="switch-paddle" for="dm-file-switch">
 					<span class="show-for-sr">Depthmap</span>
 					<span class="switch-active" aria-hidden="true">File</span>
 				</label>
 				</div>
 				<div class="switch">
-				<input class="switch-input" id="dm-text-switch" type="radio" value="text" name="dm_switches" onchange="radio_changed(this, 'dm-text-panel', ['dm-file-input-panel']);">
+				<input class="switch-input" id="dm-text-switch" type="radio" value="text" name="dm_switches" onchange="radio_changed(this, 'dm-text-panel', ['dm-file-input-panel', 'dm-preset-panel']);">
 				<label class="switch-paddle" for="dm-text-switch">
 					<span class="show-for-sr">Depthmap</span>
 					<span class="switch-active" aria-hidden="true">Text</span>
 				</label>
 				</div>
+				<div class="switch preset-switch">
+				<input class="switch-input" id="dm-preset-switch" type="radio" value="preset" name="dm_switches" onchange="radio_changed(this, 'dm-preset-panel', ['dm-file-input-panel', 'dm-text-panel']);">
+				<label class="switch-paddle" for="dm-preset-switch">
+					<span class="show-for-sr">Depthmap</span>
+					<span class="switch-active" aria-hidden="true">Preset</span>
+				</label>
+				</div>
 			</div>
 			<!-- Panels -->
 			<div class="cell large-10">
@@ -133,6 +149,10 @@
 						<span class="form-error">Enter some text first</span>
 						<div id="chars-left"></div>
 					</div>
+					<!-- Preset selector -->
+					<div id="dm-preset-panel" class="panel-hidden">
+						<select id="depthmap-preset" name="depthmap_preset"></select>
+					</div>
 				</div>
 			</div>
 		</div>
@@ -142,19 +162,26 @@
 			<div class="cell large-2">
 				<div class="has-tip left" data-tooltip title="What to put as a background. Provide an image or select a random dot pattern">Background Pattern</div>
 				<div class="switch">
-					<input class="switch-input" id="pattern-file-switch" type="radio" value="file" checked name="pattern_switches" onchange="radio_changed(this, 'pattern-file-input-panel', ['pattern-dots-settings-panel']);">
+					<input class="switch-input" id="pattern-file-switch" type="radio" value="file" checked name="pattern_switches" onchange="radio_changed(this, 'pattern-file-input-panel', ['pattern-dots-settings-panel', 'pattern-preset-panel']);">
 					<label class="switch-paddle" for="pattern-file-switch">
 						<span class="show-for-sr">Patterns</span>
 						<span class="switch-active" aria-hidden="true">File</span>
 					</label>
 				</div>
 				<div class="switch">
-					<input class="switch-input" id="pattern-dots-switch" type="radio" value="dots" name="pattern_switches" onchange="radio_changed(this, 'pattern-dots-settings-panel', ['pattern-file-input-panel']);">
+					<input class="switch-input" id="pattern-dots-switch" type="radio" value="dots" name="pattern_switches" onchange="radio_changed(this, 'pattern-dots-settings-panel', ['pattern-file-input-panel', 'pattern-preset-panel']);">
 					<label class="switch-paddle" for="pattern-dots-switch">
 						<span class="show-for-sr">Patterns</span>
 						<span class="switch-active" aria-hidden="true">Dots</span>
 					</label>
 				</div>
+				<div class="switch preset-switch">
+					<input class="switch-input" id="pattern-preset-switch" type="radio" value="preset" name="pattern_switches" onchange="radio_changed(this, 'pattern-preset-panel', ['pattern-file-input-panel', 'pattern-dots-settings-panel']);">
+					<label class="switch-paddle" for="pattern-preset-switch">
+						<span class="show-for-sr">Patterns</span>
+						<span class="switch-active" aria-hidden="true">Preset</span>
+					</label>
+				</div>
 			</div>
 			<!-- Panels -->
 			<div class="cell large-10">
@@ -164,6 +191,9 @@
 					<span class="form-error">Select a file first</span>
 					<div id="pattern-filename" class="justify-center" placeholder="Select a pattern file"></div>
 				</div>
+				<div id="pattern-preset-panel" class="panel-hidden">
+					<select id="pattern-preset" name="pattern_preset"></select>
+				</div>
 				<div id="pattern-dots-settings-panel" class="panel-hidden">
 					<div class="grid-x">
 						<!-- dot probability -->
@@ -295,6 +325,7 @@
 					<video id="loading-icon" autoplay loop muted>
 						<source type="video/webm" src="https://giant.gfycat.com/AppropriateSpotlessAdouri.webm">
 					</video>
+					<progress id="job-progress" max="1" value="0"></progress>
 				</div>
 			<!-- </div> -->
 		</div>
@@ -384,6 +415,20 @@
 	}
 
 	$(document).ready(function(){
+		// Preset depthmaps and patterns, if the server has them
+		$.getJSON("run.php", {presets: 1}).done(function(data){
+			if (data.code != 200)
+				return;
+			for (var [kind, select_id] of [["depthmap", "#depthmap-preset"], ["pattern", "#pattern-preset"]]){
+				var presets = data.text[kind] || [];
+				for (var preset of presets){
+					$(select_id).append(new Option(preset.name + " (" + preset.width + "x" + preset.height + ")", preset.name));
+				}
+				if (presets.length > 0)
+					$(select_id).closest(".callout").find(".preset-switch").css("display", "block");
+			}
+		});
+
 		// Initialize dot colors selector
 	
 		$("#dot-colors-selector").select2({
@@ -436,7 +481,7 @@
 
 		// Depthmap mode switch: Change depth depending on the mode
 		// TODO: Move slider too
-		$("#dm-file-switch").change(function(){
+		$("#dm-file-switch, #dm-preset-switch").change(function(){
 			if ($(this).is(":checked")){
 				// Selected file depthmap
 				if (!$("#force-depth-switch").is(":checked")){
@@ -486,32 +531,82 @@
 			// Show loading
 			$("#submit").css("display", "none");
 			$("#loading-icon").css("display", "block");
+			var form_data = new FormData($("#the-form")[0]);
+			if (current_job !== null){
+				// Its settings are stale now
+				form_data.append("replaces", current_job);
+			}
 			$.ajax({
 				url: "run.php",	
 				type: "POST",
 				processData: false,
 				contentType: false,
 				async: true,
-				data: new FormData($("#the-form")[0]),
+				data: form_data,
 				dataType: 'json'
 			}).done(function(data){
 				log("OK response: " + data);
-				$("#loading-icon").css("display", "none");
-				$("#submit").css("display", "block");
-				var url = data.text;
-				$("#generated-image").attr({
-					"src": url
-				});
-				$("#generated-image-modal").foundation("open");
+				if (data.code == 202){
+					// Queued in the job queue. Show the preview until it's done, settings can be changed meanwhile
+					current_job = data.text.id;
+					show_generated_image(data.preview);
+					$("#job-progress").val(0).css("display", "block");
+					wait_for_job(data.text.id);
+					return;
+				}
+				current_job = null;
+				show_generated_image(data.text);
 			}).fail(function(data){
 				log("FAIL response: " + data);
-				$("#loading-icon").css("display", "none");
-				$("#submit").css("display", "block");
+				stop_loading();
 			});
 			return false;
 		});
 	});
 
+	var JOB_POLL_INTERVAL = 1000;  // ms
+	var current_job = null;  // Job rendering the image shown as a preview
+
+	function wait_for_job(job_id){
+		$.getJSON("run.php", {job: job_id}).done(function(data){
+			var job = data.text;
+			if (job_id != current_job){
+				// Replaced by a newer job
+				return;
+			}
+			if (data.code != 200 || job.status == "failed" || job.status == "cancelled"){
+				log("Job " + job_id + " did not finish: " + JSON.stringify(data));
+				current_job = null;
+				stop_loading();
+			} else if (job.status == "done"){
+				current_job = null;
+				show_generated_image(job.result);
+			} else {
+				$("#job-progress").val(job.progress);
+				setTimeout(function(){
+					wait_for_job(job_id);
+				}, JOB_POLL_INTERVAL);
+			}
+		}).fail(function(data){
+			log("FAIL response: " + data);
+			stop_loading();
+		});
+	}
+
+	function stop_loading(){
+		$("#loading-icon").css("display", "none");
+		$("#job-progress").css("display", "none");
+		$("#submit").css("display", "block");
+	}
+
+	function show_generated_image(url){
+		stop_loading();
+		$("#generated-image").attr({
+			"src": url
+		});
+		$("#generated-image-modal").foundation("open");
+	}
+
 	function _path_basename(complete_path){
 		return complete_path.split(/[\\/]/).pop();
 	}
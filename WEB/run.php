@@ -1,6 +1,7 @@
 <?php 
 $HTTP_OK = 200;
 $HTTP_BAD_REQUEST = 400;
+$HTTP_PAYLOAD_TOO_LARGE = 413;
 $HTTP_SERVER_ERROR = 500;
 
 /*
@@ -12,6 +13,123 @@ function send_response($HTTP_CODE, $response){
 	echo json_encode($HTTP_CODE == 200 ? $response : "{'error': '".$response."'}");
 	exit;
 }
+
+$OUTPUT_DIR = "out";  // Must be relative to this script's location
+$sirds_path = "/home/mexomagno/Workspace_ext4/stereogramaxo";
+
+// Queue renders in the job queue (jobs.py), if running with $OUTPUT_DIR as its output directory. Requests then return
+// the job and a quick preview at once, and clients poll its progress with GET run.php?job=<id>. Posting "replaces"
+// with the id of a job cancels it
+$job_server = "";  // i.e. "http://127.0.0.1:8643"
+// Render with the render server (server.py), if running. Avoids starting a python process per request
+$render_server = "";  // i.e. "http://127.0.0.1:8642"
+
+// Uploads. Their header is checked before storing them, and the script refuses to decode more than its own pixel
+// budget. Big JPEGs are decoded at a reduced scale, so they can have more pixels than that
+$MAX_UPLOAD_BYTES = 20 * 1000 * 1000;
+$MAX_UPLOAD_PIXELS = 150 * 1000 * 1000;
+$TIME_LIMIT = 30;  // Seconds a render by the script may take. The render server has its own
+// Accepted image types, and the extension they are stored with
+$UPLOAD_TYPES = array(IMAGETYPE_PNG => ".png", IMAGETYPE_JPEG => ".jpg", IMAGETYPE_GIF => ".gif",
+                      IMAGETYPE_BMP => ".bmp", IMAGETYPE_TIFF_II => ".tiff", IMAGETYPE_TIFF_MM => ".tiff");
+if (defined("IMAGETYPE_WEBP"))
+	$UPLOAD_TYPES[IMAGETYPE_WEBP] = ".webp";
+// Where uploads are stored. The job queue removes those of its jobs once they end: start it with --upload-dir pointing
+// here
+$UPLOAD_DIR = sys_get_temp_dir()."/stereogramaxo-uploads";
+// Stored uploads, removed once the request is answered, unless a job owns them
+$uploads = array();
+
+/*
+	Send a request to the job queue. Returns its decoded JSON response
+**/
+function job_request($method, $path, $content = null){
+	global $job_server, $HTTP_SERVER_ERROR;
+	$options = array("method" => $method, "ignore_errors" => true);
+	if ($content !== null){
+		$options["header"] = "Content-Type: application/json";
+		$options["content"] = json_encode($content);
+	}
+	$response = file_get_contents($job_server.$path, false, stream_context_create(array("http" => $options)));
+	if ($response === false)
+		send_response($HTTP_SERVER_ERROR, "Job queue is not reachable");
+	return json_decode($response);
+}
+
+/*
+	Preset depthmaps and patterns, from the asset index (assets.py) of the project. Empty if it wasn't built
+**/
+function read_presets(){
+	global $sirds_path;
+	$index = json_decode(@file_get_contents($sirds_path."/.assets/index.json"), true);
+	if ($index === null || !isset($index["assets"]))
+		return array();
+	return $index["assets"];
+}
+
+/*
+	Path of a preset, if there is one with that name
+**/
+function preset_path($kind, $name){
+	global $sirds_path;
+	$presets = read_presets();
+	if (!isset($presets[$kind][$name]))
+		return null;
+	return $sirds_path."/".$presets[$kind][$name]["path"];
+}
+
+/*
+	Check an uploaded image, reading only its header, and store it under a name of our own. Returns its path
+**/
+function store_upload($field){
+	global $MAX_UPLOAD_BYTES, $MAX_UPLOAD_PIXELS, $UPLOAD_TYPES, $UPLOAD_DIR, $uploads;
+	global $HTTP_BAD_REQUEST, $HTTP_PAYLOAD_TOO_LARGE, $HTTP_SERVER_ERROR;
+	$file = $_FILES[$field];
+	if ($file["error"] != UPLOAD_ERR_OK || !is_uploaded_file($file["tmp_name"]))
+		send_response($HTTP_BAD_REQUEST, "Could not upload image");
+	if ($file["size"] > $MAX_UPLOAD_BYTES)
+		send_response($HTTP_PAYLOAD_TOO_LARGE, "Images can't be bigger than ".$MAX_UPLOAD_BYTES." bytes");
+	$info = @getimagesize($file["tmp_name"]);
+	if ($info === false || !isset($UPLOAD_TYPES[$info[2]]))
+		send_response($HTTP_BAD_REQUEST, "Unsupported image type");
+	if ($info[0] * $info[1] > $MAX_UPLOAD_PIXELS)
+		send_response($HTTP_PAYLOAD_TOO_LARGE, "Images can't have more than ".$MAX_UPLOAD_PIXELS." pixels");
+	if (!is_dir($UPLOAD_DIR) && !@mkdir($UPLOAD_DIR) && !is_dir($UPLOAD_DIR))
+		send_response($HTTP_SERVER_ERROR, "Could not store uploaded image");
+	$path = $UPLOAD_DIR."/sirds-".uniqid("", true).$UPLOAD_TYPES[$info[2]];
+	if (!move_uploaded_file($file["tmp_name"], $path))
+		send_response($HTTP_SERVER_ERROR, "Could not store uploaded image");
+	$uploads[] = $path;
+	return $path;
+}
+
+register_shutdown_function(function(){
+	global $uploads;
+	foreach ($uploads as $path)
+		@unlink($path);
+});
+
+if (isset($_GET["presets"])){
+	$listing = array();
+	foreach (read_presets() as $kind => $entries){
+		$listing[$kind] = array();
+		foreach ($entries as $name => $entry)
+			$listing[$kind][] = array("name" => $name, "width" => $entry["width"], "height" => $entry["height"]);
+	}
+	send_response($HTTP_OK, array("code" => $HTTP_OK, "text" => $listing));
+}
+
+// Job progress. DELETE cancels the job
+if (isset($_GET["job"])){
+	if ($job_server == "" || !preg_match("/^[0-9a-f]{32}$/", $_GET["job"]))
+		send_response($HTTP_BAD_REQUEST, "Invalid job");
+	$job_response = job_request($_SERVER["REQUEST_METHOD"] == "DELETE" ? "DELETE" : "GET", "/jobs/".$_GET["job"]);
+	if ($job_response->code != $HTTP_OK)
+		send_response($HTTP_SERVER_ERROR, $job_response->text);
+	if ($job_response->text->result !== null)
+		$job_response->text->result = $OUTPUT_DIR."/".$job_response->text->result;
+	send_response($HTTP_OK, $job_response);
+}
 //var_dump($_POST["dot_colors"]);
 //exit;
 
@@ -31,43 +149,55 @@ pattern_file: OPTIONAL file for pattern
 */
 // Validate arguments
 $script_args = "";
+// Same arguments, as render server options
+$render_options = array();
 
 if ( !isset($_POST) )
 	send_response($HTTP_BAD_REQUEST, "You must send request via POST method");
 if (!isset($_POST["dm_switches"]) || !isset($_POST["pattern_switches"]))
 	send_response($HTTP_BAD_REQUEST, "You must select a depthmap and a pattern mode");
 $dm_mode = $_POST["dm_switches"];
-if ($dm_mode != "text" && $dm_mode != "file")
+if ($dm_mode != "text" && $dm_mode != "file" && $dm_mode != "preset")
 	send_response($HTTP_BAD_REQUEST, "Invalid depthmap mode");
 if ($dm_mode == "text" && (!isset($_POST["depthmap_text"]) || strlen($_POST["depthmap_text"]) == 0))
 	send_response($HTTP_BAD_REQUEST, "You must input some text for a text depthmap");
 if ($dm_mode == "file" && (!isset($_FILES) || !isset($_FILES["depthmap_file"])))
 	send_response($HTTP_BAD_REQUEST, "You must attach an image for an image depthmap");
 // Validated depthmap. Convert to args
-if ($dm_mode == "text")
+if ($dm_mode == "text"){
 	$script_args = $script_args." -t \"".$_POST["depthmap_text"]."\"";
+	$render_options["text"] = $_POST["depthmap_text"];
+}
 if ($dm_mode == "file"){
-	// TODO: Validate image properties
-	$dm_path = "/tmp/".basename($_FILES["depthmap_file"]["name"]);
-	// send_response(400, "path to upload dm: ".$dm_path);
-	if (!move_uploaded_file($_FILES["depthmap_file"]["tmp_name"], $dm_path))
-		send_response($HTTP_SERVER_ERROR, "Could not upload depthmap image");
+	$dm_path = store_upload("depthmap_file");
+	$script_args = $script_args." -d \"".$dm_path."\"";
+	$render_options["depthmap"] = $dm_path;
+}
+if ($dm_mode == "preset"){
+	$dm_path = isset($_POST["depthmap_preset"]) ? preset_path("depthmap", $_POST["depthmap_preset"]) : null;
+	if ($dm_path === null)
+		send_response($HTTP_BAD_REQUEST, "Unknown depthmap preset");
 	$script_args = $script_args." -d \"".$dm_path."\"";
+	$render_options["depthmap"] = $dm_path;
 }
 
 $pattern_mode = $_POST["pattern_switches"];
-if ($pattern_mode != "dots" && $pattern_mode != "file")
+if ($pattern_mode != "dots" && $pattern_mode != "file" && $pattern_mode != "preset")
 	$send_response($HTTP_BAD_REQUEST, "Invalid pattern mode");
 if ($pattern_mode == "file" && (!isset($_FILES) || !isset($_FILES["pattern_file"])))
 	$send_response($HTTP_BAD_REQUEST, "You must attach an image for an image pattern");
 // Validated pattern. Convert to args
 if ($pattern_mode == "file"){
-	// TODO: Validate image properties
-	$p_file = "/tmp/".basename($_FILES["pattern_file"]["name"]);
-	// send_response(400, "path to upload dm: ".$p_file);
-	if (!move_uploaded_file($_FILES["pattern_file"]["tmp_name"], $p_file))
-		send_response($HTTP_SERVER_ERROR, "Could not upload pattern image");
+	$p_file = store_upload("pattern_file");
+	$script_args = $script_args." -p \"".$p_file."\"";
+	$render_options["pattern"] = $p_file;
+}
+if ($pattern_mode == "preset"){
+	$p_file = isset($_POST["pattern_preset"]) ? preset_path("pattern", $_POST["pattern_preset"]) : null;
+	if ($p_file === null)
+		send_response($HTTP_BAD_REQUEST, "Unknown pattern preset");
 	$script_args = $script_args." -p \"".$p_file."\"";
+	$render_options["pattern"] = $p_file;
 }
 if ($pattern_mode == "dots"){
 	$script_args = $script_args." --dots";
@@ -80,6 +210,7 @@ if ($pattern_mode == "dots"){
 			send_response($HTTP_BAD_REQUEST, "Invalid background color: '".$bg_c."'");
 		}
 		$script_args = $script_args." --dot-bg-color ".$bg_c;
+		$render_options["dot_bg_color"] = $bg_c;
 	}
 
 	// Dot colors
@@ -92,6 +223,7 @@ if ($pattern_mode == "dots"){
 			$prefix = ",";
 		}
 		$script_args = $script_args." --dot-colors ".$all_colors;
+		$render_options["dot_colors"] = $all_colors;
 	}
 	// Dot aparition options
 	if (isset($_POST["dot_probability"]) && is_numeric($_POST["dot_probability"])){
@@ -100,6 +232,7 @@ if ($pattern_mode == "dots"){
 			send_response($HTTP_BAD_REQUEST, "Invalid dot probability value");
 		}
 		$script_args = $script_args." --dot-prob ".($float_dp/100.0);
+		$render_options["dot_prob"] = $float_dp/100.0;
 	}
 }
 
@@ -111,6 +244,7 @@ if (isset($_POST["blur"]) && ctype_digit($_POST["blur"])){
 		send_response($HTTP_BAD_REQUEST, "Invalid blur value");
 	}
 	$script_args = $script_args." -b ".$blur;
+	$render_options["blur"] = $blur;
 }
 
 // View mode
@@ -122,6 +256,7 @@ if (isset($_POST["view_mode"])){
 	$view_mode = "-".$vm;
 }
 $script_args = $script_args." ".$view_mode;
+$render_options["wall"] = $view_mode == "-w";
 
 // Force depth
 if (isset($_POST["force_depth"])){
@@ -132,36 +267,77 @@ if (isset($_POST["force_depth"])){
 		}
 		$fd = $fd/100.0;
 		$script_args = $script_args." --forcedepth ".$fd;
+		$render_options["forcedepth"] = $fd;
 	}
 }
 
-// Execute script
-
-$OUTPUT_DIR = "out";  // Must be relative to this script's location
-$script_args = $script_args." -o \"".getcwd()."/".$OUTPUT_DIR."\"";
+/*
+	Render a stereogram with the render server (server.py) if set, or else running the script. Returns the path of the
+	image, relative to this script
+**/
+function render_stereogram($script_args, $render_options){
+	global $OUTPUT_DIR, $sirds_path, $render_server, $TIME_LIMIT, $HTTP_OK, $HTTP_SERVER_ERROR;
+	if ($render_server != ""){
+		$context = stream_context_create(array("http" => array(
+			"method" => "POST",
+			"header" => "Content-Type: application/json",
+			"content" => json_encode($render_options),
+			"ignore_errors" => true
+		)));
+		$image_bytes = file_get_contents($render_server."/render", false, $context);
+		if ($image_bytes === false)
+			send_response($HTTP_SERVER_ERROR, "Render server is not reachable");
+		if (strpos($http_response_header[0], " 200 ") === false){
+			$json_response = json_decode($image_bytes);
+			send_response($HTTP_SERVER_ERROR, $json_response->text);
+		}
+		$out_name = $OUTPUT_DIR."/".uniqid("", true).".png";
+		if (file_put_contents($out_name, $image_bytes) === false)
+			send_response($HTTP_SERVER_ERROR, "Could not store generated image");
+		return $out_name;
+	}
 
-// send_response(400, "Args so far: ".$script_args);
+	// Execute script
+	$script_args = $script_args." --time-limit ".$TIME_LIMIT." -o \"".getcwd()."/".$OUTPUT_DIR."\"";
 
-$sirds_path = "/home/mexomagno/Workspace_ext4/stereogramaxo";
+	// send_response(400, "Args so far: ".$script_args);
 
-//$cmd_text = "$sirds_path/ENV/bin/python $sirds_path/sirds.py -d $sirds_path/depth_maps/tiburon.png --dots -w --blur 6 --forcedepth 1 -o out";
-$cmd_text = $sirds_path."/ENV/bin/python $sirds_path/sirds.py ".$script_args;
-$cmd = escapeshellcmd($cmd_text);
+	//$cmd_text = "$sirds_path/ENV/bin/python $sirds_path/sirds.py -d $sirds_path/depth_maps/tiburon.png --dots -w --blur 6 --forcedepth 1 -o out";
+	$cmd_text = $sirds_path."/ENV/bin/python $sirds_path/sirds.py ".$script_args;
+	$cmd = escapeshellcmd($cmd_text);
 
-# Expect a JSON with results
-$script_response = exec($cmd, $cmd_output, $shell_retcode);
+	# Expect a JSON with results
+	$script_response = exec($cmd, $cmd_output, $shell_retcode);
 
-$response_data = "";
+	switch($shell_retcode){
+		case 0:
+			// Get generated file name
+			$json_response = json_decode($script_response);
+			if ($json_response->code != $HTTP_OK)
+				send_response($json_response->code, $json_response->text);
+			return $OUTPUT_DIR."/".$json_response->text;
+		case 126:
+			send_response($HTTP_SERVER_ERROR, "Server has permission issues! Fix first");
+		default:
+			send_response($HTTP_SERVER_ERROR, "Server error: '".$shell_retcode."'"); 
+	}
+}
 
-switch($shell_retcode){
-	case 0:
-		// Get generated file name
-		$json_response = json_decode($script_response);
-		$json_response->text = $OUTPUT_DIR."/".$json_response->text;
-		send_response($json_response->code, $json_response);
-	case 126:
-		send_response($HTTP_SERVER_ERROR, "Server has permission issues! Fix first");
-	default:
-		send_response($HTTP_SERVER_ERROR, "Server error: '".$shell_retcode."'"); 
+if ($job_server != ""){
+	// Something to show while the job renders. Before queueing it, that may remove the uploads once it ends
+	$preview = render_stereogram($script_args." --preview", array_merge($render_options, array("preview" => true)));
+	$job_options = $render_options;
+	// The job rendering the previous settings, if the client is still waiting for it
+	if (isset($_POST["replaces"]) && preg_match("/^[0-9a-f]{32}$/", $_POST["replaces"]))
+		$job_options["replaces"] = $_POST["replaces"];
+	$job_response = job_request("POST", "/jobs", $job_options);
+	if ($job_response->code != 202)
+		send_response($HTTP_SERVER_ERROR, $job_response->text);
+	// The job reads them later, and the job queue removes them once it ends
+	$uploads = array();
+	$job_response->preview = $preview;
+	send_response($HTTP_OK, $job_response);
 }
+
+send_response($HTTP_OK, array("code" => $HTTP_OK, "text" => render_stereogram($script_args, $render_options)));
 ?>
\ No newline at end of file
@@ -1,47 +1,188 @@
 #!/usr/bin/python
-# -*- coding: utf-8 -*-
-
-from sirds import *
-
-# Recibe carpeta con frames
-# Aplica algoritmo a cada frame
-# guarda cada frame resultante en carpeta nueva dentro de la anterior
-# DESPUES: Crea video con frames
-
-import os,sys
-
-OUTFOLDER_SUFIX = "_animacion"
-# checkear carpeta
-if len(sys.argv)<=1:
-	print "Debe ingresar carpeta!"
-	exit(1)
-folder = sys.argv[1]
-print folder
-if not os.path.exists(folder):
-	print "Carpeta no existe"
-	exit(1)
-# Crear carpeta para resultados
-if not os.path.exists(folder+OUTFOLDER_SUFIX):
-	os.mkdir(folder+OUTFOLDER_SUFIX)
-pattern = "patterns/jellybeans_tile.jpg"
-count = 1
-# Obtener archivos
-dirlist = os.listdir(folder)
-nfiles = len(dirlist)
-for file in dirlist:
-	if os.path.isdir(folder+"/"+file):
-		continue
-	i = make_stereogram(folder + "/" + file, pattern, "we")
-	save_to_file(i, "frame_{}".format(count), savefolder = (folder + OUTFOLDER_SUFIX))
-	print "{} de {} listos".format((count),nfiles)
-	count+=1
-print "Creando video..."
-#os.chdir(folder+OUTFOLDER_SUFIX)
-from subprocess import call
-call(('ffmpeg -r 30 -f image2 -i '+folder+OUTFOLDER_SUFIX+'/frame_%d.png -crf 15 -vcodec libx264 '+folder+'_video.mp4').split(),stdout=open(os.devnull,'wb'))
-print "Video creado como '{}_video.mp4'".format(folder)
-print "Eliminando archivos temporales..."
-for file in os.listdir(folder+OUTFOLDER_SUFIX):
-	os.remove(folder+OUTFOLDER_SUFIX+"/"+file)
-os.rmdir(folder+OUTFOLDER_SUFIX)
-print "Listo"
+"""
+Animated stereograms. Renders a folder of depthmap frames and streams them straight into an ffmpeg video.
+
+Frames are rendered in parallel but written in order. At most `window` frames are rendered or waiting to be written
+at any time, so memory use doesn't depend on the number of frames.
+
+In coherent mode, frames are rendered one after the other sharing the same pattern, which avoids flickering and only
+renders again the rows that changed between frames.
+"""
+
+import argparse
+import os
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from log import Log as log
+from main import RenderOptions, SUPPORTED_IMAGE_EXTENSIONS, make_stereogram, render_sequence
+
+DEFAULT_FPS = 30
+DEFAULT_CRF = 15
+DEFAULT_PATTERN = "patterns/jellybeans_tile.jpg"
+
+
+def list_frames(folder):
+    """
+    Lists the depthmap frames of a folder, sorted by name
+
+    Parameters
+    ----------
+    folder : str
+        Folder with one depthmap image per frame
+
+    Returns
+    -------
+    list(str)
+        Paths to the frames
+    """
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+            if os.path.splitext(name)[1].lower() in SUPPORTED_IMAGE_EXTENSIONS]
+
+
+def _render_frame(options_dict):
+    """Worker process entry point. Returns the frame as raw RGB, the format ffmpeg reads."""
+    frame_img = make_stereogram(RenderOptions.from_dict(options_dict)).convert("RGB")
+    return frame_img.size, frame_img.tobytes()
+
+
+def render_frames(frame_files, options, workers=None, window=None):
+    """
+    Renders a stereogram for each frame, in parallel
+
+    Parameters
+    ----------
+    frame_files : list(str)
+        Depthmap of each frame
+    options : RenderOptions
+        Options shared by every frame. Its depthmap is replaced by each frame
+    workers : int
+        Number of render processes. Defaults to the number of CPUs
+    window : int
+        Maximum number of frames being rendered or waiting to be consumed. Defaults to twice the workers
+
+    Yields
+    ------
+    tuple(tuple(int, int), bytes)
+        Size and raw RGB pixels of each frame, in order
+    """
+    workers = workers or os.cpu_count()
+    window = window or 2 * workers
+    options_dict = options.to_dict()
+    frames = iter(frame_files)
+
+    def submit_next(pool, pending):
+        frame_file = next(frames, None)
+        if frame_file is not None:
+            pending.append(pool.submit(_render_frame, dict(options_dict, depthmap=frame_file)))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for _ in range(window):
+            submit_next(pool, pending)
+        while pending:
+            frame = pending.popleft().result()
+            submit_next(pool, pending)
+            yield frame
+
+
+def encode_video(frames, output, fps=DEFAULT_FPS, crf=DEFAULT_CRF):
+    """
+    Pipes raw RGB frames into ffmpeg, encoding them as an H.264 video. No intermediate files are written
+
+    Parameters
+    ----------
+    frames : iterable(tuple(tuple(int, int), bytes))
+        Size and raw RGB pixels of each frame. All frames must have the same size
+    output : str
+        Path of the video file
+    fps : int
+        Frames per second
+    crf : int
+        H.264 constant rate factor. Lower is better quality
+
+    Returns
+    -------
+    int
+        Number of encoded frames
+    """
+    ffmpeg = None
+    count = 0
+    try:
+        for size, rgb_bytes in frames:
+            if ffmpeg is None:
+                video_size = size
+                ffmpeg = subprocess.Popen([
+                    "ffmpeg", "-y", "-loglevel", "error",
+                    "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "{}x{}".format(*size), "-r", str(fps), "-i", "-",
+                    # H.264 needs even dimensions
+                    "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+                    "-c:v", "libx264", "-crf", str(crf), "-pix_fmt", "yuv420p", output
+                ], stdin=subprocess.PIPE)
+            if size != video_size:
+                raise ValueError("Frame {} is {}, but the video is {}".format(count + 1, size, video_size))
+            ffmpeg.stdin.write(rgb_bytes)
+            count += 1
+            log.i("{} frames ready".format(count))
+    finally:
+        if ffmpeg is not None:
+            ffmpeg.stdin.close()
+            ffmpeg.wait()
+    if ffmpeg is not None and ffmpeg.returncode != 0:
+        raise RuntimeError("ffmpeg failed with code {}".format(ffmpeg.returncode))
+    return count
+
+
+def obtain_args():
+    def _existent_directory(dirname):
+        if not os.path.isdir(dirname):
+            raise argparse.ArgumentTypeError("'{}' is not a directory".format(dirname))
+        return dirname
+
+    arg_parser = argparse.ArgumentParser(description="Stereogramaxo: renders a folder of depthmaps into a video")
+    arg_parser.add_argument("folder", help="Folder with one depthmap image per frame, sorted by name",
+                            type=_existent_directory)
+    pattern_arg_group = arg_parser.add_mutually_exclusive_group()
+    pattern_arg_group.add_argument("--dots", help="Generate a dot pattern for the background", action="store_true")
+    pattern_arg_group.add_argument("--pattern", "-p", help="Path to an image file to use as background pattern",
+                                   default=DEFAULT_PATTERN)
+    viewmode_arg_group = arg_parser.add_mutually_exclusive_group()
+    viewmode_arg_group.add_argument("--wall", "-w", help="Wall eyed mode (default)", action="store_true")
+    viewmode_arg_group.add_argument("--cross", "-c", help="Cross eyed mode", action="store_true")
+    arg_parser.add_argument("--blur", "-b", help="Gaussian blur ammount", type=int)
+    arg_parser.add_argument("--forcedepth", help="Force max depth to use", type=float)
+    arg_parser.add_argument("--seed", help="Seed for the random dots", type=int)
+    arg_parser.add_argument("--output", "-o", help="Video file. Defaults to '<folder>_video.mp4'")
+    arg_parser.add_argument("--fps", help="Frames per second", type=int, default=DEFAULT_FPS)
+    arg_parser.add_argument("--crf", help="H.264 quality. Lower is better", type=int, default=DEFAULT_CRF)
+    arg_parser.add_argument("--coherent", help="Share the pattern between frames and render only the rows that "
+                                               "changed. Frames are rendered one after the other",
+                            action="store_true")
+    arg_parser.add_argument("--workers", help="Number of render processes. Defaults to the number of CPUs", type=int)
+    arg_parser.add_argument("--window", help="Maximum number of frames in memory. Defaults to twice the workers",
+                            type=int)
+    return arg_parser.parse_args()
+
+
+def main():
+    args = obtain_args()
+    frame_files = list_frames(args.folder)
+    if not frame_files:
+        log.e("No depthmap frames in '{}'".format(args.folder))
+        return
+    options = RenderOptions(depthmap=frame_files[0], pattern=None if args.dots else args.pattern,
+                            wall=not args.cross, blur=args.blur, forcedepth=args.forcedepth, seed=args.seed)
+    output = args.output or os.path.normpath(args.folder) + "_video.mp4"
+    if args.coherent:
+        frames = ((frame_img.size, frame_img.tobytes()) for frame_img in render_sequence(frame_files, options))
+    else:
+        frames = render_frames(frame_files, options, args.workers, args.window)
+    t0 = time.time()
+    count = encode_video(frames, output, args.fps, args.crf)
+    log.i("Video with {} frames created as '{}' ({:.1f} frames/s)".format(count, output, count / (time.time() - t0)))
+
+
+if __name__ == "__main__":
+    main()
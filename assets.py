@@ -0,0 +1,371 @@
+#!/usr/bin/python
+"""
+Image files: guarded decoding, and the index of the preset depthmaps and patterns.
+
+Images are opened reading only their header. Those that would take more than a pixel budget to decode are refused
+before decoding anything, and big JPEGs are decoded straight at a reduced scale, so huge uploads and decompression bombs
+don't tie up a process.
+
+Presets are decoded once, downsized like any loaded image, and stored as raw pixels in .npy files. Every process maps
+those into memory instead of decoding its own copy, so worker processes share the pages. The index keeps the size and
+modification time of every file: updating it only decodes the files that changed, and changed files are decoded as
+usual until it is updated.
+"""
+
+import argparse
+import json
+import os
+
+from lazy import lazy_import
+from log import Log as log
+
+np = lazy_import("numpy")
+# This "PIL" refers to Pillow, the PIL fork. Check https://pillow.readthedocs.io/en/
+im = lazy_import("PIL.Image")
+
+DMFOLDER = "depthmaps"
+PATTERNFOLDER = "patterns"
+MAX_DIMENSION = 1500  # px
+MAX_IMAGE_PIXELS = 50 * 1000 * 1000  # Decoded per image, at most
+# Images are decoded and reduced to at least this many times the size they are downsized to, then resampled
+REDUCING_GAP = 2.0
+# The project's, so it's found from any directory
+ASSET_INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".assets")
+ASSET_INDEX_VERSION = 1
+# Kind of preset: (folder next to the index, mode it is loaded in, "" for the file's own)
+PRESET_FOLDERS = {
+    "depthmap": (DMFOLDER, "L"),
+    "pattern": (PATTERNFOLDER, ""),
+}
+# Modes stored as arrays. Palettes are kept in the index
+STORED_MODES = ("L", "RGB", "RGBA", "P")
+
+
+class ImageTooLarge(ValueError):
+    """An image would take more pixels to decode than allowed"""
+
+
+def _downsized_size(size, max_dimension):
+    """Size of an image once downsized to fit in max_dimension, as `decode_image` does"""
+    if max_dimension is None or max(size) <= max_dimension:
+        return size
+    factor = max_dimension / float(max(size))
+    return int(size[0] * factor), int(size[1] * factor)
+
+
+def open_image(name, max_dimension=MAX_DIMENSION, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Opens an image file reading only its header, and plans its decoding: JPEGs much bigger than max_dimension are set
+    to decode at a reduced scale. Nothing is decoded yet.
+
+    Parameters
+    ----------
+    name : str
+        Path to the image
+    max_dimension : int
+        Size the image will be downsized to. None to keep its size
+    max_pixels : int
+        Most pixels the image may take to decode, at the planned scale. None for no limit
+
+    Returns
+    -------
+    tuple(PIL.Image.Image, tuple(int, int))
+        The image, not loaded, and the size to downsize it to
+
+    Raises
+    ------
+    IOError
+        If the file can't be read or isn't an image
+    ImageTooLarge
+        If decoding it would take more than max_pixels, or Pillow finds it too big to open
+    """
+    try:
+        i = im.open(name)
+    except im.DecompressionBombError as e:
+        # Pillow's own limit, of about 180 million pixels
+        raise ImageTooLarge(str(e))
+    original_size = i.size
+    target_size = _downsized_size(original_size, max_dimension)
+    if max(original_size) > REDUCING_GAP * max(target_size):
+        # Only JPEGs support it. Keeps the mode, so conversions give the same result
+        if i.draft(None, (int(target_size[0] * REDUCING_GAP), int(target_size[1] * REDUCING_GAP))) is not None:
+            log.d("Decoding {} at {} instead of {}".format(name, i.size, original_size))
+    if max_pixels is not None and i.size[0] * i.size[1] > max_pixels:
+        raise ImageTooLarge("'{}' is {}x{}, more than {} pixels to decode".format(
+            os.path.basename(name), i.size[0], i.size[1], max_pixels))
+    return i, target_size
+
+
+def decode_image(name, mode="", max_dimension=MAX_DIMENSION, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Decodes an image file, within a pixel budget
+
+    Parameters
+    ----------
+    name : str
+        Path to the image
+    mode : str
+        Mode to convert it to. Empty to keep the file's
+    max_dimension : int
+        Images bigger than this are downsized. None to keep their size
+    max_pixels : int
+        Most pixels the image may take to decode. None for no limit
+
+    Returns
+    -------
+    PIL.Image.Image
+        The image
+
+    Raises
+    ------
+    IOError
+        If the file can't be read or decoded
+    ImageTooLarge
+        If decoding it would take more than max_pixels. Checked before decoding
+    """
+    i, new_size = open_image(name, max_dimension, max_pixels)
+    if mode != "":
+        i = i.convert(mode)
+    # Resize if too big
+    if i.size != new_size:
+        log.d("Image is big: {}. Resizing to {}".format(i.size, new_size))
+        # Much bigger images are reduced by whole factors first, which is faster
+        i = i.resize(new_size, reducing_gap=REDUCING_GAP)
+    return i
+
+
+def _file_version(path):
+    """Size and modification time of a file, that change when it does"""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _write_atomically(path, write):
+    partial_path = path + ".part"
+    with open(partial_path, "wb") as f:
+        write(f)
+    os.replace(partial_path, path)
+
+
+class AssetIndex(object):
+    """
+    Index of preset images, in a directory: `index.json` and a .npy file per image.
+
+    The index is read on first use and again whenever it is updated, by this or another process.
+    """
+    def __init__(self, directory=ASSET_INDEX_DIR):
+        """
+        Parameters
+        ----------
+        directory : str
+            Directory of the index. Preset paths are relative to its parent
+        """
+        self.directory = directory
+        self._index_version = None
+        self._assets = {}  # kind: {name: entry}
+        self._by_path = {}  # absolute path: entry
+        self._max_dimension = None
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    @property
+    def _root(self):
+        return os.path.dirname(os.path.abspath(self.directory))
+
+    def _refresh(self):
+        """Reads the index if it changed since the last time"""
+        try:
+            version = _file_version(self._index_path)
+        except OSError:
+            version = None
+        if version == self._index_version:
+            return
+        self._index_version = version
+        self._assets, self._by_path, self._max_dimension = {}, {}, None
+        if version is None:
+            return
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            log.w("Asset index '{}' can't be read: {}".format(self._index_path, e))
+            return
+        if index.get("version") != ASSET_INDEX_VERSION:
+            log.w("Asset index '{}' is outdated. Update it".format(self._index_path))
+            return
+        self._assets = index["assets"]
+        self._max_dimension = index["max_dimension"]
+        for entries in self._assets.values():
+            for entry in entries.values():
+                self._by_path[os.path.join(self._root, entry["path"])] = entry
+
+    def names(self, kind):
+        """
+        Parameters
+        ----------
+        kind : str
+            One of PRESET_FOLDERS
+
+        Returns
+        -------
+        list(str)
+            File names of the indexed presets of that kind, sorted
+        """
+        self._refresh()
+        return sorted(self._assets.get(kind, {}))
+
+    def paths(self, kind):
+        """Paths of the indexed presets of a kind, relative to the current directory if they are inside it"""
+        cwd = os.path.join(os.getcwd(), "")
+        paths = [os.path.join(self._root, self._assets[kind][name]["path"]) for name in self.names(kind)]
+        return [os.path.relpath(path) if path.startswith(cwd) else path for path in paths]
+
+    def listing(self):
+        """
+        Returns
+        -------
+        dict
+            Name, width and height of every preset, by kind
+        """
+        self._refresh()
+        return {kind: [{"name": name, "width": entries[name]["width"], "height": entries[name]["height"]}
+                       for name in sorted(entries)]
+                for kind, entries in self._assets.items()}
+
+    def image(self, name, mode="", max_dimension=MAX_DIMENSION):
+        """
+        A preset image, as `decode_image` would return it, without decoding it. Its pixels are mapped from the index:
+        images of 1 and 4 bytes per pixel share them, they must not be modified.
+
+        Returns
+        -------
+        PIL.Image.Image
+            The image. None if it isn't indexed like that, or the file changed since the index was updated
+        """
+        self._refresh()
+        entry = self._by_path.get(os.path.abspath(name))
+        if entry is None or mode != entry["mode_requested"]:
+            return None
+        original_max = max(entry["original_width"], entry["original_height"])
+        if max_dimension != self._max_dimension and any(d is not None and original_max > d
+                                                        for d in (max_dimension, self._max_dimension)):
+            # Downsized to another size
+            return None
+        try:
+            if list(_file_version(name)) != entry["version"]:
+                return None
+            pixels = np.load(os.path.join(self.directory, entry["data"]), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        i = im.fromarray(pixels)
+        if entry["mode"] == "P":
+            i.putpalette(entry["palette"])
+        return i
+
+    def update(self, folders=None, max_dimension=MAX_DIMENSION):
+        """
+        Indexes new and changed files, and forgets the removed ones. Unchanged files aren't decoded again
+
+        Parameters
+        ----------
+        folders : dict
+            {kind: (folder, mode)}, like PRESET_FOLDERS. Folders are relative to the parent of the index directory
+        max_dimension : int
+            Images bigger than this are downsized, like when loaded. Changing it reindexes everything
+
+        Returns
+        -------
+        dict
+            Names of the "added", "updated" and "removed" presets, and the number of "unchanged" ones
+        """
+        # Imported here, only updates need it
+        import shutil
+
+        folders = PRESET_FOLDERS if folders is None else folders
+        self._refresh()
+        old_assets = self._assets if self._max_dimension == max_dimension else {}
+        changes = {"added": [], "updated": [], "removed": [], "unchanged": 0}
+        assets = {}
+        os.makedirs(self.directory, exist_ok=True)
+        for kind, (folder, mode) in folders.items():
+            old_entries = old_assets.get(kind, {})
+            entries = assets[kind] = {}
+            os.makedirs(os.path.join(self.directory, kind), exist_ok=True)
+            folder_path = os.path.join(self._root, folder)
+            names = sorted(os.listdir(folder_path)) if os.path.isdir(folder_path) else []
+            for name in names:
+                path = os.path.join(folder_path, name)
+                if not os.path.isfile(path):
+                    continue
+                version = list(_file_version(path))
+                old_entry = old_entries.get(name)
+                if old_entry is not None and old_entry["version"] == version and old_entry["mode_requested"] == mode:
+                    entries[name] = old_entry
+                    changes["unchanged"] += 1
+                    continue
+                try:
+                    original_size = im.open(path).size
+                    i = decode_image(path, mode, max_dimension)
+                except (IOError, ValueError) as e:
+                    log.w("Skipping '{}': {}".format(path, e))
+                    continue
+                if i.mode not in STORED_MODES:
+                    log.w("Skipping '{}': {} images are not indexed".format(path, i.mode))
+                    continue
+                entry = {
+                    "path": "{}/{}".format(folder, name),
+                    "version": version,
+                    "mode_requested": mode,
+                    "mode": i.mode,
+                    "width": i.size[0],
+                    "height": i.size[1],
+                    "original_width": original_size[0],
+                    "original_height": original_size[1],
+                    "data": "{}/{}.npy".format(kind, name),
+                }
+                if i.mode == "P":
+                    entry["palette"] = i.getpalette()
+                pixels = np.asarray(i)
+                _write_atomically(os.path.join(self.directory, entry["data"]), lambda f: np.save(f, pixels))
+                entries[name] = entry
+                changes["updated" if name in old_entries else "added"].append("{}/{}".format(folder, name))
+            for name in sorted(set(old_entries) - set(entries)):
+                changes["removed"].append("{}/{}".format(folder, name))
+                try:
+                    os.remove(os.path.join(self.directory, old_entries[name]["data"]))
+                except OSError:
+                    pass
+        index = {"version": ASSET_INDEX_VERSION, "max_dimension": max_dimension, "assets": assets}
+        _write_atomically(self._index_path, lambda f: f.write(json.dumps(index, indent=1).encode("utf-8")))
+        # Data of kinds that aren't indexed anymore
+        for kind in set(old_assets) - set(assets):
+            shutil.rmtree(os.path.join(self.directory, kind), ignore_errors=True)
+        self._refresh()
+        return changes
+
+
+# The project's presets
+presets = AssetIndex()
+
+
+def obtain_args():
+    arg_parser = argparse.ArgumentParser(description="Stereogramaxo preset index. Updates it, only decoding the "
+                                                     "files that changed")
+    arg_parser.add_argument("--index-dir", help="Directory of the index", default=ASSET_INDEX_DIR)
+    arg_parser.add_argument("--max-dimension", help="Presets bigger than this are downsized", type=int,
+                            default=MAX_DIMENSION)
+    arg_parser.add_argument("--list", help="Print the indexed presets as JSON instead of updating the index",
+                            action="store_true")
+    return arg_parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = obtain_args()
+    index = AssetIndex(args.index_dir)
+    if args.list:
+        print(json.dumps({"code": 200, "text": index.listing()}))
+    else:
+        result = index.update(max_dimension=args.max_dimension)
+        print(json.dumps({"code": 200, "text": result}))
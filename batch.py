@@ -0,0 +1,215 @@
+#!/usr/bin/python
+"""
+Batch mode: renders many stereograms in a single invocation, with a pool of worker processes.
+
+Items come either from depthmaps (a directory or a glob) combined with every given pattern, or from a manifest: a JSONL
+file with one JSON object of `main.RenderOptions` fields per line, and an optional "name" for the result file.
+
+Results are saved with deterministic names, so runs can be repeated and compared. Workers live for the whole batch,
+so loaded patterns and depthmaps are reused between the items they render.
+"""
+
+import argparse
+import glob
+import json
+import os
+import functools
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import ResultCache
+from log import Log as log
+from main import SUPPORTED_IMAGE_EXTENSIONS, RenderOptions, render_image, save_to_file, \
+    return_http_response, _HTTPCode
+from output import FORMATS, PNG_COMPRESS_LEVEL, QUALITY, encoder_params
+
+DOTS = "dots"
+
+
+def expand_images(source):
+    """
+    Lists the images of a directory or matching a glob, sorted by path
+
+    Parameters
+    ----------
+    source : str
+        Directory or glob
+
+    Returns
+    -------
+    list(str)
+        Paths to the images
+    """
+    paths = glob.glob(os.path.join(source, "*")) if os.path.isdir(source) else glob.glob(source)
+    return sorted(path for path in paths if os.path.splitext(path)[1].lower() in SUPPORTED_IMAGE_EXTENSIONS)
+
+
+def _stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def make_items(depthmaps, patterns, defaults):
+    """
+    Combines every depthmap with every pattern
+
+    Parameters
+    ----------
+    depthmaps : list(str)
+        Paths to depthmap images
+    patterns : list(str)
+        Paths to pattern images. `DOTS` for a random dot pattern
+    defaults : dict
+        Options shared by every item
+
+    Returns
+    -------
+    list(tuple(str, dict))
+        Result name and options of each item. Items sharing a pattern are next to each other
+    """
+    return [("{}__{}".format(_stem(depthmap), DOTS if pattern == DOTS else _stem(pattern)),
+             dict(defaults, depthmap=depthmap, pattern=None if pattern == DOTS else pattern))
+            for pattern in patterns for depthmap in depthmaps]
+
+
+def read_manifest(filename, defaults):
+    """
+    Reads a JSONL manifest
+
+    Parameters
+    ----------
+    filename : str
+        Manifest with a JSON object per line: `RenderOptions` fields and an optional "name" for the result
+    defaults : dict
+        Options for fields that items don't set
+
+    Returns
+    -------
+    list(tuple(str, dict))
+        Result name and options of each item. Items without name are named after their line number
+    """
+    items = []
+    with open(filename) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            name = item.pop("name", None) or "{:05d}".format(line_number)
+            items.append((name, dict(defaults, **item)))
+    return items
+
+
+def _render_item(item, output_dir, cache_dir, encoding):
+    """Worker process entry point. Renders and saves one item. Failures are reported, not raised"""
+    name, options_dict = item
+    try:
+        # Encoded straight into the result file
+        write_image = functools.partial(render_image, RenderOptions.from_dict(options_dict),
+                                        result_cache=ResultCache(cache_dir) if cache_dir else None, **encoding)
+        return (name,) + save_to_file(write_image, output_dir, name, ".{}".format(encoding["file_format"]))
+    except Exception as e:
+        return name, False, "Could not render: {}".format(e)
+
+
+def run_batch(items, output_dir, workers=None, cache_dir=None, encoding=None):
+    """
+    Renders and saves every item
+
+    Parameters
+    ----------
+    items : list(tuple(str, dict))
+        Result name and options of each item
+    output_dir : str
+        Directory where to save the results
+    workers : int
+        Number of render processes. Defaults to the number of CPUs
+    cache_dir : str
+        Directory of a result cache. Not used if None
+    encoding : dict
+        `main.render_image` keyword arguments: file_format, quality and compress_level. PNG by default
+
+    Returns
+    -------
+    list(tuple(str, bool, str))
+        Name, success and path to the result or reason of failure, of each item, in order
+    """
+    names = [name for name, _ in items]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError("Repeated result names: {}".format(duplicates))
+    workers = workers or os.cpu_count()
+    encoding = dict({"file_format": "png"}, **(encoding or {}))
+    # Fail before starting, not once per item
+    encoder_params(**encoding)
+    # Consecutive items, that likely share a pattern, go to the same worker
+    chunksize = max(1, len(items) // (4 * workers))
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for name, success, additional_info in pool.map(_render_item, items, [output_dir] * len(items),
+                                                       [cache_dir] * len(items), [encoding] * len(items),
+                                                       chunksize=chunksize):
+            if success:
+                log.i("{} of {} ready: {}".format(len(results) + 1, len(items), additional_info))
+            else:
+                log.e("{} of {} failed: {}".format(len(results) + 1, len(items), additional_info))
+            results.append((name, success, additional_info))
+    return results
+
+
+def obtain_args():
+    arg_parser = argparse.ArgumentParser(description="Stereogramaxo: renders many stereograms at once")
+    arg_parser.add_argument("source", help="Directory or glob of depthmap images, or a .jsonl manifest")
+    arg_parser.add_argument("--pattern", "-p", action="append", default=[],
+                            help="Directory, glob or path of pattern images to combine with every depthmap. "
+                                 "Can be repeated. '{}' for a random dot pattern".format(DOTS))
+    arg_parser.add_argument("--dots", help="Also combine every depthmap with a random dot pattern",
+                            action="store_true")
+    viewmode_arg_group = arg_parser.add_mutually_exclusive_group()
+    viewmode_arg_group.add_argument("--wall", "-w", help="Wall eyed mode (default)", action="store_true")
+    viewmode_arg_group.add_argument("--cross", "-c", help="Cross eyed mode", action="store_true")
+    arg_parser.add_argument("--blur", "-b", help="Gaussian blur ammount", type=int)
+    arg_parser.add_argument("--forcedepth", help="Force max depth to use", type=float)
+    arg_parser.add_argument("--seed", help="Seed for the random dots", type=int)
+    arg_parser.add_argument("--output", "-o", help="Directory where to store the results", required=True)
+    arg_parser.add_argument("--workers", help="Number of render processes. Defaults to the number of CPUs", type=int)
+    arg_parser.add_argument("--cache-dir", help="Directory of a result cache. Repeated renders are read from it")
+    arg_parser.add_argument("--format", help="Output file format", choices=sorted(FORMATS), default="png")
+    arg_parser.add_argument("--quality", help="Quality of webp and jpeg images, 1 to 100", type=int, default=QUALITY)
+    arg_parser.add_argument("--compress-level", help="zlib compression level of png images, 0 to 9", type=int,
+                            default=PNG_COMPRESS_LEVEL)
+    args = arg_parser.parse_args()
+    if not args.source.endswith(".jsonl") and not args.pattern and not args.dots:
+        arg_parser.error("Depthmaps need at least one --pattern or --dots")
+    return args
+
+
+def main():
+    args = obtain_args()
+    defaults = {"wall": not args.cross}
+    for field in ["blur", "forcedepth", "seed"]:
+        if getattr(args, field) is not None:
+            defaults[field] = getattr(args, field)
+    if args.source.endswith(".jsonl"):
+        items = read_manifest(args.source, defaults)
+    else:
+        patterns = [path for source in args.pattern
+                    for path in ([DOTS] if source == DOTS else expand_images(source))]
+        if args.dots:
+            patterns.append(DOTS)
+        items = make_items(expand_images(args.source), patterns, defaults)
+    if not items:
+        log.e("Nothing to render")
+        return_http_response(_HTTPCode.BAD_REQUEST, "Nothing to render")
+        sys.exit(1)
+    t0 = time.time()
+    results = run_batch(items, args.output, args.workers, args.cache_dir,
+                        {"file_format": args.format, "quality": args.quality, "compress_level": args.compress_level})
+    failures = [result for result in results if not result[1]]
+    log.i("Batch of {} finished after {:.2f}s, {} failed".format(len(results), time.time() - t0, len(failures)))
+    return_http_response(_HTTPCode.INTERNAL_SERVER_ERROR if failures else _HTTPCode.OK,
+                         [{"name": name, "success": success, "text": additional_info}
+                          for name, success, additional_info in results])
+
+
+if __name__ == "__main__":
+    main()
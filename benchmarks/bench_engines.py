@@ -0,0 +1,56 @@
+#!/usr/bin/python
+"""
+Compares the rendering engines on the bundled depthmaps: time of the pixel shifting stage only, with the same
+depthmap and canvas as `main.make_stereogram`.
+
+Run from the project root: python benchmarks/bench_engines.py [engine ...]
+Defaults to comparing 'numpy' and 'hsr'. 'pixel' can be added, but it takes minutes.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from engines import ENGINES  # noqa: E402
+from main import SHIFT_RATIO, RenderOptions, make_canvas, make_depthmap, _oversample_depthmap  # noqa: E402
+
+DEPTHMAPS_FOLDER = "depthmaps"
+PATTERN = "patterns/jellybeans_tile.jpg"
+DEFAULT_ENGINES = ["numpy", "hsr"]
+REPEATS = 3
+
+
+def _best_time(engine, dm_img, canvas_img, pattern_width, wall, subpixel):
+    best = None
+    for _ in range(REPEATS):
+        canvas_copy = canvas_img.copy()
+        t0 = time.perf_counter()
+        ENGINES[engine](dm_img, canvas_copy, pattern_width, pattern_width * SHIFT_RATIO, wall, subpixel)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    engines = sys.argv[1:] or DEFAULT_ENGINES
+    print("{:<20}{:>9}{:>7}{:>12}".format("depthmap", "pattern", "wall", "canvas") +
+          "".join("{:>12}".format(engine + " (s)") for engine in engines))
+    for filename in sorted(os.listdir(DEPTHMAPS_FOLDER)):
+        for pattern in [None, PATTERN]:
+            for wall in [True, False]:
+                options = RenderOptions(depthmap=os.path.join(DEPTHMAPS_FOLDER, filename), pattern=pattern,
+                                        wall=wall, seed=0)
+                dm_img = make_depthmap(options)
+                canvas_img, pattern_width = make_canvas(dm_img.size, options)
+                dm_img = _oversample_depthmap(dm_img, options)
+                times = [_best_time(engine, dm_img, canvas_img, pattern_width, wall, options.subpixel)
+                         for engine in engines]
+                print("{:<20}{:>9}{:>7}{:>12}".format(
+                    filename, "image" if pattern else "dots", str(wall), "{}x{}".format(*canvas_img.size)) +
+                    "".join("{:>12.4f}".format(t) for t in times))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+"""
+Compares the previous, pixel by pixel, `redistribute_grays` with the current one on the bundled depthmaps.
+
+Run from the project root: python benchmarks/bench_redistribute_grays.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from main import load_file, redistribute_grays  # noqa: E402
+
+DEPTHMAPS_FOLDER = "depthmaps"
+GRAY_HEIGHTS = [0.2, 0.5, 1.0]
+
+
+def legacy_redistribute_grays(img_object, gray_height):
+    """Pixel by pixel implementation, as it was before vectorizing. Modifies `img_object` in place."""
+    if img_object.mode != "L":
+        img_object = img_object.convert("L")
+    min_gray = {
+        "point": (0, 0),
+    }
+    min_gray["value"] = img_object.getpixel(min_gray["point"])
+    max_gray = {
+        "point": (0, 0),
+    }
+    max_gray["value"] = img_object.getpixel(max_gray["point"])
+
+    for x in range(img_object.size[0]):
+        for y in range(img_object.size[1]):
+            this_gray = img_object.getpixel((x, y))
+            if this_gray > img_object.getpixel(max_gray["point"]):
+                max_gray["point"] = (x, y)
+                max_gray["value"] = this_gray
+            if this_gray < img_object.getpixel(min_gray["point"]):
+                min_gray["point"] = (x, y)
+                min_gray["value"] = this_gray
+
+    old_min = min_gray["value"]
+    old_max = max_gray["value"]
+    old_interval = old_max - old_min
+    new_min = 0
+    new_max = int(255.0 * gray_height)
+    new_interval = new_max - new_min
+
+    conv_factor = float(new_interval)/float(old_interval)
+
+    pixels = img_object.load()
+    for x in range(img_object.size[0]):
+        for y in range(img_object.size[1]):
+            pixels[x, y] = int((pixels[x, y] * conv_factor)) + new_min
+    return img_object
+
+
+def _timed(function, *args):
+    t0 = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - t0
+
+
+def main():
+    print("{:<28}{:>8}{:>12}{:>12}{:>10}  {}".format("depthmap", "height", "legacy (s)", "new (s)", "speedup", "same"))
+    for filename in sorted(os.listdir(DEPTHMAPS_FOLDER)):
+        dm_img = load_file(os.path.join(DEPTHMAPS_FOLDER, filename), "L")
+        if dm_img is None:
+            continue
+        for gray_height in GRAY_HEIGHTS:
+            legacy_img, legacy_time = _timed(legacy_redistribute_grays, dm_img.copy(), gray_height)
+            new_img, new_time = _timed(redistribute_grays, dm_img, gray_height)
+            print("{:<28}{:>8}{:>12.4f}{:>12.4f}{:>9.0f}x  {}".format(
+                filename, gray_height, legacy_time, new_time, legacy_time / new_time,
+                legacy_img.tobytes() == new_img.tobytes()))
+
+
+if __name__ == "__main__":
+    main()
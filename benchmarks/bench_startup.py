@@ -0,0 +1,54 @@
+#!/usr/bin/python
+"""
+Measures the startup latency of `main.py`, as paid by every request of the web GUI: wall time of whole invocations,
+from spawning the process to its exit.
+
+Run from the project root: python benchmarks/bench_startup.py [runs]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_RUNS = 20
+DEPTHMAP = "depthmaps/shark.png"
+
+
+def _wall_times(args, runs):
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t0)
+    return sorted(times)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RUNS
+    output_dir = tempfile.mkdtemp()
+    render_args = ["main.py", "--depthmap", DEPTHMAP, "--dots", "--seed", "1", "--wall", "--output", output_dir,
+                   "--log-file", ""]
+    cases = [
+        ("interpreter only", ["-c", "pass"]),
+        ("--help", ["main.py", "--help"]),
+        ("argument error", ["main.py", "--depthmap", "missing.png", "--dots", "--wall"]),
+        ("render", render_args),
+        ("result cache hit", render_args + ["--cache-dir", os.path.join(output_dir, "cache")]),
+    ]
+    try:
+        # Fill the result cache, so every measured run is a hit
+        subprocess.run([sys.executable] + cases[-1][1], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        print("{:<20}{:>12}{:>12}{:>12}".format("case", "min (ms)", "median (ms)", "max (ms)"))
+        for name, args in cases:
+            times = _wall_times(args, runs)
+            print("{:<20}{:>12.1f}{:>12.1f}{:>12.1f}".format(name, times[0] * 1000, times[len(times) // 2] * 1000,
+                                                             times[-1] * 1000))
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+"""
+Benchmark suite: renders the bundled depthmaps at several sizes, with random dots and pattern images, in wall and cross
+eyed modes, recording wall time, pixels per second and peak memory of each case.
+
+Every case runs in a fresh process, so peak memory is that case's own: the peak resident set size of the process,
+minus what it was before rendering.
+
+Results are compared against:
+- A baseline of a previous run (`--save-baseline` to store one). Timings depend on the machine, so baselines are not
+  committed: make one before changing anything, then compare. Cases slower or bigger than the baseline beyond the
+  tolerance fail.
+- Golden hashes of the output pixels, committed in golden.json. Engines that claim to produce the same pixels as the
+  reference engine must match them exactly. Regenerate them with `--save-golden`, preferably with `--engine pixel`.
+  They are made with the default oversampling, so they are not checked with `--oversample`.
+
+The exit code is 1 if anything failed.
+
+Run from the project root:
+    python benchmarks/bench_suite.py --save-baseline
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --engine pixel --filter shark@400
+    python benchmarks/bench_suite.py --oversample 1.8 --baseline oversampled.json --save-baseline
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_FOLDER, ".."))
+
+import numpy as np  # noqa: E402
+import PIL  # noqa: E402
+from PIL import Image as im  # noqa: E402
+
+from cache import depthmap_cache, pattern_cache, shift_map_cache  # noqa: E402
+from engines import DEFAULT_ENGINE, ENGINES  # noqa: E402
+from main import OVERSAMPLE, RenderOptions, make_stereogram  # noqa: E402
+
+DEPTHMAPS_FOLDER = "depthmaps"
+PATTERNS = ["patterns/jellybeans_tile.jpg", "patterns/damask_tile.png"]
+WIDTHS = [400, 800, 1500]
+SEED = 0
+REPEATS = 3
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_FOLDER, "baseline.json")
+GOLDEN = os.path.join(BENCHMARKS_FOLDER, "golden.json")
+DEFAULT_TOLERANCE = 0.25
+# Differences below these are noise, whatever the tolerance
+MIN_SECONDS_REGRESSION = 0.005
+MIN_MB_REGRESSION = 5.0
+# Engines that must produce the reference pixels
+EXACT_ENGINES = ["pixel", "numpy"]
+
+
+def _peak_rss_mb():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def make_cases(sizes_folder, widths=WIDTHS):
+    """
+    Lists every case, writing the resized depthmaps they use
+
+    Parameters
+    ----------
+    sizes_folder : str
+        Where to write the depthmaps resized to each width
+    widths : list(int)
+        Depthmap widths
+
+    Returns
+    -------
+    list(tuple(str, dict))
+        Case name and `RenderOptions` fields, sorted by name
+    """
+    cases = []
+    for filename in sorted(os.listdir(DEPTHMAPS_FOLDER)):
+        stem = os.path.splitext(filename)[0]
+        dm_img = im.open(os.path.join(DEPTHMAPS_FOLDER, filename)).convert("L")
+        for width in widths:
+            sized_path = os.path.join(sizes_folder, "{}@{}.png".format(stem, width))
+            dm_img.resize((width, int(round(dm_img.size[1] * width / float(dm_img.size[0]))))).save(sized_path)
+            for pattern in [None] + PATTERNS:
+                for wall in [True, False]:
+                    name = "{}@{}/{}/{}".format(stem, width,
+                                                "dots" if pattern is None else os.path.basename(pattern),
+                                                "wall" if wall else "cross")
+                    cases.append((name, {"depthmap": sized_path, "pattern": pattern, "wall": wall,
+                                         "seed": SEED if pattern is None else None}))
+    return sorted(cases)
+
+
+def _run_case(options_dict, repeats):
+    """Child process entry point. Best time of the repeats, peak memory and hash of the result"""
+    options = RenderOptions.from_dict(options_dict)
+    rss_before = _peak_rss_mb()
+    best = None
+    for _ in range(repeats):
+        # Every repeat starts cold, like a single render
+        depthmap_cache.clear()
+        pattern_cache.clear()
+        shift_map_cache.clear()
+        t0 = time.perf_counter()
+        stereogram_img = make_stereogram(options)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    pixels = stereogram_img.size[0] * stereogram_img.size[1]
+    return {
+        "seconds": round(best, 6),
+        "pixels_per_second": round(pixels / best),
+        "peak_mb": round(_peak_rss_mb() - rss_before, 2),
+        "size": list(stereogram_img.size),
+        "sha256": hashlib.sha256(np.asarray(stereogram_img.convert("RGB")).tobytes()).hexdigest(),
+    }
+
+
+def run_cases(cases, engine, repeats, oversample=OVERSAMPLE):
+    """
+    Runs every case in its own process
+
+    Returns
+    -------
+    dict
+        Case name: results
+    """
+    results = {}
+    for name, options_dict in cases:
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply(_run_case, (dict(options_dict, engine=engine, oversample=oversample), repeats))
+        finally:
+            pool.close()
+            pool.join()
+        print("{:<44}{:>10.4f}{:>14}{:>10.1f}".format(name, result["seconds"], result["pixels_per_second"],
+                                                     result["peak_mb"]))
+        results[name] = result
+    return results
+
+
+def compare_baseline(results, baseline, tolerance):
+    """
+    Returns
+    -------
+    list(str)
+        Description of every regression
+    """
+    failures = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["seconds"] > base["seconds"] * (1 + tolerance) and \
+                result["seconds"] - base["seconds"] > MIN_SECONDS_REGRESSION:
+            failures.append("{}: {:.4f}s, baseline {:.4f}s".format(name, result["seconds"], base["seconds"]))
+        if result["peak_mb"] > base["peak_mb"] * (1 + tolerance) and \
+                result["peak_mb"] - base["peak_mb"] > MIN_MB_REGRESSION:
+            failures.append("{}: {:.1f}MB, baseline {:.1f}MB".format(name, result["peak_mb"], base["peak_mb"]))
+    return failures
+
+
+def compare_golden(results, golden):
+    """
+    Returns
+    -------
+    list(str)
+        Every case whose pixels differ from the golden ones
+    """
+    return ["{}: pixels differ from the golden output".format(name)
+            for name, result in sorted(results.items())
+            if name in golden and result["sha256"] != golden[name]]
+
+
+def _versions():
+    return {"python": sys.version.split()[0], "pillow": PIL.__version__, "numpy": np.__version__}
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print("Saved '{}'".format(path))
+
+
+def obtain_args():
+    arg_parser = argparse.ArgumentParser(description="Stereogramaxo benchmark suite")
+    arg_parser.add_argument("--engine", help="Rendering engine", choices=sorted(ENGINES), default=DEFAULT_ENGINE)
+    arg_parser.add_argument("--filter", help="Only run cases whose name contains this")
+    arg_parser.add_argument("--repeats", help="Renders per case. The best time counts", type=int, default=REPEATS)
+    arg_parser.add_argument("--oversample", help="Oversampling factor of pattern images", type=float,
+                            default=OVERSAMPLE)
+    arg_parser.add_argument("--baseline", help="Baseline file", default=DEFAULT_BASELINE)
+    arg_parser.add_argument("--save-baseline", help="Store this run as the baseline", action="store_true")
+    arg_parser.add_argument("--save-golden", help="Store the output hashes of this run as the golden ones",
+                            action="store_true")
+    arg_parser.add_argument("--tolerance", help="Allowed slowdown or memory growth over the baseline, as a fraction",
+                            type=float, default=DEFAULT_TOLERANCE)
+    return arg_parser.parse_args()
+
+
+def main():
+    args = obtain_args()
+    with tempfile.TemporaryDirectory() as sizes_folder:
+        cases = [case for case in make_cases(sizes_folder) if not args.filter or args.filter in case[0]]
+        print("{:<44}{:>10}{:>14}{:>10}".format("case ({})".format(args.engine), "time (s)", "pixels/s", "peak MB"))
+        results = run_cases(cases, args.engine, args.repeats, args.oversample)
+
+    failures = []
+    if args.save_baseline:
+        _write_json(args.baseline, {"engine": args.engine, "versions": _versions(), "cases": results})
+    elif os.path.exists(args.baseline):
+        baseline = _read_json(args.baseline)
+        if baseline["engine"] != args.engine:
+            print("Warning: baseline made with engine '{}'".format(baseline["engine"]))
+        failures.extend(compare_baseline(results, baseline["cases"], args.tolerance))
+    else:
+        print("No baseline in '{}'. Make one with --save-baseline".format(args.baseline))
+
+    if args.oversample != OVERSAMPLE:
+        print("Golden outputs are for the default oversampling, neither checked nor saved")
+    elif args.save_golden:
+        _write_json(GOLDEN, {"engine": args.engine, "versions": _versions(),
+                             "cases": {name: result["sha256"] for name, result in results.items()}})
+    elif args.engine in EXACT_ENGINES:
+        golden = _read_json(GOLDEN)
+        if golden["versions"]["pillow"] != PIL.__version__:
+            # Pillow's resampling, used with pattern images, may change between versions
+            print("Warning: golden outputs made with Pillow {}, this is {}".format(golden["versions"]["pillow"],
+                                                                                    PIL.__version__))
+        failures.extend(compare_golden(results, golden["cases"]))
+
+    if failures:
+        print("\n{} FAILURES:".format(len(failures)))
+        for failure in failures:
+            print("  " + failure)
+        sys.exit(1)
+    print("\nAll {} cases passed".format(len(results)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Caches for work that is identical between renders."""
+
+import os
+import threading
+from collections import OrderedDict
+
+from output import FORMATS
+
+# SETTINGS
+PATTERN_CACHE_BYTES = 64 * 1024 * 1024
+DEPTHMAP_CACHE_BYTES = 64 * 1024 * 1024
+SHIFT_MAP_CACHE_BYTES = 128 * 1024 * 1024
+RESULT_CACHE_BYTES = 512 * 1024 * 1024
+
+
+class LRUCache(object):
+    """
+    In-memory least recently used cache, bounded by the total size of its values in bytes.
+
+    Values are shared between everyone getting them: they must not be modified.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key: (value, size in bytes)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Retrieves a value, marking it as the most recently used
+
+        Parameters
+        ----------
+        key : hashable
+            Key of the value
+
+        Returns
+        -------
+        object
+            The cached value. None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        """
+        Stores a value, evicting the least recently used ones until everything fits
+
+        Parameters
+        ----------
+        key : hashable
+            Key of the value
+        value : object
+            Value to store
+        nbytes : int
+            Size of the value, in bytes. Values bigger than the whole cache are not stored
+        """
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            while self.current_bytes + nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class ResultCache(object):
+    """
+    On-disk cache of encoded results, one file per key. Can be shared by concurrent processes.
+
+    Files are named after the key, with the extension of their format. They are written atomically, and their
+    modification time is the last time they were used: the least recently used ones are removed when the directory
+    grows beyond `max_bytes`.
+    """
+    EXTENSIONS = tuple(".{}".format(file_format) for file_format in FORMATS)
+
+    def __init__(self, directory, max_bytes=RESULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, file_format):
+        if file_format not in FORMATS:
+            raise ValueError("Unknown format '{}'. Valid options are: {}".format(file_format, sorted(FORMATS)))
+        return os.path.join(self.directory, "{}.{}".format(key, file_format))
+
+    def get(self, key, file_format="png"):
+        """
+        Parameters
+        ----------
+        key : str
+            Content hash of the result
+        file_format : str
+            One of `output.FORMATS`, the format of the result
+
+        Returns
+        -------
+        bytes
+            The stored result. None on a miss
+        """
+        path = self._path(key, file_format)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data, file_format="png"):
+        """
+        Stores a result, then evicts the least recently used ones if needed
+
+        Parameters
+        ----------
+        key : str
+            Content hash of the result
+        data : bytes
+            Encoded result
+        file_format : str
+            One of `output.FORMATS`, the format of the result
+        """
+        # Imported here, most runs never write to the cache
+        import tempfile
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key, file_format))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.EXTENSIONS):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Another process got it first
+                pass
+            total_bytes -= size
+
+
+def image_nbytes(img_object):
+    """Size in memory of the pixels of a PIL image"""
+    return img_object.size[0] * img_object.size[1] * len(img_object.getbands())
+
+
+# Resized pattern tiles, keyed by (file path, mtime, strip width), and ready to paste pattern strips, keyed by
+# (file path, mtime, strip width, strip height, oversample, top row)
+pattern_cache = LRUCache(PATTERN_CACHE_BYTES)
+# Blurred and normalized depthmaps
+depthmap_cache = LRUCache(DEPTHMAP_CACHE_BYTES)
+# Shift maps of those depthmaps, keyed by the depthmap key and the render settings
+shift_map_cache = LRUCache(SHIFT_MAP_CACHE_BYTES)
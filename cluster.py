@@ -0,0 +1,415 @@
+#!/usr/bin/python
+"""
+Render cluster: spreads a batch or the frames of an animation over several render servers (`server.py`), on this or
+other machines.
+
+Items are split into shards of consecutive items, that likely share a pattern, so each node reuses what it loaded. A
+shard is rendered by one node, one `POST /render` request per item over a single connection. Items the node refuses
+(4xx), i.e. a depthmap that can't be loaded, fail alone. Shards that fail, because the node can't be reached or
+answers 5xx, are retried on another node, from the first item not rendered yet. Nodes that fail WORKER_FAILURE_LIMIT
+shards in a row are left out.
+
+Results are saved here, with the names of the items, and reported in the order of the items, with the throughput of
+every shard. Nodes open the depthmap and pattern paths of the options themselves: they must see the same files, i.e.
+the project's presets or a shared folder. Items with random dots and no seed all get one picked here, so every node
+draws the same dots.
+"""
+
+import argparse
+import http.client
+import io
+import json
+import os
+import random
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+from animated_sirds import list_frames
+from batch import read_manifest
+from lazy import lazy_import, load_now
+from log import Log as log
+from main import save_to_file, return_http_response, _HTTPCode
+from output import FORMATS, PNG_COMPRESS_LEVEL, QUALITY, encoder_params
+
+# This "PIL" refers to Pillow, the PIL fork. Check https://pillow.readthedocs.io/en/
+im = lazy_import("PIL.Image")
+
+SLOTS = 2  # Shards rendered at once by each node
+RETRIES = 2  # Times a shard is tried again after failing
+REQUEST_TIMEOUT = 300.0  # Seconds to wait for a node to answer a render
+WORKER_FAILURE_LIMIT = 3  # Shards failed in a row before a node is left out
+
+
+class WorkerError(Exception):
+    """A node couldn't be reached, or failed to render (5xx). Counts against the node, unlike refused items"""
+
+
+class Shard(object):
+    """Consecutive items, rendered by one node at a time. Keeps the results of the items rendered so far"""
+    def __init__(self, index, items):
+        """
+        Parameters
+        ----------
+        index : int
+            Position of the shard
+        items : list(tuple(int, str, dict))
+            Position, result name and options of each item
+        """
+        self.index = index
+        self.items = items
+        self.results = {}  # Item position: (name, success, path or reason of failure)
+        self.attempts = 0
+        self.failed_on = set()  # Nodes
+        self.report = None
+
+    @property
+    def remaining(self):
+        return [item for item in self.items if item[0] not in self.results]
+
+
+class _Worker(object):
+    def __init__(self, url, slots):
+        self.url = url
+        self.slots = slots
+        self.busy = 0
+        self.failures = 0  # In a row
+        self.alive = True
+
+    @property
+    def free(self):
+        return self.slots - self.busy if self.alive else 0
+
+
+def make_frame_items(frame_files, defaults):
+    """
+    Items for the frames of an animation
+
+    Parameters
+    ----------
+    frame_files : list(str)
+        Depthmap of each frame
+    defaults : dict
+        Options shared by every frame
+
+    Returns
+    -------
+    list(tuple(str, dict))
+        Result name and options of each frame. Named after the depthmaps, so they sort like the frames
+    """
+    return [(os.path.splitext(os.path.basename(frame))[0], dict(defaults, depthmap=frame)) for frame in frame_files]
+
+
+def seed_dots(items, seed):
+    """
+    Gives a seed to the items with random dots and none of their own. Otherwise each node would draw different dots
+
+    Parameters
+    ----------
+    items : list(tuple(str, dict))
+        Result name and options of each item
+    seed : int
+        Seed for the random dots
+
+    Returns
+    -------
+    list(tuple(str, dict))
+        The items, seeded
+    """
+    return [(name, dict(options, seed=seed) if options.get("pattern") is None and options.get("seed") is None
+             else options) for name, options in items]
+
+
+def make_shards(items, shard_size):
+    """
+    Splits items in shards
+
+    Parameters
+    ----------
+    items : list(tuple(str, dict))
+        Result name and options of each item
+    shard_size : int
+        Items per shard. The last one can have less
+
+    Returns
+    -------
+    list(Shard)
+    """
+    positioned = [(position, name, options_dict) for position, (name, options_dict) in enumerate(items)]
+    return [Shard(index, positioned[start:start + shard_size])
+            for index, start in enumerate(range(0, len(positioned), shard_size))]
+
+
+def _connect(url, timeout):
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    return connection_class(parts.hostname, parts.port, timeout=timeout)
+
+
+def _render_shard(worker_url, shard, output_dir, encoding, timeout):
+    """
+    Renders the remaining items of a shard on a node, saving the results. Items the node refuses (4xx), i.e. invalid
+    options or missing files, fail alone.
+
+    Returns
+    -------
+    dict
+        Throughput report of the shard
+
+    Raises
+    ------
+    WorkerError
+        If the node can't be reached or fails to render. Results of the items rendered before are kept
+    """
+    request_fields = {"format": encoding["file_format"]}
+    for field in ["quality", "compress_level"]:
+        if field in encoding:
+            request_fields[field] = encoding[field]
+    remaining = shard.remaining
+    rendered = pixels = size = 0
+    t0 = time.time()
+    connection = _connect(worker_url, timeout)
+    try:
+        for position, name, options_dict in remaining:
+            body = json.dumps(dict(options_dict, **request_fields)).encode("utf-8")
+            try:
+                connection.request("POST", "/render", body, {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                response_body = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                raise WorkerError("{} is not reachable: {}".format(worker_url, e))
+            if response.status >= _HTTPCode.INTERNAL_SERVER_ERROR:
+                raise WorkerError("{} failed to render '{}': {}".format(worker_url, name, _error_text(response_body)))
+            if response.status != _HTTPCode.OK:
+                shard.results[position] = (name, False, "Refused by {}: {}".format(worker_url,
+                                                                                   _error_text(response_body)))
+                continue
+            try:
+                width, height = im.open(io.BytesIO(response_body)).size
+            except (IOError, ValueError) as e:
+                raise WorkerError("{} answered '{}' with an invalid image: {}".format(worker_url, name, e))
+            shard.results[position] = (name,) + save_to_file(response_body, output_dir, name,
+                                                             ".{}".format(encoding["file_format"]))
+            rendered += 1
+            pixels += width * height
+            size += len(response_body)
+    finally:
+        connection.close()
+    seconds = time.time() - t0
+    return {
+        "shard": shard.index,
+        "worker": worker_url,
+        "items": len(remaining),
+        "rendered": rendered,
+        "attempts": shard.attempts,
+        "seconds": round(seconds, 3),
+        "items_per_second": round(rendered / seconds, 2) if seconds > 0 else None,
+        "megapixels_per_second": round(pixels / 1e6 / seconds, 2) if seconds > 0 else None,
+        "megabytes": round(size / 1e6, 3),
+    }
+
+
+def _error_text(response_body):
+    try:
+        return json.loads(response_body.decode("utf-8"))["text"]
+    except (ValueError, KeyError, TypeError):
+        return response_body[:200].decode("utf-8", "replace")
+
+
+def _pick_worker(workers, shard):
+    """Node with most free slots, other than those the shard failed on. None to wait for one"""
+    candidates = [worker for worker in workers if worker.free > 0]
+    if not candidates:
+        return None
+    untried = [worker for worker in candidates if worker.url not in shard.failed_on]
+    if untried:
+        return max(untried, key=lambda worker: worker.free)
+    if any(worker.alive and worker.url not in shard.failed_on for worker in workers):
+        # A node it didn't fail on is busy: wait for it
+        return None
+    return max(candidates, key=lambda worker: worker.free)
+
+
+def run_cluster(items, worker_urls, output_dir, encoding=None, shard_size=None, slots=SLOTS, retries=RETRIES,
+                timeout=REQUEST_TIMEOUT):
+    """
+    Renders every item on a set of render servers and saves the results
+
+    Parameters
+    ----------
+    items : list(tuple(str, dict))
+        Result name and options of each item
+    worker_urls : list(str)
+        Base URL of each render server, i.e. "http://10.0.0.2:8642"
+    output_dir : str
+        Directory where to save the results
+    encoding : dict
+        `main.render_image` keyword arguments: file_format, quality and compress_level. PNG by default
+    shard_size : int
+        Items per shard. Defaults to about 4 shards per slot
+    slots : int
+        Shards rendered at once by each node. More keep the render processes of a node busy
+    retries : int
+        Times a failed shard is tried again
+    timeout : float
+        Seconds to wait for a node to answer a render
+
+    Returns
+    -------
+    tuple(list(tuple(str, bool, str)), list(dict))
+        Name, success and path to the result or reason of failure, of each item, in order. Report of each shard, in
+        order: throughput of its last attempt, or its error
+    """
+    names = [name for name, _ in items]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError("Repeated result names: {}".format(duplicates))
+    if not worker_urls:
+        raise ValueError("No render servers to render with")
+    encoding = dict({"file_format": "png"}, **(encoding or {}))
+    # Fail before starting, not once per item
+    encoder_params(**encoding)
+    workers = [_Worker(url.rstrip("/"), slots) for url in worker_urls]
+    shard_size = shard_size or max(1, len(items) // (4 * slots * len(workers)))
+    shards = make_shards(items, shard_size)
+    # Loaded before the threads use it
+    load_now(im)
+    pending = deque(shards)
+    running = {}  # Future: (shard, worker)
+    with ThreadPoolExecutor(max_workers=slots * len(workers)) as pool:
+        while pending or running:
+            for shard in list(pending):
+                worker = _pick_worker(workers, shard)
+                if worker is None:
+                    continue
+                pending.remove(shard)
+                shard.attempts += 1
+                worker.busy += 1
+                running[pool.submit(_render_shard, worker.url, shard, output_dir, encoding, timeout)] = shard, worker
+            if not running:
+                # Every node was left out
+                for shard in pending:
+                    for position, name, _ in shard.remaining:
+                        shard.results[position] = (name, False, "No render server left to render it")
+                pending.clear()
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                shard, worker = running.pop(future)
+                worker.busy -= 1
+                try:
+                    shard.report = future.result()
+                except WorkerError as e:
+                    worker.failures += 1
+                    shard.failed_on.add(worker.url)
+                    if worker.failures >= WORKER_FAILURE_LIMIT and worker.alive:
+                        log.w("Leaving out {} after {} failures in a row".format(worker.url, worker.failures))
+                        worker.alive = False
+                    if shard.attempts <= retries:
+                        log.w("Shard {} failed, trying it again: {}".format(shard.index, e))
+                        pending.appendleft(shard)
+                    else:
+                        log.e("Shard {} failed {} times: {}".format(shard.index, shard.attempts, e))
+                        shard.report = {"shard": shard.index, "worker": worker.url, "items": len(shard.remaining),
+                                        "attempts": shard.attempts, "error": str(e)}
+                        for position, name, _ in shard.remaining:
+                            shard.results[position] = (name, False, str(e))
+                    continue
+                worker.failures = 0
+                report = shard.report
+                log.i("Shard {} of {} done by {}: {} items in {}s, {} items/s, {} Mpx/s".format(
+                    shard.index + 1, len(shards), worker.url, report["rendered"], report["seconds"],
+                    report["items_per_second"], report["megapixels_per_second"]))
+    results = {}
+    for shard in shards:
+        results.update(shard.results)
+    return [results[position] for position in range(len(items))], [shard.report for shard in shards]
+
+
+def _item_range(s):
+    """START:END, END excluded, like a slice. Either can be empty"""
+    try:
+        start, end = s.split(":")
+        return slice(int(start) if start else None, int(end) if end else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{}' is not a START:END range".format(s))
+
+
+def obtain_args():
+    arg_parser = argparse.ArgumentParser(description="Stereogramaxo: renders a batch or an animation on several "
+                                                     "render servers")
+    arg_parser.add_argument("source", help="A .jsonl manifest, like batch.py's, or a folder with one depthmap image "
+                                           "per frame, sorted by name")
+    arg_parser.add_argument("--worker", action="append", default=[], required=True,
+                            help="Base URL of a render server (server.py), i.e. http://10.0.0.2:8642. Repeat for "
+                                 "every node")
+    arg_parser.add_argument("--output", "-o", help="Directory where to store the results", required=True)
+    arg_parser.add_argument("--range", help="Only render these items or frames, START:END, END excluded",
+                            type=_item_range)
+    pattern_arg_group = arg_parser.add_mutually_exclusive_group()
+    pattern_arg_group.add_argument("--dots", help="Frames: generate a dot pattern for the background",
+                                   action="store_true")
+    pattern_arg_group.add_argument("--pattern", "-p", help="Frames: path to an image file to use as background "
+                                                           "pattern")
+    viewmode_arg_group = arg_parser.add_mutually_exclusive_group()
+    viewmode_arg_group.add_argument("--wall", "-w", help="Wall eyed mode (default)", action="store_true")
+    viewmode_arg_group.add_argument("--cross", "-c", help="Cross eyed mode", action="store_true")
+    arg_parser.add_argument("--blur", "-b", help="Gaussian blur ammount", type=int)
+    arg_parser.add_argument("--forcedepth", help="Force max depth to use", type=float)
+    arg_parser.add_argument("--seed", help="Seed for the random dots. Defaults to a random one, the same for every "
+                                           "item", type=int)
+    arg_parser.add_argument("--format", help="Output file format", choices=sorted(FORMATS), default="png")
+    arg_parser.add_argument("--quality", help="Quality of webp and jpeg images, 1 to 100", type=int, default=QUALITY)
+    arg_parser.add_argument("--compress-level", help="zlib compression level of png images, 0 to 9", type=int,
+                            default=PNG_COMPRESS_LEVEL)
+    arg_parser.add_argument("--shard-size", help="Items per shard. Defaults to about 4 shards per slot", type=int)
+    arg_parser.add_argument("--slots", help="Shards rendered at once by each node", type=int, default=SLOTS)
+    arg_parser.add_argument("--retries", help="Times a failed shard is tried again", type=int, default=RETRIES)
+    arg_parser.add_argument("--timeout", help="Seconds to wait for a node to answer a render", type=float,
+                            default=REQUEST_TIMEOUT)
+    args = arg_parser.parse_args()
+    if not args.source.endswith(".jsonl") and not os.path.isdir(args.source):
+        arg_parser.error("'{}' is neither a .jsonl manifest nor a folder of frames".format(args.source))
+    return args
+
+
+def main():
+    args = obtain_args()
+    defaults = {"wall": not args.cross}
+    for field in ["blur", "forcedepth", "seed"]:
+        if getattr(args, field) is not None:
+            defaults[field] = getattr(args, field)
+    if args.source.endswith(".jsonl"):
+        items = read_manifest(args.source, defaults)
+    else:
+        items = make_frame_items(list_frames(args.source),
+                                 dict(defaults, pattern=None if args.dots else args.pattern))
+    if args.seed is None:
+        seed = random.randrange(1 << 32)
+        log.i("Random dots seed: {}".format(seed))
+        items = seed_dots(items, seed)
+    if args.range is not None:
+        items = items[args.range]
+    if not items:
+        log.e("Nothing to render")
+        return_http_response(_HTTPCode.BAD_REQUEST, "Nothing to render")
+        sys.exit(1)
+    t0 = time.time()
+    results, reports = run_cluster(items, args.worker, args.output,
+                                   {"file_format": args.format, "quality": args.quality,
+                                    "compress_level": args.compress_level},
+                                   args.shard_size, args.slots, args.retries, args.timeout)
+    failures = [result for result in results if not result[1]]
+    elapsed = time.time() - t0
+    log.i("{} items rendered by {} nodes after {:.2f}s ({:.2f} items/s), {} failed".format(
+        len(results), len(args.worker), elapsed, len(results) / elapsed, len(failures)))
+    return_http_response(_HTTPCode.INTERNAL_SERVER_ERROR if failures else _HTTPCode.OK,
+                         {"items": [{"name": name, "success": success, "text": additional_info}
+                                    for name, success, additional_info in results],
+                          "shards": reports})
+
+
+if __name__ == "__main__":
+    main()
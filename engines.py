@@ -0,0 +1,396 @@
+"""Rendering engines: the pixel shifting stage of the stereogram generation."""
+
+from lazy import lazy_import
+from shiftmap import SUBPIXEL_BITS, SUBPIXEL_HALF, SUBPIXEL_MASK, ShiftMap
+
+np = lazy_import("numpy")
+# This "PIL" refers to Pillow, the PIL fork. Check https://pillow.readthedocs.io/en/
+im = lazy_import("PIL.Image")
+
+SUBPIXEL_BLOCK_ROWS = 64  # Rows sampled from the pattern strip at once
+
+
+def render_pixel(dm_img, canvas_img, pattern_width, depth_factor, wall, subpixel=False, shift_map=None):
+    """
+    Reference engine. Shifts the canvas one pixel at a time, strip by strip.
+
+    Parameters
+    ----------
+    dm_img : PIL.Image.Image
+        Grayscale depthmap
+    canvas_img : PIL.Image.Image
+        RGB canvas, with the first pattern strip(s) already pasted at the center. Modified in place
+    pattern_width : int
+        Width of the pattern strip, in pixels
+    depth_factor : float
+        Maximum shift, in pixels, for a white depthmap pixel
+    wall : bool
+        True for wall eyed mode, False for cross eyed mode
+    subpixel : bool
+        Shift by fractions of a pixel. Instead of pixels, what is shifted is the position in the pattern strip each
+        pixel shows, interpolated between the two nearest pixels. The strip is sampled once at the end, so it doesn't
+        blur as it repeats. Meant for pattern images, random dots would blur
+    shift_map : shiftmap.ShiftMap
+        Shifts of the depthmap for these settings, i.e. cached from a previous render. Computed if not given
+
+    Returns
+    -------
+    PIL.Image.Image
+        The rendered canvas
+    """
+    def shift_pixels(dm_start_x, direction):
+        """ shifts pixel of image. direction==1 right, -1 left """
+        cv_pixels = canvas_img.load()
+        while 0 <= dm_start_x < dm_img.size[0]:
+            for dm_y in range(dm_img.size[1]):
+                constrained_end = max(0, min(dm_img.size[0]-1, dm_start_x + direction * pattern_width))
+                for dm_x in range(int(dm_start_x), int(constrained_end), direction):
+                    px_shift = shifts[dm_y][dm_x]*direction
+                    if direction == 1:
+                        cv_pixels[dm_x + pattern_width, dm_y] = canvas_img.getpixel((px_shift + dm_x, dm_y))
+                    if direction == -1:
+                        cv_pixels[dm_x, dm_y] = canvas_img.getpixel((dm_x + pattern_width + px_shift, dm_y))
+
+            dm_start_x += direction*pattern_width
+
+    def shift_coordinates(dm_start_x, direction):
+        """ Same as shift_pixels, on the strip positions. Copies across a strip are one pattern width apart """
+        while 0 <= dm_start_x < dm_img.size[0]:
+            for dm_y in range(dm_img.size[1]):
+                row = coordinates[dm_y]
+                constrained_end = max(0, min(dm_img.size[0]-1, dm_start_x + direction * pattern_width))
+                for dm_x in range(int(dm_start_x), int(constrained_end), direction):
+                    px_shift = shifts[dm_y][dm_x]*direction
+                    whole = px_shift >> SUBPIXEL_BITS
+                    fraction = px_shift & SUBPIXEL_MASK
+                    if direction == 1:
+                        source = dm_x + whole
+                        row[dm_x + pattern_width] = row[source] + _interpolate(row[source], row[source + 1], fraction) \
+                            + strip_width
+                    if direction == -1:
+                        source = dm_x + pattern_width + whole
+                        row[dm_x] = row[source] + _interpolate(row[source], row[source + 1], fraction) - strip_width
+
+            dm_start_x += direction*pattern_width
+
+    dm_center_x = dm_img.size[0]/2
+    shifts = _checked_shift_map(shift_map, dm_img, depth_factor, wall, subpixel).shifts.tolist()
+    if not subpixel:
+        shift_pixels(dm_center_x, 1)
+        shift_pixels(dm_center_x + pattern_width, -1)
+        return canvas_img
+
+    strip_width = pattern_width << SUBPIXEL_BITS
+    # Position in the strip, not wrapped, so neighbouring pixels interpolate smoothly across strip copies
+    coordinates = [[(x - dm_img.size[0]//2) << SUBPIXEL_BITS for x in range(canvas_img.size[0])]
+                   for _ in range(canvas_img.size[1])]
+    shift_coordinates(dm_center_x, 1)
+    shift_coordinates(dm_center_x + pattern_width, -1)
+    strip_img = canvas_img.crop((dm_img.size[0]//2, 0, dm_img.size[0]//2 + pattern_width, canvas_img.size[1]))
+    cv_pixels = canvas_img.load()
+    for y, row in enumerate(coordinates):
+        for x, coordinate in enumerate(row):
+            coordinate %= strip_width
+            column = coordinate >> SUBPIXEL_BITS
+            left = strip_img.getpixel((column, y))
+            right = strip_img.getpixel(((column + 1) % pattern_width, y))
+            cv_pixels[x, y] = tuple(l + _interpolate(l, r, coordinate & SUBPIXEL_MASK) for l, r in zip(left, right))
+    return canvas_img
+
+
+def _checked_shift_map(shift_map, dm_img, depth_factor, wall, subpixel):
+    """The shift map given to an engine, if it fits the render, or the depthmap's"""
+    if shift_map is None:
+        return ShiftMap.from_depthmap(dm_img if dm_img.mode == "L" else dm_img.convert("L"), depth_factor, wall,
+                                      subpixel)
+    if not shift_map.matches(depth_factor, wall, subpixel) or shift_map.size != dm_img.size:
+        raise ValueError("Shift map doesn't fit the render: {} with depth factor {}, wall {} and subpixel {}, "
+                         "expected {}, {}, {} and {}".format(shift_map.size, shift_map.depth_factor, shift_map.wall,
+                                                            shift_map.subpixel, dm_img.size, depth_factor, wall,
+                                                            subpixel))
+    return shift_map
+
+
+def _interpolate(left, right, fraction):
+    """Offset from left towards right, fraction in fixed point. Integer operations only, the same in every engine"""
+    return ((right - left) * fraction + SUBPIXEL_HALF) >> SUBPIXEL_BITS
+
+
+def _subpixel_coordinates(shifts, canvas_size, pattern_width, depth_factor):
+    """
+    Vectorized `render_pixel` subpixel shift: strip position of every canvas pixel, not wrapped, in fixed point.
+    Chunks are one pixel narrower than in `render_numpy`, as each pixel interpolates between two sources.
+    """
+    width, height = canvas_size
+    dm_width = shifts.shape[1]
+    dm_center_x = dm_width // 2
+    strip_width = pattern_width << SUBPIXEL_BITS
+    coordinates = np.empty((height, width), dtype=np.int32)
+    coordinates[:] = (np.arange(width, dtype=np.int32) - dm_center_x) << SUBPIXEL_BITS
+    flat = coordinates.reshape(-1)
+    step = max(1, pattern_width - int(np.ceil(depth_factor)) - 1)
+    row_starts = np.arange(height, dtype=np.intp)[:, None] * width
+    # Right side, left to right: coordinates[x + pattern_width] <- coordinates[x + shift] + strip_width
+    for start in range(dm_center_x, dm_width - 1, step):
+        xs = np.arange(start, min(start + step, dm_width - 1))
+        chunk = shifts[:, xs]
+        sources = row_starts + xs + (chunk >> SUBPIXEL_BITS)
+        left = flat[sources]
+        coordinates[:, xs + pattern_width] = left + _interpolate(left, flat[sources + 1], chunk & SUBPIXEL_MASK) \
+            + strip_width
+    # Left side, right to left: coordinates[x] <- coordinates[x + pattern_width - shift] - strip_width
+    for start in range(dm_center_x + pattern_width, 0, -step):
+        xs = np.arange(start, max(start - step, 0), -1)
+        chunk = -shifts[:, xs]
+        sources = row_starts + xs + pattern_width + (chunk >> SUBPIXEL_BITS)
+        left = flat[sources]
+        coordinates[:, xs] = left + _interpolate(left, flat[sources + 1], chunk & SUBPIXEL_MASK) - strip_width
+    return coordinates
+
+
+def render_numpy(dm_img, canvas_img, pattern_width, depth_factor, wall, subpixel=False, shift_map=None):
+    """
+    Vectorized engine. Produces the same pixels as `render_pixel`.
+
+    Every canvas pixel copies a pixel at least `pattern_width - max shift` columns away from it, towards the center.
+    Columns are therefore processed in chunks of that width: all sources of a chunk are final before the chunk is
+    written, so a whole chunk of every row is shifted in a single array operation.
+
+    Parameters
+    ----------
+    dm_img : PIL.Image.Image
+        Grayscale depthmap
+    canvas_img : PIL.Image.Image
+        RGB canvas, with the first pattern strip(s) already pasted at the center
+    pattern_width : int
+        Width of the pattern strip, in pixels
+    depth_factor : float
+        Maximum shift, in pixels, for a white depthmap pixel
+    wall : bool
+        True for wall eyed mode, False for cross eyed mode
+    subpixel : bool
+        Shift by fractions of a pixel, see `render_pixel`
+    shift_map : shiftmap.ShiftMap
+        Shifts of the depthmap for these settings, i.e. cached from a previous render. Computed if not given
+
+    Returns
+    -------
+    PIL.Image.Image
+        The rendered canvas
+    """
+    shifts = _checked_shift_map(shift_map, dm_img, depth_factor, wall, subpixel).shifts
+    canvas = np.array(canvas_img.convert("RGB"), dtype=np.uint8)
+    dm_width = shifts.shape[1]
+    dm_center_x = dm_width // 2
+    rows = np.arange(shifts.shape[0])[:, None]
+    if subpixel:
+        coordinates = _subpixel_coordinates(shifts, canvas_img.size, pattern_width, depth_factor)
+        coordinates %= pattern_width << SUBPIXEL_BITS
+        strip = canvas[:, dm_center_x:dm_center_x + pattern_width].copy()
+        # In blocks of rows, so the wide temporary arrays stay small
+        for top in range(0, canvas.shape[0], SUBPIXEL_BLOCK_ROWS):
+            block = coordinates[top:top + SUBPIXEL_BLOCK_ROWS]
+            block_rows = rows[top:top + SUBPIXEL_BLOCK_ROWS]
+            columns = block >> SUBPIXEL_BITS
+            left = strip[block_rows, columns].astype(np.int32)
+            right = strip[block_rows, (columns + 1) % pattern_width]
+            fractions = (block & SUBPIXEL_MASK)[:, :, None]
+            canvas[top:top + SUBPIXEL_BLOCK_ROWS] = left + _interpolate(left, right, fractions)
+        return im.fromarray(canvas, "RGB")
+    step = max(1, pattern_width - int(depth_factor))
+    # Right side, left to right: canvas[x + pattern_width] <- canvas[x + shift]
+    for start in range(dm_center_x, dm_width - 1, step):
+        xs = np.arange(start, min(start + step, dm_width - 1))
+        canvas[:, xs + pattern_width] = canvas[rows, xs + shifts[:, xs]]
+    # Left side, right to left: canvas[x] <- canvas[x + pattern_width - shift]
+    for start in range(dm_center_x + pattern_width, 0, -step):
+        xs = np.arange(start, max(start - step, 0), -1)
+        canvas[:, xs] = canvas[rows, xs + pattern_width - shifts[:, xs]]
+    return im.fromarray(canvas, "RGB")
+
+
+def _hsr_visible(z, eye_separation, mu):
+    """
+    Hidden surface test of every pixel: whether both eyes see it, i.e. the lines from it to each eye don't go through
+    a nearer part of the surface. Those lines rise `2 * (2 - mu * z) / (mu * eye_separation)` depth units per column.
+    """
+    width = z.shape[1]
+    max_t = int(np.ceil(mu * eye_separation / 4.0)) + 1
+    padded = np.pad(z, ((0, 0), (max_t, max_t)))
+    slope = 2 * (2 - mu * z) / np.float32(mu * eye_separation)
+    visible = np.ones(z.shape, dtype=bool)
+    checking = np.ones(z.shape, dtype=bool)
+    for t in range(1, max_t + 1):
+        zt = z + slope * t
+        clear = (padded[:, max_t - t:max_t - t + width] < zt) & (padded[:, max_t + t:max_t + t + width] < zt)
+        visible &= clear | ~checking
+        # The lines reach the eyes' plane once zt is 1
+        checking &= visible & (zt < 1)
+        if not checking.any():
+            break
+    return visible
+
+
+def render_hsr(dm_img, canvas_img, pattern_width, depth_factor, wall, subpixel=False, shift_map=None):
+    """
+    Hidden surface removal engine, after Thimbleby, Inglis and Witten, "Displaying 3D images: algorithms for
+    single-image random-dot stereograms" (1994).
+
+    Instead of copying pixels from an offset, every surface point visible by both eyes links the two canvas pixels
+    that show it: they must have the same color. Links of a row are kept as chains pointing to the right, like a
+    union-find, and each chain takes its color from the pattern strip at its rightmost pixel. Points hidden from one
+    eye link nothing, which removes the echoes the other engines leave next to sharp depth edges.
+
+    The eye separation is twice the pattern width and the depth of field matches `depth_factor`, so separations span
+    the same range as in the other engines. Rows are independent, so every row is processed at once, column by column.
+
+    Parameters
+    ----------
+    dm_img : PIL.Image.Image
+        Grayscale depthmap
+    canvas_img : PIL.Image.Image
+        RGB canvas, with the first pattern strip(s) already pasted at the center. Only the strip is used
+    pattern_width : int
+        Width of the pattern strip, in pixels
+    depth_factor : float
+        Maximum shift, in pixels, for a white depthmap pixel
+    wall : bool
+        True for wall eyed mode, False for cross eyed mode, where separations grow with depth instead of shrinking
+    subpixel : bool
+        Ignored: links join whole pixels. Oversample the canvas for smoother pattern images
+    shift_map : shiftmap.ShiftMap
+        Ignored: separations come from the depths, not from shifts
+
+    Returns
+    -------
+    PIL.Image.Image
+        The rendered canvas
+    """
+    dm = np.asarray(dm_img.convert("L"), dtype=np.uint8)
+    canvas = np.array(canvas_img.convert("RGB"), dtype=np.uint8)
+    height, width = canvas.shape[:2]
+    dm_center_x = dm.shape[1] // 2
+    pattern_strip = canvas[:, dm_center_x:dm_center_x + pattern_width].copy()
+    # Depth of every canvas column: the depthmap at the middle, the far plane around it
+    z = np.zeros((height, width), dtype=np.float32)
+    offset = (width - dm.shape[1]) // 2
+    z[:, offset:offset + dm.shape[1]] = dm / np.float32(255)
+    # Separation is pattern_width on the far plane and pattern_width - depth_factor on the nearest one
+    eye_separation = 2 * pattern_width
+    depth_ratio = depth_factor / float(pattern_width)
+    mu = 2 * depth_ratio / (1 + depth_ratio)
+    separations = np.rint((1 - mu * z) * eye_separation / (2 - mu * z)).astype(np.int32)
+    if not wall:
+        separations = 2 * pattern_width - separations
+    lefts = np.arange(width, dtype=np.int32) - separations // 2
+    rights = lefts + separations
+    linked = (lefts >= 0) & (rights < width) & _hsr_visible(z, eye_separation, mu)
+
+    # same[y, x] is a pixel to the right with the same color, or x itself if x is the end of its chain
+    same = np.tile(np.arange(width, dtype=np.int32), (height, 1))
+    for x in range(width):
+        rows = np.flatnonzero(linked[:, x])
+        left = lefts[rows, x]
+        right = rights[rows, x]
+        # Walk down the chain of left until right fits in it, keeping chains sorted
+        while rows.size:
+            k = same[rows, left]
+            done = (k == left) | (k == right)
+            same[rows[done], left[done]] = right[done]
+            pending = ~done
+            rows, left, right, k = rows[pending], left[pending], right[pending], k[pending]
+            before = k < right
+            # k is past right: insert right between left and k
+            same[rows[~before], left[~before]] = right[~before]
+            left, right = np.where(before, k, right), np.where(before, right, k)
+
+    # Right to left, so every pixel copies an already colored one
+    all_rows = np.arange(height)
+    for x in range(width - 1, -1, -1):
+        chain_ends = (same[:, x] == x)[:, None]
+        canvas[:, x] = np.where(chain_ends, pattern_strip[:, (x - dm_center_x) % pattern_width],
+                                canvas[all_rows, same[:, x]])
+    return im.fromarray(canvas, "RGB")
+
+
+def process_pool(workers):
+    """
+    Pool of processes for `render_parallel`, to share between many renders. Shut it down when done
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes
+
+    Returns
+    -------
+    concurrent.futures.ProcessPoolExecutor
+    """
+    # Imported here: it brings in multiprocessing, that most runs don't need
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def render_parallel(engine, dm_img, canvas_img, pattern_width, depth_factor, wall, workers, subpixel=False,
+                    shift_map=None, pool=None):
+    """
+    Renders horizontal bands of the canvas in a process pool, then stitches them back together.
+
+    Rows are independent from each other, so the result is the same as rendering the whole canvas at once.
+
+    Parameters
+    ----------
+    engine : str
+        Name of the engine that renders each band. One of `ENGINES`
+    dm_img : PIL.Image.Image
+        Grayscale depthmap
+    canvas_img : PIL.Image.Image
+        RGB canvas, with the first pattern strip(s) already pasted at the center. Modified in place
+    pattern_width : int
+        Width of the pattern strip, in pixels
+    depth_factor : float
+        Maximum shift, in pixels, for a white depthmap pixel
+    wall : bool
+        True for wall eyed mode, False for cross eyed mode
+    workers : int
+        Number of worker processes. Also the number of bands
+    subpixel : bool
+        Shift by fractions of a pixel, see `render_pixel`
+    shift_map : shiftmap.ShiftMap
+        Shifts of the depthmap for these settings. Each band gets its rows. Computed by each band if not given
+    pool : concurrent.futures.ProcessPoolExecutor
+        Pool to render in, from `process_pool`, i.e. shared by the bands of `main.render_bands`. If None, one is
+        started and shut down for this render
+
+    Returns
+    -------
+    PIL.Image.Image
+        The rendered canvas
+    """
+    if pool is None:
+        with process_pool(workers) as pool:
+            return render_parallel(engine, dm_img, canvas_img, pattern_width, depth_factor, wall, workers, subpixel,
+                                   shift_map, pool)
+    height = dm_img.size[1]
+    band_height = -(-height // workers)
+    band_tops = range(0, height, band_height)
+    futures = [pool.submit(ENGINES[engine],
+                           dm_img.crop((0, y, dm_img.size[0], min(y + band_height, height))),
+                           canvas_img.crop((0, y, canvas_img.size[0], min(y + band_height, height))),
+                           pattern_width, depth_factor, wall, subpixel,
+                           None if shift_map is None else shift_map.rows(y, min(y + band_height, height)))
+               for y in band_tops]
+    for y, future in zip(band_tops, futures):
+        canvas_img.paste(future.result(), (0, y))
+    return canvas_img
+
+
+ENGINES = {
+    "pixel": render_pixel,
+    "numpy": render_numpy,
+    "hsr": render_hsr,
+}
+# Engines that shift by a shift map. Others ignore it, so don't make one for them
+SHIFT_MAP_ENGINES = {"pixel", "numpy"}
+DEFAULT_ENGINE = "numpy"
@@ -0,0 +1,582 @@
+#!/usr/bin/python
+"""
+Job queue for long renders. Jobs are accepted at once and rendered in the background, in bands of rows, reporting the
+rows done so far. They can be cancelled while waiting or rendering.
+
+An asyncio HTTP front-end takes the requests, a process pool renders and a SQLite database keeps the jobs, so any
+process can read their state. At most `workers` jobs render at once and at most `max_pending` wait: further jobs are
+refused, so bursts don't overload the machine. Each job renders in a single process, within a time limit. If a render
+process dies, i.e. out of memory, its jobs fail and the pool is started again. Jobs waiting or rendering when the queue
+stops are queued again when it starts.
+
+Every answer is a JSON object with "code" and "text", like the CLI, except the result image:
+    POST /jobs             Body: `main.RenderOptions` fields, and an optional "format" (png or tiff). Answers 202 with
+                           the job, or 503 if too many jobs are waiting. An optional "replaces" with the id of a job
+                           cancels that one, i.e. a render with stale settings. Depthmap and pattern files over the
+                           pixel budget are refused with 413, reading only their header. Files in the upload
+                           directory belong to the job: they are removed once it ends
+    GET /jobs/<id>         The job: "id", "status", "progress" (0 to 1), "result" (file name in the output directory),
+                           "error", and "created", "started" and "finished" timestamps
+    DELETE /jobs/<id>      Cancels the job
+    GET /jobs/<id>/result  The image, once the job is done
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from assets import ImageTooLarge
+from log import Log as log
+from main import BAND_HEIGHT, SAVEFOLDER, RenderOptions, check_input_files, render_bands, _HTTPCode
+from output import BAND_WRITERS, FORMATS
+from timing import TimeLimitExceeded, time_limit
+
+DEFAULT_PORT = 8643
+DEFAULT_STORE = "jobs.sqlite3"
+MAX_PENDING = 64  # Jobs waiting to render
+# Decoded per depthmap or pattern file. Jobs render depthmaps at full size, and hold them whole, a byte per pixel
+MAX_PIXELS = 150 * 1000 * 1000
+MAX_REQUEST_BYTES = 64 * 1024  # Of a request body. Jobs are a few options
+TIME_LIMIT = 3600.0  # Seconds per job
+SQLITE_TIMEOUT = 10.0  # Seconds to wait for another process writing to the store
+RESULT_CHUNK_SIZE = 1 << 20  # Bytes of a result image sent at once
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    """Stops the render of a cancelled job"""
+
+
+class QueueFull(Exception):
+    """Too many jobs waiting"""
+
+
+class JobStore(object):
+    """
+    Jobs kept in a SQLite database. Each process opens its own store on the same file: the queue to add and update
+    jobs, workers to write their progress.
+
+    Queries are small and local, so the asyncio front-end runs them without an executor.
+    """
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            Database file. Created if it doesn't exist
+        """
+        self.path = path
+        # Autocommit: every statement is a transaction
+        self._connection = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        # Reading jobs doesn't wait for workers writing their progress
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                options TEXT NOT NULL,
+                file_format TEXT NOT NULL,
+                progress REAL NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL
+            )""")
+
+    def add(self, options_dict, file_format):
+        """
+        Parameters
+        ----------
+        options_dict : dict
+            `main.RenderOptions` fields
+        file_format : str
+            One of `output.BAND_WRITERS`
+
+        Returns
+        -------
+        dict
+            The new job, queued
+        """
+        job_id = uuid.uuid4().hex
+        self._connection.execute("INSERT INTO jobs (id, status, options, file_format, created) VALUES (?, ?, ?, ?, ?)",
+                                 (job_id, QUEUED, json.dumps(options_dict), file_format, time.time()))
+        return self.get(job_id)
+
+    def get(self, job_id):
+        """
+        Returns
+        -------
+        dict
+            The job, with its options decoded. None if there is no such job
+        """
+        row = self._connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["options"] = json.loads(job["options"])
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+    def ids(self, status):
+        """Ids of the jobs in a status, oldest first"""
+        return [row[0] for row in self._connection.execute("SELECT id FROM jobs WHERE status = ? ORDER BY created",
+                                                           (status,))]
+
+    def count(self, status):
+        return self._connection.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def update(self, job_id, **fields):
+        """Sets columns of a job"""
+        assignments = ", ".join("{} = ?".format(column) for column in fields)
+        self._connection.execute("UPDATE jobs SET {} WHERE id = ?".format(assignments),
+                                 list(fields.values()) + [job_id])
+
+    def start(self, job_id):
+        """
+        Marks a queued job as running
+
+        Returns
+        -------
+        bool
+            False if the job isn't queued anymore, i.e. it was cancelled
+        """
+        cursor = self._connection.execute("UPDATE jobs SET status = ?, started = ? WHERE id = ? AND status = ?",
+                                          (RUNNING, time.time(), job_id, QUEUED))
+        return cursor.rowcount == 1
+
+    def set_progress(self, job_id, progress):
+        """
+        Returns
+        -------
+        bool
+            Whether the job was asked to be cancelled
+        """
+        self._connection.execute("UPDATE jobs SET progress = ? WHERE id = ?", (progress, job_id))
+        return bool(self._connection.execute("SELECT cancel_requested FROM jobs WHERE id = ?",
+                                             (job_id,)).fetchone()[0])
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued job at once. A running job is asked to stop, and does after its current band
+
+        Returns
+        -------
+        dict
+            The job. None if there is no such job
+        """
+        self._connection.execute("UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?",
+                                 (CANCELLED, time.time(), job_id, QUEUED))
+        self._connection.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?",
+                                 (job_id, RUNNING))
+        return self.get(job_id)
+
+    def close(self):
+        self._connection.close()
+
+
+def _public_job(job):
+    """What clients see of a job"""
+    return {field: job[field] for field in ["id", "status", "progress", "result", "error", "created", "started",
+                                            "finished"]}
+
+
+def _partial_path(output_dir, job_id, file_format):
+    return os.path.join(output_dir, "{}.{}.part".format(job_id, file_format))
+
+
+def _run_job(store_path, job_id, output_dir, band_height, seconds):
+    """
+    Worker process entry point. Renders a job into the output directory, writing its progress to the store.
+
+    The image is written under a temporary name, and renamed once complete. Raises TimeLimitExceeded after `seconds`.
+
+    Returns
+    -------
+    str
+        File name of the result, in the output directory
+    """
+    store = JobStore(store_path)
+    try:
+        job = store.get(job_id)
+        result = "{}.{}".format(job_id, job["file_format"])
+        partial_path = _partial_path(output_dir, job_id, job["file_format"])
+
+        def report(rows_done, rows_total):
+            if store.set_progress(job_id, rows_done / float(rows_total)):
+                raise JobCancelled()
+
+        try:
+            # Tasks run in the main thread of the worker, where time limits apply
+            with open(partial_path, "wb") as f, time_limit(seconds):
+                render_bands(RenderOptions.from_dict(job["options"]), f, job["file_format"], band_height,
+                             progress=report)
+        except BaseException:
+            os.remove(partial_path)
+            raise
+        os.rename(partial_path, os.path.join(output_dir, result))
+        return result
+    finally:
+        store.close()
+
+
+class JobQueue(object):
+    """
+    Renders the jobs of a store in a process pool, at most one per worker at once. Must be started and used from a
+    running asyncio event loop
+    """
+    def __init__(self, store, output_dir, workers=None, max_pending=MAX_PENDING, band_height=BAND_HEIGHT,
+                 max_pixels=MAX_PIXELS, seconds=TIME_LIMIT, upload_dir=None):
+        """
+        Parameters
+        ----------
+        store : JobStore
+            Where jobs are kept
+        output_dir : str
+            Directory where to save the results
+        workers : int
+            Number of render processes, and of jobs rendering at once. Defaults to the number of CPUs
+        max_pending : int
+            Jobs that can be waiting to render. Submitting more raises QueueFull
+        band_height : int
+            Rows rendered between progress reports
+        max_pixels : int
+            Most pixels a depthmap or pattern file of a job may take to decode, and a band of its canvas to render.
+            Jobs can only lower it
+        seconds : float
+            Time limit of each job. None for no limit
+        upload_dir : str
+            Directory of uploaded inputs, i.e. by the web GUI. Depthmaps and patterns in it are only read by their job,
+            which removes them once it ends. None if there is none
+        """
+        self.store = store
+        self.output_dir = output_dir
+        self.workers = workers or os.cpu_count()
+        self.max_pending = max_pending
+        self.band_height = band_height
+        self.max_pixels = max_pixels
+        self.time_limit = seconds
+        self.upload_dir = upload_dir
+        self._pool = None
+        self._queue = None
+        self._runners = []
+        self._renders = set()
+
+    async def start(self):
+        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        self._queue = asyncio.Queue()
+        # Left by a previous queue. Their workers are gone, so they start over
+        for job_id in self.store.ids(RUNNING):
+            self.store.update(job_id, status=QUEUED, progress=0, started=None)
+        for job_id in self.store.ids(QUEUED):
+            self._queue.put_nowait(job_id)
+        self._runners = [asyncio.ensure_future(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stops taking jobs from the queue and waits for the running ones to finish"""
+        for runner in self._runners:
+            runner.cancel()
+        await asyncio.gather(*self._runners, return_exceptions=True)
+        await asyncio.gather(*self._renders, return_exceptions=True)
+        self._pool.shutdown()
+
+    def submit(self, options_dict, file_format="png", replaces=None):
+        """
+        Queues a job
+
+        Parameters
+        ----------
+        options_dict : dict
+            `main.RenderOptions` fields
+        file_format : str
+            One of `output.BAND_WRITERS`
+        replaces : str
+            Id of a job to cancel, whose result won't be needed. Cancelled even if the queue is full
+
+        Returns
+        -------
+        dict
+            The job
+        """
+        # Fail now, not in a worker
+        options = RenderOptions.from_dict(options_dict)
+        if options.max_pixels is None or options.max_pixels > self.max_pixels:
+            options_dict = dict(options_dict, max_pixels=self.max_pixels)
+            options.max_pixels = self.max_pixels
+        # Jobs already render in parallel. A pool of their own inside a worker would multiply the processes
+        options_dict = dict(options_dict, workers=1)
+        # Depthmaps are rendered at full size
+        check_input_files(options, None, self.band_height)
+        if file_format not in BAND_WRITERS:
+            raise ValueError("Jobs can't write '{}'. Valid options are: {}".format(file_format, sorted(BAND_WRITERS)))
+        if replaces is not None and self.cancel(replaces) is not None:
+            log.d("Job {} replaced".format(replaces))
+        if self.store.count(QUEUED) >= self.max_pending:
+            raise QueueFull("{} jobs are already waiting".format(self.max_pending))
+        job = self.store.add(options_dict, file_format)
+        self._queue.put_nowait(job["id"])
+        log.d("Job {} queued".format(job["id"]))
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancels a job, see `JobStore.cancel`. The uploads of a queued one are removed at once
+
+        Returns
+        -------
+        dict
+            The job. None if there is no such job
+        """
+        job = self.store.cancel(job_id)
+        if job is not None and job["status"] == CANCELLED and job["started"] is None:
+            self._remove_uploads(job)
+        return job
+
+    def _remove_uploads(self, job):
+        if self.upload_dir is None:
+            return
+        upload_dir = os.path.realpath(self.upload_dir)
+        for path in [job["options"].get("depthmap"), job["options"].get("pattern")]:
+            if path is not None and os.path.dirname(os.path.realpath(path)) == upload_dir:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Already gone
+                    pass
+
+    async def _run(self):
+        while True:
+            job_id = await self._queue.get()
+            if not self.store.start(job_id):
+                # Cancelled while queued
+                continue
+            render = asyncio.ensure_future(self._render(job_id))
+            self._renders.add(render)
+            render.add_done_callback(self._renders.discard)
+            # Stopping the queue doesn't abandon the render: stop() waits for it
+            await asyncio.shield(render)
+
+    async def _render(self, job_id):
+        log.i("Job {} started".format(job_id))
+        pool = self._pool
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(pool, _run_job, self.store.path, job_id,
+                                                                      self.output_dir, self.band_height,
+                                                                      self.time_limit)
+        except JobCancelled:
+            log.i("Job {} cancelled".format(job_id))
+            self.store.update(job_id, status=CANCELLED, finished=time.time())
+        except TimeLimitExceeded as e:
+            log.w("Job {} gave up: {}".format(job_id, e))
+            self.store.update(job_id, status=FAILED, error="Gave up: {}".format(e), finished=time.time())
+        except BrokenProcessPool as e:
+            log.e("Job {} failed, its process died: {}".format(job_id, e))
+            self.store.update(job_id, status=FAILED, error="Its render process died", finished=time.time())
+            # Left behind by the dead process
+            partial_path = _partial_path(self.output_dir, job_id, self.store.get(job_id)["file_format"])
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            # Every job it was rendering fails, and only the first one restarts it
+            if self._pool is pool:
+                log.w("Restarting the render processes")
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                pool.shutdown(wait=False)
+        except Exception as e:
+            log.e("Job {} failed: {}".format(job_id, e))
+            self.store.update(job_id, status=FAILED, error=str(e), finished=time.time())
+        else:
+            log.i("Job {} done: {}".format(job_id, result))
+            self.store.update(job_id, status=DONE, progress=1.0, result=result, finished=time.time())
+        self._remove_uploads(self.store.get(job_id))
+
+
+async def _read_request(reader):
+    """Parses an HTTP request. Returns its method, path and body"""
+    method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1")
+        if line in ("\r\n", "\n", ""):
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_REQUEST_BYTES:
+        raise ValueError("body of {} bytes, over the limit of {}".format(length, MAX_REQUEST_BYTES))
+    body = await reader.readexactly(length)
+    return method, path, body
+
+
+def _write_head(writer, code, content_type, length):
+    writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+        code, "OK" if code < 400 else "Error", content_type, length).encode("latin-1"))
+
+
+async def _send_json(writer, code, text):
+    body = json.dumps({"code": code, "text": text}).encode("utf-8")
+    _write_head(writer, code, "application/json", len(body))
+    writer.write(body)
+    await writer.drain()
+
+
+async def _send_file(writer, path, content_type):
+    """Sends a file in chunks, so big images are never whole in memory"""
+    _write_head(writer, _HTTPCode.OK, content_type, os.path.getsize(path))
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(RESULT_CHUNK_SIZE), b""):
+            writer.write(chunk)
+            await writer.drain()
+
+
+async def _handle_request(queue, method, path, body, writer):
+    parts = path.split("?")[0].strip("/").split("/")
+    if parts == ["jobs"] and method == "POST":
+        try:
+            fields = json.loads(body.decode("utf-8"))
+            if not isinstance(fields, dict):
+                raise ValueError("expected a JSON object")
+            file_format = fields.pop("format", "png")
+            replaces = fields.pop("replaces", None)
+            job = queue.submit(fields, file_format, replaces)
+        except ImageTooLarge as e:
+            await _send_json(writer, _HTTPCode.PAYLOAD_TOO_LARGE, "Image too large: {}".format(e))
+            return
+        except (ValueError, TypeError) as e:
+            await _send_json(writer, _HTTPCode.BAD_REQUEST, "Invalid job: {}".format(e))
+            return
+        except QueueFull as e:
+            await _send_json(writer, _HTTPCode.SERVICE_UNAVAILABLE, "Try again later: {}".format(e))
+            return
+        await _send_json(writer, _HTTPCode.ACCEPTED, _public_job(job))
+        return
+    if len(parts) not in (2, 3) or parts[0] != "jobs":
+        await _send_json(writer, _HTTPCode.NOT_FOUND, "Unknown path '{}'".format(path))
+        return
+    job = queue.cancel(parts[1]) if method == "DELETE" and len(parts) == 2 else queue.store.get(parts[1])
+    if job is None:
+        await _send_json(writer, _HTTPCode.NOT_FOUND, "No job '{}'".format(parts[1]))
+    elif len(parts) == 2:
+        await _send_json(writer, _HTTPCode.OK, _public_job(job))
+    elif parts[2] != "result":
+        await _send_json(writer, _HTTPCode.NOT_FOUND, "Unknown path '{}'".format(path))
+    elif job["status"] != DONE:
+        await _send_json(writer, _HTTPCode.CONFLICT, "Job is {}".format(job["status"]))
+    else:
+        await _send_file(writer, os.path.join(queue.output_dir, job["result"]), FORMATS[job["file_format"]][1])
+
+
+async def _serve(queue, host, port, socket_path):
+    async def handle_connection(reader, writer):
+        try:
+            method, path, body = await _read_request(reader)
+            log.d("{} {}".format(method, path))
+            await _handle_request(queue, method, path, body, writer)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            await _send_json(writer, _HTTPCode.BAD_REQUEST, "Malformed request: {}".format(e))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    await queue.start()
+    if socket_path is not None:
+        server = await asyncio.start_unix_server(handle_connection, socket_path)
+        address = socket_path
+    else:
+        server = await asyncio.start_server(handle_connection, host, port)
+        address = "{}:{}".format(host, port)
+    log.i("Job queue listening on {} with {} workers".format(address, queue.workers))
+    try:
+        await server.serve_forever()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await queue.stop()
+
+
+def serve(host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, store_path=DEFAULT_STORE, output_dir=SAVEFOLDER,
+          workers=None, max_pending=MAX_PENDING, band_height=BAND_HEIGHT, max_pixels=MAX_PIXELS, seconds=TIME_LIMIT,
+          upload_dir=None):
+    """
+    Runs the job queue until interrupted
+
+    Parameters
+    ----------
+    host : str
+        Address to listen on. Ignored if `socket_path` is set
+    port : int
+        TCP port to listen on. Ignored if `socket_path` is set
+    socket_path : str
+        Path of a Unix socket to listen on, instead of TCP
+    store_path : str
+        SQLite database of the jobs
+    output_dir : str
+        Directory where to save the results
+    workers : int
+        Number of render processes, and of jobs rendering at once. Defaults to the number of CPUs
+    max_pending : int
+        Jobs that can be waiting to render
+    band_height : int
+        Rows rendered between progress reports
+    max_pixels : int
+        Most pixels a depthmap or pattern file of a job may take to decode
+    seconds : float
+        Time limit of each job. None for no limit
+    upload_dir : str
+        Directory of uploaded inputs, removed once their job ends. None if there is none
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if socket_path is not None and os.path.exists(socket_path):
+        os.remove(socket_path)
+    store = JobStore(store_path)
+    queue = JobQueue(store, output_dir, workers, max_pending, band_height, max_pixels, seconds, upload_dir)
+    try:
+        asyncio.run(_serve(queue, host, port, socket_path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def obtain_args():
+    arg_parser = argparse.ArgumentParser(description="Stereogramaxo job queue for long renders")
+    arg_parser.add_argument("--host", help="Address to listen on", default="127.0.0.1")
+    arg_parser.add_argument("--port", help="TCP port to listen on", type=int, default=DEFAULT_PORT)
+    arg_parser.add_argument("--socket", help="Listen on this Unix socket instead of TCP")
+    arg_parser.add_argument("--store", help="SQLite database of the jobs", default=DEFAULT_STORE)
+    arg_parser.add_argument("--output", "-o", help="Directory where to store the results", default=SAVEFOLDER)
+    arg_parser.add_argument("--workers", help="Number of jobs rendering at once. Defaults to the number of CPUs",
+                            type=int)
+    arg_parser.add_argument("--max-pending", help="Jobs that can be waiting. More are refused", type=int,
+                            default=MAX_PENDING)
+    arg_parser.add_argument("--band-height", help="Rows rendered between progress reports", type=int,
+                            default=BAND_HEIGHT)
+    arg_parser.add_argument("--max-pixels", help="Refuse depthmap and pattern files that would take more pixels than "
+                                                 "this to decode, reading only their header",
+                            type=int, default=MAX_PIXELS)
+    arg_parser.add_argument("--time-limit", help="Seconds a job may take. 0 for no limit", type=float,
+                            default=TIME_LIMIT)
+    arg_parser.add_argument("--upload-dir", help="Directory of uploaded depthmaps and patterns, i.e. by the web GUI. "
+                                                 "They are removed once their job ends")
+    return arg_parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = obtain_args()
+    serve(args.host, args.port, args.socket, args.store, args.output, args.workers, args.max_pending,
+          args.band_height, args.max_pixels, args.time_limit or None, args.upload_dir)
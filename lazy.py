@@ -0,0 +1,48 @@
+"""Lazy imports, so starting up doesn't pay for modules a run never uses."""
+
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """
+    Imports a module that is only loaded when one of its attributes is first used
+
+    Parameters
+    ----------
+    name : str
+        Absolute module name, i.e. "PIL.ImageFont"
+
+    Returns
+    -------
+    module
+        The module. Already imported modules are returned as they are
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    # As a regular import does, so "import PIL.Image" followed by "PIL.Image" works
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def load_now(module):
+    """
+    Loads a module from `lazy_import` at once. Threads must use lazy modules only once loaded: before Python 3.12,
+    several threads loading one at the same time can see it half loaded.
+
+    Returns
+    -------
+    module
+        The module
+    """
+    # Any attribute loads it
+    module.__dict__
+    return module
@@ -1,8 +1,9 @@
 """Logging tool."""
 
+import atexit
 import logging
+import os
 import sys
-from logging.handlers import RotatingFileHandler
 
 
 class _ColoredFormatter(logging.Formatter):
@@ -53,37 +54,150 @@ class _ColoredFormatter(logging.Formatter):
         return logging.Formatter.format(self, record)
 
 
+# SETTINGS. Environment variables override the defaults
+DEFAULT_LEVEL = os.environ.get("STEREOGRAMAXO_LOG_LEVEL", "DEBUG")
+# Under the user's state directory, never the working directory. Empty for no log file
+DEFAULT_PATH = os.environ.get("STEREOGRAMAXO_LOG_FILE", os.path.join(
+    os.environ.get("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state"),
+    "stereogramaxo", "sirds.log"))
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 2
+LOG_FORMAT = '[%(asctime)s] %(levelname)s %(message)s'
+
 logger = logging.getLogger('stereogramaxo')
-logger.setLevel('DEBUG')
-# handlers
-file_formatter = _ColoredFormatter('[%(asctime)s] %(levelname)s %(message)s', color_all=True)
-console_formatter = _ColoredFormatter('[%(asctime)s] %(levelname)s %(message)s', color_all=True, datefmt='%H:%M:%S')
-rotating_file_handler = RotatingFileHandler('sirds.log', maxBytes=2048, backupCount=2)
-console_handler = logging.StreamHandler(sys.stdout)
-rotating_file_handler.setFormatter(file_formatter)
-console_handler.setFormatter(console_formatter)
-logger.addHandler(rotating_file_handler)
-logger.addHandler(console_handler)
+_handlers = []
+_queue_listener = None
+_configured = False
+_forked = False
+
+
+def _stop_listener():
+    """Writes the queued records and stops the writer thread"""
+    global _queue_listener
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        _queue_listener = None
+
+
+def configure(level=None, path=None, console=True, color=None, max_bytes=DEFAULT_MAX_BYTES,
+              backup_count=DEFAULT_BACKUP_COUNT):
+    """
+    Sets where and what to log. Replaces any previous configuration. Done with the defaults on the first record if
+    nobody called it, so runs that never log don't pay for it.
+
+    Callers only put records in a queue: a background thread formats and writes them, so logging never waits for the
+    console or the disk.
+
+    Parameters
+    ----------
+    level : str
+        Minimum level to log, i.e. "INFO". Defaults to DEFAULT_LEVEL
+    path : str
+        Log file, rotated when it reaches `max_bytes`. Defaults to DEFAULT_PATH. Empty for no log file. Its directory is
+        created if needed, and the file when the first record is written
+    console : bool
+        Whether to also log to stdout
+    color : bool
+        Whether to color console output. Defaults to coloring only if stdout is a terminal. Files are never colored
+    max_bytes : int
+        Size of the log file before rotating it
+    backup_count : int
+        Number of rotated log files to keep
+    """
+    # Imported here, they are slow to import
+    import queue
+    from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+    global _handlers, _queue_listener, _configured
+    _configured = True
+    _stop_listener()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    for handler in _handlers:
+        handler.close()
+    logger.setLevel(level or DEFAULT_LEVEL)
+    path = DEFAULT_PATH if path is None else path
+    _handlers = []
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(_ColoredFormatter(LOG_FORMAT, use_color=sys.stdout.isatty() if color is None
+                                                       else color, color_all=True, datefmt='%H:%M:%S'))
+        _handlers.append(console_handler)
+    if path:
+        if os.path.dirname(path):
+            # Failing here would fail the caller's first record. Opening the file reports it instead
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            except OSError:
+                pass
+        file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        _handlers.append(file_handler)
+    if _forked:
+        for handler in _handlers:
+            logger.addHandler(handler)
+    elif _handlers:
+        log_queue = queue.Queue()
+        logger.addHandler(QueueHandler(log_queue))
+        _queue_listener = QueueListener(log_queue, *_handlers)
+        _queue_listener.start()
+
+
+def flush():
+    """Waits until every queued record is written"""
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        _queue_listener.start()
+
+
+def _write_directly():
+    """A forked process has no writer thread: it writes its records itself"""
+    global _queue_listener, _forked
+    _forked = True
+    _queue_listener = None
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    for handler in _handlers:
+        logger.addHandler(handler)
+
+
+def _configured_logger():
+    if not _configured:
+        configure()
+    return logger
+
+
+atexit.register(_stop_listener)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_write_directly)
 
 
 class Log:
+    configure = staticmethod(configure)
+    flush = staticmethod(flush)
+
+    @staticmethod
+    def debug_enabled():
+        """Whether debug records are logged. Check it before building expensive debug messages"""
+        return _configured_logger().isEnabledFor(logging.DEBUG)
+
     @staticmethod
     def d(s):
-        logger.debug(s)
+        _configured_logger().debug(s)
 
     @staticmethod
     def i(s):
-        logger.info(s)
+        _configured_logger().info(s)
 
     @staticmethod
     def w(s):
-        logger.warning(s)
+        _configured_logger().warning(s)
 
     @staticmethod
     def e(s):
-        logger.error(s)
+        _configured_logger().error(s)
 
     @staticmethod
     def c(s):
-        logger.critical(s)
+        _configured_logger().critical(s)
 
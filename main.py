@@ -2,20 +2,37 @@
 """Main project file, contains everything to generate stereograms."""
 
 import argparse
+import cProfile
+import hashlib
+import itertools
 import json
 import os
 import re
+import sys
 import codecs
+import contextlib
+import functools
 import time
 from random import choice, random
 
-# This "PIL" refers to Pillow, the PIL fork. Check https://pillow.readthedocs.io/en/
-from PIL import Image as im
-from PIL import ImageDraw as imd
-from PIL import ImageFilter as imflt
-from PIL import ImageFont as imf
-
+from assets import (DMFOLDER, MAX_DIMENSION, MAX_IMAGE_PIXELS, PATTERNFOLDER, ImageTooLarge, decode_image, open_image,
+                    presets)
+from cache import ResultCache, depthmap_cache, image_nbytes, pattern_cache, shift_map_cache
+from engines import DEFAULT_ENGINE, ENGINES, SHIFT_MAP_ENGINES, process_pool, render_parallel
+from lazy import lazy_import
 from log import Log as log
+from output import BAND_WRITERS, FORMATS, PNG_COMPRESS_LEVEL, QUALITY, encode_image, encoder_params
+from shiftmap import ShiftMap
+from timing import NULL_TIMER, StageTimer, TimeLimitExceeded, time_limit
+
+# Heavy modules load on first use, so --help, argument errors and cache hits start fast
+np = lazy_import("numpy")
+# This "PIL" refers to Pillow, the PIL fork. Check https://pillow.readthedocs.io/en/
+im = lazy_import("PIL.Image")
+# Only for text depthmaps
+imd = lazy_import("PIL.ImageDraw")
+imflt = lazy_import("PIL.ImageFilter")
+imf = lazy_import("PIL.ImageFont")
 
 # Program info
 PROGRAM_VERSION = "2.0"
@@ -25,17 +42,23 @@ DEFAULT_DEPTHTEXT_FONT = "freefont/FreeSansBold"
 FONT_ROOT = "/usr/share/fonts/truetype"
 DEFAULT_OUTPUT_EXTENSION = SUPPORTED_IMAGE_EXTENSIONS[0]
 # CONSTANTS
-DMFOLDER = "depth_maps"
-PATTERNFOLDER = "patterns"
 SAVEFOLDER = "saved"
 
 # SETTINGS
-MAX_DIMENSION = 1500  # px
 PATTERN_FRACTION = 8.0
-OVERSAMPLE = 1.8
+OVERSAMPLE = 1.0  # Pattern images. 1 shifts by fractions of a pixel at output size, bigger renders larger and downsizes
+MAX_OVERSAMPLE = 4.0
 SHIFT_RATIO = 0.3
 LEFT_TO_RIGHT = False  # Defines how the pixels will be shifted (left to right or center to sides)
 DOT_OVER_PATTERN_PROBABILITY = 0.3  # Defines how often dots are chosen over pattern on random pattern selection
+DEFAULT_DOT_PROB = 0.4
+DEFAULT_DOT_COLORS = [(255, 0, 0), (255, 255, 0), (200, 0, 255)]
+FONT_CACHE_SIZE = 64  # Loaded (font, size) pairs
+MAX_FONT_SIZE = 1 << 15  # Text depthmaps. FreeType refuses sizes past 65535
+BAND_HEIGHT = 256  # Rows per band when rendering in bands
+BAND_MARGIN = 8  # Rows rendered above and below each band, so resampling doesn't show seams between bands
+PREVIEW_DIMENSION = 400  # px. Previews are downsized to this
+HASH_CHUNK_SIZE = 1 << 20  # Bytes of an input file hashed at once
 
 
 def show_img(i):
@@ -63,7 +86,64 @@ def _hex_color_to_tuple(s):
     return tuple(int(c) for c in codecs.decode(s, 'hex'))  # s.decode('hex'))
 
 
-def make_background(size, filename="", dots_prob=None, bg_color="000", dot_colors_string=None):
+def _parse_dot_colors(s):
+    """
+    Parses a comma separated list of hex colors, with optional multipliers.
+
+    Parameters
+    ----------
+    s: str
+        i.e.: "fff,ff0000x3" results in 3 times more ff0000 than fff
+
+    Returns
+    -------
+    list: RGB triplets. Multiplied colors are repeated
+    """
+    hex_strings = list()
+    for hex_str in s.split(','):
+        if re.match(r'.+x\d+', hex_str):
+            # multiplier
+            factor = int(re.sub(r'.*x', '', hex_str))
+            hex_strings.extend([re.sub(r'x\d+', '', hex_str)]*factor)
+        else:
+            hex_strings.append(hex_str)
+    return [_hex_color_to_tuple(hex_str) for hex_str in hex_strings]
+
+
+def make_dot_pattern(size, dot_prob=DEFAULT_DOT_PROB, color_tuples=None, bg_color=(0, 0, 0), seed=None):
+    """
+    Generates a random dot pattern from a single random draw
+
+    Parameters
+    ----------
+    size : tuple(int, int)
+        Size of the pattern
+    dot_prob : float
+        Probability of a pixel being a dot
+    color_tuples : list
+        RGB triplets to choose the dots colors from. Repeated colors are chosen more often
+    bg_color : tuple
+        RGB triplet for the pixels that are not dots
+    seed : int
+        Seed for the random generator. Same seed, same pattern. If None, the pattern is different each time
+
+    Returns
+    -------
+    PIL.Image.Image
+        Generated pattern
+    """
+    colors = np.array(color_tuples or DEFAULT_DOT_COLORS, dtype=np.uint8)
+    draw = np.random.default_rng(seed).random((size[1], size[0]))
+    pattern = np.empty((size[1], size[0], 3), dtype=np.uint8)
+    pattern[:] = bg_color
+    dots = draw < dot_prob
+    # A dot's draw is uniform in [0, dot_prob), so it also picks the dot color
+    color_indexes = (draw[dots] / dot_prob * len(colors)).astype(np.intp)
+    pattern[dots] = colors[np.minimum(color_indexes, len(colors) - 1)]
+    return im.fromarray(pattern, "RGB")
+
+
+def make_background(size, filename="", dots_prob=None, bg_color="000", dot_colors_string=None, seed=None):
     """
     Constructs background pattern
 
@@ -77,6 +157,10 @@ def make_background(size, filename="", dots_prob=None, bg_color="000", dot_color
         Probability of dots appearing. Only makes sense if filename is not set (or equals to 'dots')
     bg_color : str
         hex code for color
+    dot_colors_string : str
+        Comma separated list of hex colors for the dots. Supports multipliers
+    seed : int
+        Seed for the random dots
     Returns
     -------
     """
@@ -84,7 +168,6 @@ def make_background(size, filename="", dots_prob=None, bg_color="000", dot_color
     pattern_width = (int)(size[0] / PATTERN_FRACTION)
     # Pattern is a little bit longer than original picture, so everything fits on 3D (eye crossing shrinks the picture horizontally!)
     i = im.new("RGB", (size[0] + pattern_width, size[1]), color=_hex_color_to_tuple(bg_color))
-    i_pix = i.load()
     if filename == "R" and random() < DOT_OVER_PATTERN_PROBABILITY:
         filename = "dots"
     # Load from picture
@@ -106,14 +189,10 @@ def make_background(size, filename="", dots_prob=None, bg_color="000", dot_color
                 y += pattern.size[1]
     # Random fill
     if filename == "" or filename == "dots":
-        for f in range(i.size[1]):
-            for c in range(pattern_width):
-                if random() < dots_prob:
-                    if dot_colors_string is None:
-                        i_pix[c, f] = choice([(255, 0, 0), (255, 255, 0), (200, 0, 255)])
-                    else:
-                        colors = [_hex_color_to_tuple(s) for s in dot_colors_string.split(",")]
-                        i_pix[c, f] = choice(colors)
+        i.paste(make_dot_pattern((pattern_width, i.size[1]),
+                                 dots_prob if dots_prob is not None else DEFAULT_DOT_PROB,
+                                 _parse_dot_colors(dot_colors_string) if dot_colors_string else None,
+                                 _hex_color_to_tuple(bg_color), seed), (0, 0))
 
     return i, is_image
 
@@ -133,6 +212,9 @@ def get_random(whatfile="depthmap"):
         Randomly chosen absolute file dir
 
     """
+    indexed = presets.paths("depthmap" if whatfile == "depthmap" else "pattern")
+    if indexed:
+        return choice(indexed)
     folder = (DMFOLDER if whatfile == "depthmap" else PATTERNFOLDER)
     return folder + "/" + choice(os.listdir(folder))
 
@@ -156,145 +238,761 @@ def redistribute_grays(img_object, gray_height):
     if img_object.mode != "L":
         img_object = img_object.convert("L")
     # Determine min and max gray value
-    min_gray = {
-        "point": (0, 0),
-    }
-    min_gray["value"] = img_object.getpixel(min_gray["point"])
-    max_gray = {
-        "point": (0, 0),
-    }
-    max_gray["value"] = img_object.getpixel(max_gray["point"])
-
-    for x in range(img_object.size[0]):
-        for y in range(img_object.size[1]):
-            this_gray = img_object.getpixel((x, y))
-            if this_gray > img_object.getpixel(max_gray["point"]):
-                max_gray["point"] = (x, y)
-                max_gray["value"] = this_gray
-            if this_gray < img_object.getpixel(min_gray["point"]):
-                min_gray["point"] = (x, y)
-                min_gray["value"] = this_gray
+    old_min, old_max = img_object.getextrema()
 
     # Transform to new scale
-    old_min = min_gray["value"]
-    old_max = max_gray["value"]
     old_interval = old_max - old_min
     new_min = 0
     new_max = int(255.0 * gray_height)
     new_interval = new_max - new_min
+    if old_interval == 0:
+        # Flat depthmap, there is no range to redistribute
+        return img_object.point(lambda gray: new_min)
 
     conv_factor = float(new_interval)/float(old_interval)
+    return img_object.point([min(255, int(gray * conv_factor) + new_min) for gray in range(256)])
+
+
+class RenderOptions(object):
+    """
+    Options for generating a stereogram. Attribute names match the command line arguments.
+
+    Attributes
+    ----------
+    depthmap : str
+        Path to a depthmap image file. Exclusive with `text`
+    text : str
+        Text to generate a depthmap with. Exclusive with `depthmap`
+    pattern : str
+        Path to an image file to use as background pattern. If None, a random dot pattern is generated
+    wall : bool
+        True for wall eyed mode, False for cross eyed mode
+    dot_prob : float
+        Dot apparition probability
+    dot_bg_color : str
+        Hex code for the background color of the dot pattern
+    dot_colors : str
+        Comma separated list of hex colors for the dots. Supports multipliers
+    blur : int
+        Gaussian blur amount. Defaults to 2 for depthmap files and 8 for text
+    forcedepth : float
+        Force max depth to use
+    font : str
+        Truetype font file to use for text. If relative path, font root is FONT_ROOT
+    engine : str
+        Rendering engine. One of `engines.ENGINES`
+    workers : int
+        Number of processes rendering bands of the image in parallel
+    seed : int
+        Seed for the random dot pattern. Renders with the same options and seed are identical
+    oversample : float
+        Only for pattern images. 1 shifts pixels by fractions of a pixel at the output size. Bigger factors render the
+        depthmap, canvas and pattern that many times larger with whole pixel shifts, then downsize the result
+    preview : bool
+        Renders a quick, low resolution stereogram instead: the depthmap is downsized to PREVIEW_DIMENSION, and it is
+        never oversampled nor split between processes. Same pattern and seed as the full stereogram, so it can be shown
+        while that renders
+    max_pixels : int
+        Most pixels a depthmap or pattern file may take to decode, and the canvas to render, oversampled. Bigger ones
+        are refused before decoding or rendering, with `assets.ImageTooLarge`. None for no limit, i.e. print-size
+        renders in bands. Servers set their own budget
+    """
+    FIELDS = ("depthmap", "text", "pattern", "wall", "dot_prob", "dot_bg_color", "dot_colors", "blur", "forcedepth",
+              "font", "engine", "workers", "seed", "oversample", "preview", "max_pixels")
+
+    def __init__(self, depthmap=None, text=None, pattern=None, wall=True, dot_prob=None, dot_bg_color=None,
+                 dot_colors=None, blur=None, forcedepth=None, font=DEFAULT_DEPTHTEXT_FONT, engine=DEFAULT_ENGINE,
+                 workers=1, seed=None, oversample=OVERSAMPLE, preview=False,
+                 max_pixels=None):
+        if (depthmap is None) == (text is None):
+            raise ValueError("Exactly one of depthmap and text must be set")
+        if pattern is not None and (dot_prob is not None or dot_bg_color is not None or dot_colors is not None):
+            raise ValueError("Dot settings only make sense without a pattern")
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine '{}'. Valid options are: {}".format(engine, sorted(ENGINES)))
+        if workers < 1:
+            raise ValueError("{} is not a positive number of workers".format(workers))
+        if not 1 <= oversample <= MAX_OVERSAMPLE:
+            raise ValueError("Can't oversample by {}, it must be in range [1, {}]".format(oversample, MAX_OVERSAMPLE))
+        if max_pixels is not None and max_pixels < 1:
+            raise ValueError("{} is not a positive number of pixels".format(max_pixels))
+        self.depthmap = depthmap
+        self.text = text
+        self.pattern = pattern
+        self.wall = bool(wall)
+        self.dot_prob = dot_prob
+        self.dot_bg_color = dot_bg_color
+        self.dot_colors = dot_colors
+        self.blur = blur if blur else (2 if depthmap else 8)
+        self.forcedepth = forcedepth
+        self.font = font
+        self.engine = engine
+        self.workers = workers
+        self.seed = seed
+        self.oversample = float(oversample)
+        self.preview = bool(preview)
+        self.max_pixels = max_pixels
+
+    @property
+    def dots(self):
+        return self.pattern is None
+
+    @property
+    def cross(self):
+        return not self.wall
+
+    @property
+    def oversampled(self):
+        return self.pattern is not None and self.oversample != 1 and not self.preview
+
+    @property
+    def subpixel(self):
+        return self.pattern is not None and not self.oversampled
+
+    @classmethod
+    def from_args(cls, parsed_args):
+        """
+        Builds options from parsed command line arguments
+
+        Parameters
+        ----------
+        parsed_args : argparse.Namespace
+            As returned by `obtain_args`
+
+        Returns
+        -------
+        RenderOptions
+        """
+        return cls(depthmap=parsed_args.depthmap, text=parsed_args.text, pattern=parsed_args.pattern,
+                   wall=parsed_args.wall, dot_prob=parsed_args.dot_prob, dot_bg_color=parsed_args.dot_bg_color,
+                   dot_colors=parsed_args.dot_colors, blur=parsed_args.blur, forcedepth=parsed_args.forcedepth,
+                   font=parsed_args.font or DEFAULT_DEPTHTEXT_FONT, engine=parsed_args.engine,
+                   workers=parsed_args.workers, seed=parsed_args.seed, oversample=parsed_args.oversample,
+                   preview=parsed_args.preview, max_pixels=parsed_args.max_pixels)
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Builds options from a dict, i.e. a decoded JSON request
+
+        Parameters
+        ----------
+        d : dict
+            Option names and values
+
+        Returns
+        -------
+        RenderOptions
+        """
+        unknown = set(d) - set(cls.FIELDS)
+        if unknown:
+            raise ValueError("Unknown options: {}".format(sorted(unknown)))
+        return cls(**d)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+def _file_key(filename):
+    """Identifies a file and its version for caching. None if the file can't be accessed"""
+    try:
+        return os.path.abspath(filename), os.path.getmtime(filename)
+    except OSError:
+        return None
 
-    pixels = img_object.load()
-    for x in range(img_object.size[0]):
-        for y in range(img_object.size[1]):
-            pixels[x, y] = int((pixels[x, y] * conv_factor)) + new_min
-    return img_object
 
+def _depthmap_key(options, max_dimension):
+    """Identifies a depthmap and its processing for caching. None if the depthmap file can't be accessed"""
+    if options.text:
+        return "text", options.text, options.font, options.blur, options.forcedepth
+    file_key = _file_key(options.depthmap)
+    return None if file_key is None else ("file",) + file_key + (options.blur, options.forcedepth, max_dimension)
+
+
+def make_depthmap(options, max_dimension=MAX_DIMENSION, timer=NULL_TIMER):
+    """
+    Loads or creates the depthmap for a stereogram, blurred and with redistributed grays if needed.
+
+    Results are cached, so they must not be modified.
+
+    Parameters
+    ----------
+    options : RenderOptions
+        Depthmap options
+    max_dimension : int
+        Depthmap files bigger than this are downsized. None to keep their size
+    timer : timing.StageTimer
+        Where to time the "load", "blur" and "redistribute_grays" stages
+
+    Returns
+    -------
+    PIL.Image.Image
+        Grayscale depthmap
+    """
+    key = _depthmap_key(options, max_dimension)
+    dm_img = depthmap_cache.get(key)
+    if dm_img is not None:
+        return dm_img
 
-def make_stereogram(parsed_args):
     # Load or create stereogram depthmap
-    if parsed_args.text:
-        dm_img = make_depth_text(parsed_args.text, parsed_args.font)
-    else:
-        dm_img = load_file(parsed_args.depthmap, "L")
+    with timer.stage("load"):
+        if options.text:
+            dm_img = make_depth_text(options.text, options.font)
+        else:
+            dm_img = load_file(options.depthmap, "L", max_dimension, options.max_pixels)
+            if dm_img is None:
+                raise ValueError("Depthmap '{}' can't be loaded".format(os.path.basename(options.depthmap)))
     # Apply gaussian blur if needed
-    if parsed_args.blur and parsed_args.blur != 0:
-        dm_img = dm_img.filter(imflt.GaussianBlur(parsed_args.blur))
+    if options.blur and options.blur != 0:
+        with timer.stage("blur"):
+            dm_img = dm_img.filter(imflt.GaussianBlur(options.blur))
 
     # Redistribute grayscale range (force depth)
-    if parsed_args.text:
-        dm_img = redistribute_grays(dm_img, parsed_args.forcedepth if parsed_args.forcedepth is not None else 0.5)
-    elif parsed_args.forcedepth:
-        dm_img = redistribute_grays(dm_img, parsed_args.forcedepth)
+    with timer.stage("redistribute_grays"):
+        if options.text:
+            dm_img = redistribute_grays(dm_img, options.forcedepth if options.forcedepth is not None else 0.5)
+        elif options.forcedepth:
+            dm_img = redistribute_grays(dm_img, options.forcedepth)
+
+    if key is not None:
+        depthmap_cache.put(key, dm_img, image_nbytes(dm_img))
+    return dm_img
+
+
+def _preview_depthmap(dm_img, timer=NULL_TIMER):
+    """
+    Downsizes a depthmap from `make_depthmap` for a preview. It is blurred at full size, so the preview looks like the
+    full stereogram, and the full render finds it in the cache.
+    """
+    if max(dm_img.size) <= PREVIEW_DIMENSION:
+        return dm_img
+    with timer.stage("preview"):
+        factor = PREVIEW_DIMENSION / float(max(dm_img.size))
+        return dm_img.resize((max(1, int(dm_img.size[0] * factor)), max(1, int(dm_img.size[1] * factor))),
+                             im.BILINEAR)
+
+
+def _pattern_tile(filename, width, max_pixels=MAX_IMAGE_PIXELS):
+    """Loads a pattern image resized to the strip width. Cached, must not be modified"""
+    file_key = _file_key(filename)
+    key = None if file_key is None else file_key + (width,)
+    tile_img = pattern_cache.get(key)
+    if tile_img is not None:
+        return tile_img
+    pattern_raw_img = load_file(filename, max_pixels=max_pixels)
+    if pattern_raw_img is None:
+        raise ValueError("Pattern '{}' can't be loaded".format(os.path.basename(filename)))
+    p_w = pattern_raw_img.size[0]
+    p_h = pattern_raw_img.size[1]
+    tile_img = pattern_raw_img.resize((width, (int)((width * 1.0 / p_w) * p_h)), im.LANCZOS)
+    if key is not None:
+        pattern_cache.put(key, tile_img, image_nbytes(tile_img))
+    return tile_img
+
+
+def make_pattern_strip(filename, width, height, oversample=1.0, top=0, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Creates a pattern strip from an image file: resized to the strip width, repeated vertically and oversampled.
+
+    Results are cached, so they must not be modified.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the pattern image
+    width : int
+        Strip width, before oversampling
+    height : int
+        Strip height, before oversampling
+    oversample : float
+        Oversampling factor
+    top : int
+        Row of the stereogram where the strip starts. Keeps the repetition aligned between bands of an image
+    max_pixels : int
+        Most pixels the pattern file may take to decode
+
+    Returns
+    -------
+    PIL.Image.Image
+        RGB pattern strip
+    """
+    file_key = _file_key(filename)
+    key = None if file_key is None else file_key + (width, height, oversample, top)
+    pattern_strip_img = pattern_cache.get(key)
+    if pattern_strip_img is not None:
+        return pattern_strip_img
+
+    pattern_strip_img = im.new(mode="RGB", size=(width, height), color=(0, 0, 0))
+    tile_img = _pattern_tile(filename, width, max_pixels)
+    # Repeat vertically
+    y = -(top % tile_img.size[1])
+    while y < pattern_strip_img.size[1]:
+        pattern_strip_img.paste(tile_img, (0, y, tile_img.size[0], y + tile_img.size[1]))
+        y += tile_img.size[1]
+    if oversample != 1.0:
+        pattern_strip_img = pattern_strip_img.resize(((int)(width * oversample), (int)(height * oversample)))
+
+    if key is not None:
+        pattern_cache.put(key, pattern_strip_img, image_nbytes(pattern_strip_img))
+    return pattern_strip_img
+
+
+def check_render_size(dm_size, options, band_height=None):
+    """
+    Refuses renders whose canvas, with the pattern strip and oversampled, takes more than `options.max_pixels`. Cheap
+    enough to call with the size in the depthmap header, before decoding it
+
+    Parameters
+    ----------
+    dm_size : tuple(int, int)
+        Size of the depthmap, before oversampling
+    options : RenderOptions
+        Oversampling and pixel budget
+    band_height : int
+        Rows per band, when rendering in bands. Only a band, with its margins, is rendered at once
+
+    Raises
+    ------
+    assets.ImageTooLarge
+        If the canvas is over the pixel budget
+    """
+    width, height = dm_size
+    if band_height is not None:
+        height = min(height, band_height + (2 * BAND_MARGIN if options.oversampled else 0))
+    oversample = options.oversample if options.oversampled else 1.0
+    canvas_size = ((int)((width + (int)(width / PATTERN_FRACTION)) * oversample), (int)(height * oversample))
+    if options.max_pixels is not None and canvas_size[0] * canvas_size[1] > options.max_pixels:
+        raise ImageTooLarge("A {}x{} canvas is over the budget of {} pixels".format(
+            canvas_size[0], canvas_size[1], options.max_pixels))
+
+
+def check_input_files(options, max_dimension=MAX_DIMENSION, band_height=None):
+    """
+    Refuses depthmap and pattern files that can't be read or are over the pixel budget, and depthmaps whose canvas
+    would be, reading only their header. Nothing to check without a pixel budget
 
+    Parameters
+    ----------
+    options : RenderOptions
+        Input files and pixel budget
+    max_dimension : int
+        Depthmap files bigger than this are downsized. None to keep their size
+    band_height : int
+        Rows per band, when rendering in bands
+
+    Raises
+    ------
+    ValueError
+        If a file can't be read
+    assets.ImageTooLarge
+        If a file or the canvas is over the pixel budget
+    """
+    if options.max_pixels is None:
+        return
+    # Patterns are always downsized when loaded
+    for path, dimension in [(options.depthmap, max_dimension), (options.pattern, MAX_DIMENSION)]:
+        if path is None:
+            continue
+        try:
+            img, size = open_image(path, dimension, options.max_pixels)
+            img.close()
+        except IOError as e:
+            raise ValueError("'{}' can't be read: {}".format(path, e))
+        # Previews are downsized further
+        if path == options.depthmap and not options.preview:
+            check_render_size(size, options, band_height)
+
+
+def make_canvas(dm_size, options, top=0, band=None):
+    """
+    Creates the canvas of a stereogram, with the first pattern strip(s) pasted at the center
+
+    Parameters
+    ----------
+    dm_size : tuple(int, int)
+        Size of the depthmap, before oversampling
+    options : RenderOptions
+        Pattern and view mode options
+    top : int
+        Row of the stereogram where the depthmap starts, when rendering it in bands
+    band : int
+        Index of the band, when rendering in bands. Each band gets its own random dots
+
+    Returns
+    -------
+    tuple(PIL.Image.Image, int)
+        Canvas, oversampled when oversampling a pattern image, and width of the pattern strip in the canvas
+    """
     # Create blank canvas
-    pattern_width = (int)(dm_img.size[0]/PATTERN_FRACTION)
-    canvas_img = im.new(mode="RGB",
-                        size=(dm_img.size[0] + pattern_width, dm_img.size[1]),
-                        color=(0, 0, 0) if parsed_args.dot_bg_color is None
-                        else _hex_color_to_tuple(parsed_args.dot_bg_color))
+    pattern_width = (int)(dm_size[0]/PATTERN_FRACTION)
+    bg_color = (0, 0, 0) if options.dot_bg_color is None else _hex_color_to_tuple(options.dot_bg_color)
+    canvas_size = (dm_size[0] + pattern_width, dm_size[1])
+    dm_width = dm_size[0]
     # Create pattern
-    pattern_strip_img = im.new(mode="RGB",
-                               size=(pattern_width, dm_img.size[1]),
-                               color=(0, 0, 0) if parsed_args.dot_bg_color is None
-                               else _hex_color_to_tuple(parsed_args.dot_bg_color))
-    if parsed_args.pattern:
-        # Create from file
-        pattern_raw_img = load_file(parsed_args.pattern)
-        p_w = pattern_raw_img.size[0]
-        p_h = pattern_raw_img.size[1]
-        # Resize to strip width
-        pattern_raw_img = pattern_raw_img.resize((pattern_width, (int)((pattern_width * 1.0 / p_w) * p_h)), im.LANCZOS)
-        # Repeat vertically
-        region = pattern_raw_img.crop((0, 0, pattern_raw_img.size[0], pattern_raw_img.size[1]))
-        y = 0
-        while y < pattern_strip_img.size[1]:
-            pattern_strip_img.paste(region, (0, y, pattern_raw_img.size[0], y + pattern_raw_img.size[1]))
-            y += pattern_raw_img.size[1]
-
-        # Oversample. Smoother results.
-        dm_img = dm_img.resize(((int)(dm_img.size[0] * OVERSAMPLE), (int)(dm_img.size[1] * OVERSAMPLE)))
-        canvas_img = canvas_img.resize(((int)(canvas_img.size[0] * OVERSAMPLE), (int)(canvas_img.size[1] * OVERSAMPLE)))
-        pattern_strip_img = pattern_strip_img.resize(((int)(pattern_strip_img.size[0] * OVERSAMPLE), (int)(pattern_strip_img.size[1] * OVERSAMPLE)))
-        pattern_width = pattern_strip_img.size[0]
+    if options.pattern:
+        # Create from file, already oversampled
+        oversample = options.oversample if options.oversampled else 1.0
+        pattern_strip_img = make_pattern_strip(options.pattern, pattern_width, dm_size[1], oversample, top,
+                                               options.max_pixels)
+
+        if options.oversampled:
+            canvas_size = ((int)(canvas_size[0] * options.oversample), (int)(canvas_size[1] * options.oversample))
+            dm_width = (int)(dm_width * options.oversample)
+            pattern_width = pattern_strip_img.size[0]
 
     else:
         # create random dot pattern
-        pixels = pattern_strip_img.load()
-        dot_prob = parsed_args.dot_prob if parsed_args.dot_prob else 0.4
-        if parsed_args.dot_colors:
-            hex_tuples = list()
-            for hex_str in parsed_args.dot_colors.split(','):
-                if re.match(r'.+x\d+', hex_str):
-                    # multiplier
-                    factor = int(re.sub(r'.*x', '', hex_str))
-                    hex_tuples.extend([re.sub(r'x\d+', '', hex_str)]*factor)
-                else:
-                    hex_tuples.append(hex_str)
-            color_tuples = [_hex_color_to_tuple(hex) for hex in hex_tuples]
-        else:
-            color_tuples = [(255, 0, 0), (255, 255, 0), (200, 0, 255)]
+        dot_prob = options.dot_prob if options.dot_prob else DEFAULT_DOT_PROB
+        color_tuples = _parse_dot_colors(options.dot_colors) if options.dot_colors else DEFAULT_DOT_COLORS
         log.d("Colors to use for dots: {}".format(color_tuples))
-        for y in range(pattern_strip_img.size[1]):
-            for x in range(pattern_width):
-                if random() < dot_prob:
-                    pixels[x, y] = choice(color_tuples)
-
-    # Important objects here: dm_img, pattern_strip_img, canvas_img
-    # Start stereogram generation
-    def shift_pixels(dm_start_x, depthmap_image_object, canvas_image_object, direction):
-        """ shifts pixel of image. direction==1 right, -1 left """
-        depth_factor = pattern_width * SHIFT_RATIO
-        cv_pixels = canvas_image_object.load()
-        while 0 <= dm_start_x < dm_img.size[0]:
-            for dm_y in range(depthmap_image_object.size[1]):
-                constrained_end = max(0, min(dm_img.size[0]-1, dm_start_x + direction * pattern_width))
-                for dm_x in range(int(dm_start_x), int(constrained_end), direction):
-                    dm_pix = dm_img.getpixel((dm_x, dm_y))
-                    px_shift = int(dm_pix/255.0*depth_factor*(1 if parsed_args.wall else -1))*direction
-                    if direction == 1:
-                        cv_pixels[dm_x + pattern_width, dm_y] = canvas_img.getpixel((px_shift + dm_x, dm_y))
-                    if direction == -1:
-                        cv_pixels[dm_x, dm_y] = canvas_img.getpixel((dm_x + pattern_width + px_shift, dm_y))
-
-            dm_start_x += direction*pattern_strip_img.size[0]
+        seed = options.seed if band is None or options.seed is None else [options.seed, band]
+        pattern_strip_img = make_dot_pattern((pattern_width, dm_size[1]), dot_prob, color_tuples, bg_color, seed)
+    canvas_img = im.new(mode="RGB", size=canvas_size, color=bg_color)
 
     # paste first pattern
-    dm_center_x = dm_img.size[0]/2
+    dm_center_x = dm_width/2
     canvas_img.paste(pattern_strip_img, (int(dm_center_x), 0, int(dm_center_x + pattern_width), canvas_img.size[1]))
-    if not parsed_args.wall:
+    if not options.wall:
         canvas_img.paste(pattern_strip_img, (int(dm_center_x - pattern_width), 0, int(dm_center_x), canvas_img.size[1]))
-    shift_pixels(dm_center_x, dm_img, canvas_img, 1)
-    shift_pixels(dm_center_x + pattern_width, dm_img, canvas_img, -1)
+    return canvas_img, pattern_width
+
 
+def _oversample_depthmap(dm_img, options):
+    if options.oversampled:
+        return dm_img.resize(((int)(dm_img.size[0] * options.oversample), (int)(dm_img.size[1] * options.oversample)))
+    return dm_img
+
+
+def make_shift_map(dm_img, pattern_width, options, max_dimension=MAX_DIMENSION):
+    """
+    Shift of every pixel of an oversampled depthmap, for the engine. Computed in a single lookup per pixel, and cached
+    with the depthmap, so repeated renders don't compute it again.
+
+    Results are cached, so they must not be modified.
+
+    Parameters
+    ----------
+    dm_img : PIL.Image.Image
+        Depthmap from `make_depthmap`, oversampled
+    pattern_width : int
+        Width of the pattern strip in the canvas
+    options : RenderOptions
+        Options `dm_img` was made with
+    max_dimension : int
+        What `dm_img` was made with
+
+    Returns
+    -------
+    shiftmap.ShiftMap
+        The shift map. None if the engine doesn't use one
+    """
+    if options.engine not in SHIFT_MAP_ENGINES:
+        return None
+    depth_factor = pattern_width * SHIFT_RATIO
+    dm_key = _depthmap_key(options, max_dimension)
+    # The size tells previews from full renders
+    key = None if dm_key is None else dm_key + (dm_img.size, options.oversample, depth_factor, options.wall,
+                                                options.subpixel)
+    shift_map = shift_map_cache.get(key)
+    if shift_map is None:
+        shift_map = ShiftMap.from_depthmap(dm_img, depth_factor, options.wall, options.subpixel)
+        if key is not None:
+            shift_map_cache.put(key, shift_map, shift_map.nbytes)
+    return shift_map
+
+
+def _parallel(options):
+    # Previews take less than starting the processes
+    return options.workers > 1 and not options.preview
+
+
+def _shift_canvas(dm_img, canvas_img, pattern_width, options, shift_map=None, pool=None):
+    if _parallel(options):
+        return render_parallel(options.engine, dm_img, canvas_img, pattern_width,
+                               pattern_width * SHIFT_RATIO, options.wall, options.workers, options.subpixel,
+                               shift_map, pool)
+    # The reference engine gives the same result, many times slower
+    render = ENGINES["numpy" if options.preview and options.engine == "pixel" else options.engine]
+    return render(dm_img, canvas_img, pattern_width, pattern_width * SHIFT_RATIO, options.wall, options.subpixel,
+                  shift_map)
+
+
+def _downsample_canvas(canvas_img, options):
     # Bring back from oversample
-    if parsed_args.pattern:
-        canvas_img = canvas_img.resize(((int)(canvas_img.size[0] / OVERSAMPLE), (int)(canvas_img.size[1] / OVERSAMPLE)),
-                                       im.LANCZOS)  # NEAREST, BILINEAR, BICUBIC, LANCZOS
+    if options.oversampled:
+        return canvas_img.resize(((int)(canvas_img.size[0] / options.oversample),
+                                  (int)(canvas_img.size[1] / options.oversample)),
+                                 im.LANCZOS)  # NEAREST, BILINEAR, BICUBIC, LANCZOS
     return canvas_img
 
 
+def make_stereogram(options, timer=NULL_TIMER):
+    """
+    Generates a stereogram
+
+    Parameters
+    ----------
+    options : RenderOptions
+        What to generate and how
+    timer : timing.StageTimer
+        Where to time each stage of the generation
+
+    Returns
+    -------
+    PIL.Image.Image
+        Generated stereogram
+    """
+    dm_img = make_depthmap(options, timer=timer)
+    if options.preview:
+        dm_img = _preview_depthmap(dm_img, timer)
+    check_render_size(dm_img.size, options)
+    with timer.stage("pattern"):
+        canvas_img, pattern_width = make_canvas(dm_img.size, options)
+    with timer.stage("oversample"):
+        dm_img = _oversample_depthmap(dm_img, options)
+    with timer.stage("shift_map"):
+        shift_map = make_shift_map(dm_img, pattern_width, options)
+    # Start stereogram generation
+    with timer.stage("shift"):
+        canvas_img = _shift_canvas(dm_img, canvas_img, pattern_width, options, shift_map)
+    with timer.stage("downsample"):
+        return _downsample_canvas(canvas_img, options)
+
+
+def render_sequence(depthmaps, options):
+    """
+    Generates a stereogram per depthmap, i.e. the frames of an animation.
+
+    The pattern strip and the canvas are built once, so the background doesn't flicker between frames, even with
+    random dots. Each frame only renders again the rows whose depth changed from the previous frame.
+
+    Parameters
+    ----------
+    depthmaps : iterable(str)
+        Path to the depthmap of each frame. All of them must have the same size
+    options : RenderOptions
+        Options shared by every frame. Its depthmap is replaced by each frame
+
+    Yields
+    ------
+    PIL.Image.Image
+        Generated stereogram of each frame
+    """
+    render = ENGINES[options.engine]
+    base_canvas = previous_dm = canvas = None
+    for depthmap in depthmaps:
+        frame_options = RenderOptions.from_dict(dict(options.to_dict(), depthmap=depthmap, text=None))
+        dm_img = make_depthmap(frame_options)
+        if options.preview:
+            dm_img = _preview_depthmap(dm_img)
+        if base_canvas is None:
+            check_render_size(dm_img.size, frame_options)
+            base_canvas_img, pattern_width = make_canvas(dm_img.size, frame_options)
+            base_canvas = np.asarray(base_canvas_img)
+            canvas = base_canvas.copy()
+        dm = np.asarray(_oversample_depthmap(dm_img, frame_options))
+        if previous_dm is None:
+            changed_rows = np.arange(dm.shape[0])
+        elif dm.shape != previous_dm.shape:
+            raise ValueError("Depthmap '{}' is {}, but previous ones are {}".format(
+                depthmap, dm_img.size, (previous_dm.shape[1], previous_dm.shape[0])))
+        else:
+            changed_rows = np.flatnonzero((dm != previous_dm).any(axis=1))
+        if changed_rows.size > 0:
+            rows_img = render(im.fromarray(dm[changed_rows], "L"), im.fromarray(base_canvas[changed_rows], "RGB"),
+                              pattern_width, pattern_width * SHIFT_RATIO, options.wall, options.subpixel)
+            canvas[changed_rows] = np.asarray(rows_img)
+        previous_dm = dm
+        yield _downsample_canvas(im.fromarray(canvas, "RGB"), frame_options)
+
+
+def render_bands(options, fp, file_format="png", band_height=BAND_HEIGHT, quality=QUALITY,
+                 compress_level=PNG_COMPRESS_LEVEL, timer=NULL_TIMER, progress=None):
+    """
+    Generates a stereogram in horizontal bands, writing each band to a file as soon as it is ready.
+
+    Depthmap files are not downsized, so this is meant for big, print resolution stereograms. Only the depthmap is
+    held whole in memory, one byte per pixel. Canvas, pattern strip and output are one band at a time, so their
+    memory use depends on the band height, not on the image height.
+
+    With random dots, each band gets its own dots: the result differs from `make_stereogram` with the same seed.
+
+    Parameters
+    ----------
+    options : RenderOptions
+        What to generate and how
+    fp : file object
+        Binary file to write the image to
+    file_format : str
+        One of `output.BAND_WRITERS`
+    band_height : int
+        Rows of the stereogram per band
+    quality : int
+        Quality of lossy formats, 1 to 100
+    compress_level : int
+        zlib compression level of PNG, 0 to 9. Lower is faster and bigger
+    timer : timing.StageTimer
+        Where to time each stage of the generation. Stages add up over the bands
+    progress : callable
+        Called with the rows written so far and the total rows, after each band. Exceptions it raises stop the render
+
+    Returns
+    -------
+    tuple(int, int)
+        Size of the generated stereogram
+    """
+    # Fail before rendering anything
+    encoder_settings = encoder_params(file_format, quality, compress_level)
+    dm_img = make_depthmap(options, max_dimension=None, timer=timer)
+    if options.preview:
+        dm_img = _preview_depthmap(dm_img, timer)
+    check_render_size(dm_img.size, options, band_height)
+    dm_width, dm_height = dm_img.size
+    size = (dm_width + (int)(dm_width / PATTERN_FRACTION), dm_height)
+    with timer.stage("encode"):
+        writer = BAND_WRITERS[file_format](fp, size, **encoder_settings)
+    # Only resampling mixes rows, so only oversampled bands need margins
+    margin = BAND_MARGIN if options.oversampled else 0
+    # Started once for all the bands
+    with process_pool(options.workers) if _parallel(options) else contextlib.nullcontext() as pool:
+        for band, band_top in enumerate(range(0, dm_height, band_height)):
+            band_bottom = min(dm_height, band_top + band_height)
+            top = max(0, band_top - margin)
+            bottom = min(dm_height, band_bottom + margin)
+            band_dm_img = dm_img.crop((0, top, dm_width, bottom))
+            with timer.stage("pattern"):
+                canvas_img, pattern_width = make_canvas(band_dm_img.size, options, top, band)
+            with timer.stage("oversample"):
+                band_dm_img = _oversample_depthmap(band_dm_img, options)
+            with timer.stage("shift"):
+                canvas_img = _shift_canvas(band_dm_img, canvas_img, pattern_width, options, pool=pool)
+            if options.oversampled:
+                with timer.stage("downsample"):
+                    # Exact size, so bands line up no matter how oversampling rounded
+                    canvas_img = canvas_img.resize((size[0], bottom - top), im.LANCZOS)
+            with timer.stage("encode"):
+                writer.write_rows(np.asarray(canvas_img)[band_top - top:band_bottom - top])
+            log.d("Rows {} to {} of {} ready".format(band_top, band_bottom, dm_height))
+            if progress is not None:
+                progress(band_bottom, dm_height)
+    with timer.stage("encode"):
+        writer.close()
+    return size
+
+
+def render_key(options, file_format="png", encoder_settings=None):
+    """
+    Content hash of everything that determines an encoded stereogram: input files contents, options, settings and
+    encoding.
+
+    Parameters
+    ----------
+    options : RenderOptions
+        What to generate and how
+    file_format : str
+        One of `output.FORMATS`
+    encoder_settings : dict
+        As returned by `output.encoder_params`. Defaults to the format's defaults
+
+    Returns
+    -------
+    str
+        Hex digest. None if the stereogram can't be reproduced, i.e. random dots without a seed
+    """
+    if options.dots and options.seed is None:
+        return None
+    params = options.to_dict()
+    # Don't change the result
+    del params["workers"]
+    del params["max_pixels"]
+    # Previews depend on their size. Full renders keep their keys
+    if params.pop("preview"):
+        params["preview"] = PREVIEW_DIMENSION
+    params["settings"] = [PROGRAM_VERSION, MAX_DIMENSION, PATTERN_FRACTION, SHIFT_RATIO]
+    if encoder_settings is None:
+        encoder_settings = encoder_params(file_format)
+    params["encoding"] = [file_format, encoder_settings]
+    key = hashlib.sha256()
+    for param in ["depthmap", "pattern"]:
+        if params[param] is not None:
+            try:
+                with open(params[param], "rb") as f:
+                    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                        key.update(chunk)
+            except IOError:
+                return None
+            params[param] = True
+    key.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return key.hexdigest()
+
+
+def render_image(options, fp=None, file_format="png", quality=QUALITY, compress_level=PNG_COMPRESS_LEVEL,
+                 result_cache=None, timer=NULL_TIMER):
+    """
+    Generates an encoded stereogram, going through a result cache. Nothing is written to disk unless `fp` is a file
+
+    Parameters
+    ----------
+    options : RenderOptions
+        What to generate and how
+    fp : file object
+        Binary file or buffer to write the image to, i.e. an open file, a socket file or `sys.stdout.buffer`. If None,
+        the image is returned
+    file_format : str
+        One of `output.FORMATS`
+    quality : int
+        Quality of lossy formats, 1 to 100
+    compress_level : int
+        zlib compression level of PNG, 0 to 9. Lower is faster and bigger
+    result_cache : cache.ResultCache
+        Where to look for the result before generating it, and to store it after. Not used if None
+    timer : timing.StageTimer
+        Where to time each stage of the generation. A result cache hit is timed as the "result_cache" stage
+
+    Returns
+    -------
+    bytes
+        Encoded image, if `fp` is None
+    """
+    encoder_settings = encoder_params(file_format, quality, compress_level)
+    key = image_bytes = None
+    if result_cache is not None:
+        with timer.stage("result_cache"):
+            # Before reading the files whole to hash them
+            check_input_files(options)
+            key = render_key(options, file_format, encoder_settings)
+            image_bytes = result_cache.get(key, file_format) if key is not None else None
+    if image_bytes is not None:
+        log.d("Result cache hit: {}".format(key))
+    else:
+        stereogram_img = make_stereogram(options, timer)
+        with timer.stage("encode"):
+            if key is None and fp is not None:
+                # Nothing to cache: straight into the file
+                encode_image(stereogram_img, fp, file_format, quality, compress_level)
+                return None
+            image_bytes = encode_image(stereogram_img, None, file_format, quality, compress_level)
+        if key is not None:
+            with timer.stage("result_cache"):
+                result_cache.put(key, image_bytes, file_format)
+    if fp is None:
+        return image_bytes
+    with timer.stage("write"):
+        fp.write(image_bytes)
+    return None
+
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def _load_font(fontpath, size):
+    """Loads a truetype font once per path and size"""
+    return imf.truetype(fontpath, size)
+
+
+def _text_bbox(text, fontpath, size):
+    return imd.Draw(im.new('L', (1, 1))).multiline_textbbox((0, 0), text, font=_load_font(fontpath, size),
+                                                            align="center")
+
+
 def make_depth_text(text, font=DEFAULT_DEPTHTEXT_FONT, canvas_size=(800, 600)):
     """
     Makes a text depthmap
@@ -302,7 +1000,7 @@ def make_depth_text(text, font=DEFAULT_DEPTHTEXT_FONT, canvas_size=(800, 600)):
     Parameters
     ----------
     text : str
-        Text to generate
+        Text to generate. Can have many lines
     font : str
         Further font specification
     canvas_size: tuple
@@ -313,36 +1011,52 @@ def make_depth_text(text, font=DEFAULT_DEPTHTEXT_FONT, canvas_size=(800, 600)):
     PIL.Image.Image
         Generated depthmap image
     """
-    # TODO: Support for multiline text
     # TODO: Fix font size only, derive canvas size later
 
-
     fontpath = font if os.path.isabs(font) else "{}/{}.ttf".format(FONT_ROOT, font)
     # Create image (grayscale)
     i = im.new('L', canvas_size, "black")
-    # Draw text with appropriate gray level
-    font_size = 1
-    fnt = imf.truetype(fontpath, font_size)
-    while fnt.getsize(text)[0] < canvas_size[0]*0.9 and fnt.getsize(text)[1] < canvas_size[1]*0.9:
-        font_size += 1
-        fnt = imf.truetype(fontpath, font_size)
-    imd.Draw(i).text(
-        ((canvas_size[0] / 2 - fnt.getsize(text)[0] / 2,
-          canvas_size[1] / 2 - (fnt.getsize(text)[1] / 2)*1.2)),
-        text, font=fnt,
+
+    def fits(size):
+        left, top, right, bottom = _text_bbox(text, fontpath, size)
+        return right - left < canvas_size[0]*0.9 and bottom - top < canvas_size[1]*0.9
+
+    # Biggest font size that fits. Short glyphs, i.e. "a", fit at sizes taller than the canvas, so there is no upper
+    # bound to start from: double the size until it doesn't fit, then bisect
+    font_size, too_big = 1, 2
+    while too_big <= MAX_FONT_SIZE and fits(too_big):
+        font_size, too_big = too_big, too_big * 2
+    while too_big - font_size > 1:
+        size = (font_size + too_big) // 2
+        if fits(size):
+            font_size = size
+        else:
+            too_big = size
+    # Draw text with appropriate gray level, centered
+    left, top, right, bottom = _text_bbox(text, fontpath, font_size)
+    imd.Draw(i).multiline_text(
+        ((canvas_size[0] - left - right) / 2, (canvas_size[1] - top - bottom) / 2),
+        text, font=_load_font(fontpath, font_size), align="center",
         fill=((int)(255.0)))
     return i
 
 
-def save_to_file(img_object, output_dir=None):
+def save_to_file(img_object, output_dir=None, name=None, file_ext=DEFAULT_OUTPUT_EXTENSION, timer=NULL_TIMER):
     """
     Attempts to save the file
 
     Parameters
     ----------
-    img_object: PIL.Image.Image
-        The image object to save
+    img_object: PIL.Image.Image, bytes or callable
+        The image object to save, an already encoded image, or a function writing the image to the open file
     output_dir : The directory where to save the file
+    name : str
+        File name, without extension. Overwritten if it exists. If None, a name is made from the current date and time,
+        never overwriting another file
+    file_ext : str
+        File extension, with the dot. Sets the format of image objects
+    timer : timing.StageTimer
+        Where to time the "encode" stage of image objects, or the "write" stage of encoded images
 
     Returns
     -------
@@ -351,7 +1065,6 @@ def save_to_file(img_object, output_dir=None):
         Additional data: Path to stored image if success, else reason of failure
 
     """
-    file_ext = DEFAULT_OUTPUT_EXTENSION
     # Trying to save with image name format
     if output_dir is None:
         savefolder = SAVEFOLDER
@@ -364,13 +1077,40 @@ def save_to_file(img_object, output_dir=None):
         except IOError as e:
             log.e("Cannot create file: {}".format(e))
             return False, "Could not create output directory '{}': {}".format(savefolder, e)
-    outfile_name = u"{date}{ext}".format(
-        date=time.strftime("%Y%m%d-%H%M%S", time.localtime()),
-        ext=file_ext
-    )
+    if name is None:
+        name = time.strftime("%Y%m%d-%H%M%S", time.localtime())
+        unique = True
+    else:
+        unique = False
+    outfile_name = u"{name}{ext}".format(name=name, ext=file_ext)
     out_path = os.path.join(savefolder, outfile_name)
     try:
-        r = img_object.save(out_path)
+        if unique:
+            # More than one file in the same second: number them
+            for count in itertools.count(1):
+                try:
+                    f = open(out_path, "xb")
+                    break
+                except FileExistsError:
+                    out_path = os.path.join(savefolder, u"{name}-{count}{ext}".format(name=name, count=count,
+                                                                                        ext=file_ext))
+        else:
+            f = open(out_path, "wb")
+        with f:
+            if isinstance(img_object, bytes):
+                with timer.stage("write"):
+                    f.write(img_object)
+            elif callable(img_object):
+                try:
+                    img_object(f)
+                except Exception:
+                    # Don't leave half written images behind
+                    f.close()
+                    os.remove(out_path)
+                    raise
+            else:
+                with timer.stage("encode"):
+                    img_object.save(f, im.registered_extensions()[file_ext])
         log.d("Saved file in {}".format(out_path))
         return True, out_path
     except IOError as e:
@@ -378,23 +1118,17 @@ def save_to_file(img_object, output_dir=None):
         return False, "Could not create file '{}': {}".format(out_path, e)
 
 
-def load_file(name, type=''):
+def load_file(name, type='', max_dimension=MAX_DIMENSION, max_pixels=MAX_IMAGE_PIXELS):
+    # Presets are already decoded in the asset index
+    i = presets.image(name, type, max_dimension)
+    if i is not None:
+        return i
     try:
-        i = im.open(name)
-        if type != "":
-            i = i.convert(type)
+        # Raises ImageTooLarge before decoding anything
+        return decode_image(name, type, max_dimension, max_pixels)
     except IOError as msg:
         log.e("Picture couln't be loaded '{}': {}".format(name, msg))
         return None
-    # Resize if too big
-    if max(i.size) > MAX_DIMENSION:
-        max_dim = 0 if i.size[0] > i.size[1] else 1
-        old_max = i.size[max_dim]
-        new_max = MAX_DIMENSION
-        factor = new_max/float(old_max)
-        log.d("Image is big: {}. Resizing by a factor of {}".format(i.size, factor))
-        i = i.resize((int(i.size[0]*factor), int(i.size[1]*factor)))
-    return i
 
 
 def obtain_args():
@@ -417,6 +1151,32 @@ def obtain_args():
             raise argparse.ArgumentTypeError("{} not in range [{}, {}]".format(x, min, max))
         return x
 
+    def _oversample_factor(x):
+        x = float(x)
+        if not 1 <= x <= MAX_OVERSAMPLE:
+            raise argparse.ArgumentTypeError("{} not in range [1, {}]".format(x, MAX_OVERSAMPLE))
+        return x
+
+    def _ranged_int(min, max):
+        def parse(x):
+            x = int(x)
+            if x < min or x > max:
+                raise argparse.ArgumentTypeError("{} not in range [{}, {}]".format(x, min, max))
+            return x
+        return parse
+
+    def _positive_int(x):
+        x = int(x)
+        if x < 1:
+            raise argparse.ArgumentTypeError("{} is not a positive integer".format(x))
+        return x
+
+    def _positive_float(x):
+        x = float(x)
+        if x <= 0:
+            raise argparse.ArgumentTypeError("{} is not a positive number".format(x))
+        return x
+
     def _supported_image_file(filename):
         if not os.path.exists(filename):
             raise argparse.ArgumentTypeError("File does not exist")
@@ -427,7 +1187,7 @@ def obtain_args():
         return filename
 
     def _existent_directory(dirname):
-        if not os.path.isdir(dirname):
+        if dirname != "-" and not os.path.isdir(dirname):
             raise argparse.ArgumentTypeError("'{}' is not a directory".format(dirname))
         return dirname
 
@@ -460,13 +1220,53 @@ def obtain_args():
                                     help="Comma separated list of hex colors. Supports multipliers, "
                                          "i.e.: fff,ff0000x3 results in 3 times more ff0000 than fff",
                                     type=_valid_colors_list)
+    dotprops_arg_group.add_argument("--seed", help="Seed for the random dots. Same seed, same stereogram", type=int)
     arg_parser.add_argument("--blur", "-b", help="Gaussian blur ammount", type=_restricted_blur)
     arg_parser.add_argument("--forcedepth", help="Force max depth to use", type=_restricted_unit)
-    arg_parser.add_argument("--output", "-o", help="Directory where to store the results", type=_existent_directory)
+    arg_parser.add_argument("--output", "-o", help="Directory where to store the results. '-' writes the image to "
+                                                     "stdout, instead of a JSON response",
+                            type=_existent_directory)
     arg_parser.add_argument("--font", "-f",
                             help="Truetype font file to use. If relative path, font root is '{}'"
-                            .format(FONT_ROOT),
-                            default=DEFAULT_DEPTHTEXT_FONT)
+                            .format(FONT_ROOT))
+    arg_parser.add_argument("--cache-dir", help="Directory of a result cache. Repeated renders are read from it")
+    arg_parser.add_argument("--engine", "-e", help="Rendering engine. 'pixel' is the reference implementation, "
+                                                     "'hsr' removes hidden surfaces",
+                            choices=sorted(ENGINES), default=DEFAULT_ENGINE)
+    arg_parser.add_argument("--workers", help="Number of processes rendering bands of the image in parallel",
+                            type=_positive_int, default=1)
+    arg_parser.add_argument("--oversample",
+                            help="Pattern images only. 1 shifts pixels by fractions of a pixel. Bigger factors, up to "
+                                 "{}, render that many times larger and downsize, i.e. 1.8, slower and with more "
+                                 "memory".format(MAX_OVERSAMPLE),
+                            type=_oversample_factor, default=OVERSAMPLE)
+    arg_parser.add_argument("--preview",
+                            help="Render a quick, low resolution preview, from the depthmap downsized to {}px, with "
+                                 "the same pattern and seed".format(PREVIEW_DIMENSION),
+                            action="store_true")
+    arg_parser.add_argument("--format", help="Output file format. Only png and tiff in bands", choices=sorted(FORMATS),
+                            default="png")
+    arg_parser.add_argument("--quality", help="Quality of webp and jpeg images", type=_ranged_int(1, 100),
+                            default=QUALITY)
+    arg_parser.add_argument("--compress-level", help="zlib compression level of png images. Lower is faster and bigger",
+                            type=_ranged_int(0, 9), default=PNG_COMPRESS_LEVEL)
+    arg_parser.add_argument("--band-height",
+                            help="Render in bands of this many rows, writing each one to the output file as soon as "
+                                 "it's ready. Depthmaps are not downsized to {}px. Memory use depends on the band "
+                                 "height, not on the image size".format(MAX_DIMENSION),
+                            type=_positive_int)
+    arg_parser.add_argument("--max-pixels",
+                            help="Refuse depthmap and pattern files that would take more pixels than this to decode, "
+                                 "reading only their header, and canvases bigger than this once oversampled. Big "
+                                 "JPEGs are decoded at a reduced scale. No limit by default, {} is safe for untrusted "
+                                 "inputs".format(MAX_IMAGE_PIXELS),
+                            type=_positive_int)
+    arg_parser.add_argument("--time-limit", help="Give up after this many seconds", type=_positive_float)
+    arg_parser.add_argument("--profile", help="Add the time spent in each stage to the JSON response",
+                            action="store_true")
+    arg_parser.add_argument("--profile-dump", help="Run under cProfile and save the stats to this file")
+    arg_parser.add_argument("--log-level", help="Minimum level to log", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    arg_parser.add_argument("--log-file", help="Log file. Empty for no log file")
     args = arg_parser.parse_args()
     if args.dot_prob and not args.dots:
         arg_parser.error("--dot-prob only makes sense when --dots is set")
@@ -474,48 +1274,131 @@ def obtain_args():
         arg_parser.error("--dot-bg-color only makes sense when --dots is set")
     if args.dot_colors and not args.dots:
         arg_parser.error("--dot-colors only makes sense when --dots is set")
-    if not args.blur:
-        args.blur = 2 if args.depthmap else 8
     if args.font and not args.text:
         arg_parser.error("--font only makes sense when --text is used")
+    if args.band_height and not args.output:
+        arg_parser.error("--band-height needs --output")
+    if args.band_height and args.format not in BAND_WRITERS:
+        arg_parser.error("--band-height only writes {}".format(" and ".join(sorted(BAND_WRITERS))))
     return args
 
 
 class _HTTPCode:
     OK = 200
+    ACCEPTED = 202
     BAD_REQUEST = 400
+    NOT_FOUND = 404
+    CONFLICT = 409
+    PAYLOAD_TOO_LARGE = 413
     INTERNAL_SERVER_ERROR = 500
+    SERVICE_UNAVAILABLE = 503
 
 
-def return_http_response(code, text):
-    print(json.dumps({
+def return_http_response(code, text, timings=None):
+    # The response must be the last line of the output
+    log.flush()
+    response = {
         "code": code,
         "text": text
-    }))
+    }
+    if timings is not None:
+        response["timings"] = timings
+    print(json.dumps(response))
 
 
-def main():
-    log.i("--- Started generation ---")
-    parsed_args = obtain_args()
-    log.d("Arguments: ")
-    for key in vars(parsed_args):
-        log.d("\t {}: {}".format(key, getattr(parsed_args, key)))
+def generate(parsed_args):
+    """
+    Generates and saves or shows a stereogram as the command line arguments say, within their time limit. Inputs that
+    are too big or can't be loaded, and renders over the time limit, are answered with an error response
+
+    Parameters
+    ----------
+    parsed_args : argparse.Namespace
+        As returned by `obtain_args`
+    """
+    try:
+        with time_limit(parsed_args.time_limit):
+            _generate(parsed_args)
+        return
+    except ImageTooLarge as e:
+        code = _HTTPCode.PAYLOAD_TOO_LARGE
+        message = "Image too large: {}".format(e)
+    except TimeLimitExceeded as e:
+        code = _HTTPCode.SERVICE_UNAVAILABLE
+        message = "Gave up: {}".format(e)
+    except ValueError as e:
+        code = _HTTPCode.BAD_REQUEST
+        message = "Invalid input: {}".format(e)
+    log.e(message)
+    if parsed_args.output == "-":
+        # stdout is for the image
+        sys.exit(1)
+    return_http_response(code, message)
+
+
+def _generate(parsed_args):
     t0 = time.time()
-    i = make_stereogram(parsed_args)
+    timer = StageTimer() if parsed_args.profile else NULL_TIMER
+    options = RenderOptions.from_args(parsed_args)
+    file_ext = ".{}".format(parsed_args.format)
     if not parsed_args.output:
+        i = make_stereogram(options, timer)
         log.i("Process finished successfully after {0:.2f}s".format(time.time() - t0))
+        if parsed_args.profile:
+            log.i("Timings: {}".format(json.dumps(timer.to_dict())))
         log.i("No output file specified. Showing in temporary preview")
         show_img(i)
         return
+    # Both write the image straight into the open file
+    if parsed_args.band_height:
+        i = functools.partial(render_bands, options, file_format=parsed_args.format,
+                              band_height=parsed_args.band_height, quality=parsed_args.quality,
+                              compress_level=parsed_args.compress_level, timer=timer)
+    else:
+        i = functools.partial(render_image, options, file_format=parsed_args.format, quality=parsed_args.quality,
+                              compress_level=parsed_args.compress_level,
+                              result_cache=ResultCache(parsed_args.cache_dir) if parsed_args.cache_dir else None,
+                              timer=timer)
+    if parsed_args.output == "-":
+        i(sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+        log.i("Process finished successfully after {0:.2f}s".format(time.time() - t0))
+        if parsed_args.profile:
+            log.i("Timings: {}".format(json.dumps(timer.to_dict())))
+        return
     # print "Saving..."
-    success, additional_info = save_to_file(i, parsed_args.output)
+    success, additional_info = save_to_file(i, parsed_args.output, file_ext=file_ext, timer=timer)
     log.d("Finished. Success: {}, Additional info: {}".format(success, additional_info))
+    timings = timer.to_dict() if parsed_args.profile else None
     if not success:
         log.e("Process finished with errors: '{}'".format(additional_info))
-        return_http_response(_HTTPCode.INTERNAL_SERVER_ERROR, additional_info)
+        return_http_response(_HTTPCode.INTERNAL_SERVER_ERROR, additional_info, timings)
     else:
         log.i("Process finished successfully after {0:.2f}s".format(time.time() - t0))
-        return_http_response(_HTTPCode.OK, os.path.basename(additional_info))
+        return_http_response(_HTTPCode.OK, os.path.basename(additional_info), timings)
+
+
+def main():
+    parsed_args = obtain_args()
+    if parsed_args.output == "-":
+        # stdout is for the image
+        log.configure(level=parsed_args.log_level, path=parsed_args.log_file, console=False)
+    elif parsed_args.log_level or parsed_args.log_file is not None:
+        log.configure(level=parsed_args.log_level, path=parsed_args.log_file)
+    log.i("--- Started generation ---")
+    if log.debug_enabled():
+        log.d("Arguments: ")
+        for key in vars(parsed_args):
+            log.d("\t {}: {}".format(key, getattr(parsed_args, key)))
+    if not parsed_args.profile_dump:
+        generate(parsed_args)
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(generate, parsed_args)
+    finally:
+        profiler.dump_stats(parsed_args.profile_dump)
+        log.i("Profile saved in '{}'. Read it with pstats or snakeviz".format(parsed_args.profile_dump))
 
 
 if __name__ == "__main__":
@@ -528,7 +1411,7 @@ Problems:
 When image sharply changes from one depth to a different one, a part of the surface edge repeats to the right and left.
 Internet's explanation is that there are some points one eye shouldn't be able to see, but we nonetheless consider them
 in the stereogram. They say it can be fixed... but how?
-This is called Hidden Surface Removal.
+This is called Hidden Surface Removal. The 'hsr' engine does it (see engines.render_hsr).
 """
 
 # TODO: Provide option to match pattern height
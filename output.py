@@ -0,0 +1,220 @@
+"""Image encoding: whole images to bytes or file objects, and writers that encode an image band by band."""
+
+import io
+import struct
+import zlib
+
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+
+PNG_COMPRESS_LEVEL = 6
+PNG_IDAT_SIZE = 1 << 20  # Max bytes per IDAT chunk
+QUALITY = 85  # Lossy formats, 1 to 100
+WEBP_METHOD = 0  # 0 is the fastest encoding, 6 the smallest file
+
+# Pillow format name and MIME type of each output format
+FORMATS = {
+    "png": ("PNG", "image/png"),
+    "tiff": ("TIFF", "image/tiff"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+
+def encoder_params(file_format, quality=QUALITY, compress_level=PNG_COMPRESS_LEVEL):
+    """
+    Encoder settings that apply to a format
+
+    Parameters
+    ----------
+    file_format : str
+        One of `FORMATS`
+    quality : int
+        Quality of lossy formats, 1 to 100
+    compress_level : int
+        zlib compression level of PNG, 0 to 9
+
+    Returns
+    -------
+    dict
+        Keyword arguments for Pillow's `Image.save`
+    """
+    if file_format not in FORMATS:
+        raise ValueError("Unknown format '{}'. Valid options are: {}".format(file_format, sorted(FORMATS)))
+    if file_format == "png":
+        if not 0 <= compress_level <= 9:
+            raise ValueError("PNG compress level {} not in range [0, 9]".format(compress_level))
+        return {"compress_level": compress_level}
+    if file_format in ("webp", "jpeg"):
+        if not 1 <= quality <= 100:
+            raise ValueError("Quality {} not in range [1, 100]".format(quality))
+        return {"quality": quality, "method": WEBP_METHOD} if file_format == "webp" else {"quality": quality}
+    return {}
+
+
+def encode_image(img, fp=None, file_format="png", quality=QUALITY, compress_level=PNG_COMPRESS_LEVEL):
+    """
+    Encodes a whole image, straight into a file object or to bytes
+
+    Parameters
+    ----------
+    img : PIL.Image.Image
+        Image to encode
+    fp : file object
+        Binary file or buffer to write to. If None, the encoded image is returned
+    file_format : str
+        One of `FORMATS`
+    quality : int
+        Quality of lossy formats, 1 to 100
+    compress_level : int
+        zlib compression level of PNG, 0 to 9
+
+    Returns
+    -------
+    bytes
+        Encoded image, if `fp` is None
+    """
+    params = encoder_params(file_format, quality, compress_level)
+    if fp is not None:
+        img.save(fp, FORMATS[file_format][0], **params)
+        return None
+    output = io.BytesIO()
+    img.save(output, FORMATS[file_format][0], **params)
+    return output.getvalue()
+
+
+class PNGBandWriter(object):
+    """
+    Writes an 8 bit RGB PNG, rows coming in bands from top to bottom.
+
+    Rows use the "Sub" filter: each byte minus the same channel of the previous pixel.
+    """
+    def __init__(self, fp, size, compress_level=PNG_COMPRESS_LEVEL):
+        """
+        Parameters
+        ----------
+        fp : file object
+            Binary file to write to. Doesn't need to be seekable
+        size : tuple(int, int)
+            Size of the whole image
+        compress_level : int
+            zlib compression level, 0 to 9
+        """
+        self.fp = fp
+        self.size = size
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = b""
+        self.fp.write(b"\x89PNG\r\n\x1a\n")
+        # Width, height, bit depth, color type (RGB), compression, filter, interlace
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, 2, 0, 0, 0))
+
+    def _write_chunk(self, chunk_type, data):
+        self.fp.write(struct.pack(">I", len(data)))
+        self.fp.write(chunk_type)
+        self.fp.write(data)
+        self.fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff))
+
+    def _write_idat(self, data, flush=False):
+        self._pending += data
+        while len(self._pending) >= PNG_IDAT_SIZE or (flush and self._pending):
+            self._write_chunk(b"IDAT", self._pending[:PNG_IDAT_SIZE])
+            self._pending = self._pending[PNG_IDAT_SIZE:]
+
+    def write_rows(self, rows):
+        """
+        Parameters
+        ----------
+        rows : numpy.ndarray
+            uint8 array of shape (rows, width, 3)
+        """
+        if rows.shape[1:] != (self.size[0], 3):
+            raise ValueError("Rows of shape {} don't match image width {}".format(rows.shape, self.size[0]))
+        filtered = np.empty((rows.shape[0], 1 + rows.shape[1] * 3), dtype=np.uint8)
+        filtered[:, 0] = 1  # Sub filter
+        flat = rows.reshape(rows.shape[0], -1)
+        filtered[:, 1:4] = flat[:, :3]
+        # uint8 arithmetic wraps modulo 256, as the filter requires
+        np.subtract(flat[:, 3:], flat[:, :-3], out=filtered[:, 4:])
+        self._write_idat(self._compressor.compress(filtered.tobytes()))
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        if self.rows_written != self.size[1]:
+            raise ValueError("Wrote {} rows of {}".format(self.rows_written, self.size[1]))
+        self._write_idat(self._compressor.flush(), flush=True)
+        self._write_chunk(b"IEND", b"")
+
+
+class TIFFBandWriter(object):
+    """
+    Writes an uncompressed 8 bit RGB TIFF, rows coming in bands from top to bottom.
+
+    The image directory goes first, so the file is written strictly in order.
+    """
+    _TAGS_OFFSET = 8
+    _TAG_COUNT = 10
+
+    def __init__(self, fp, size):
+        """
+        Parameters
+        ----------
+        fp : file object
+            Binary file to write to. Doesn't need to be seekable
+        size : tuple(int, int)
+            Size of the whole image
+        """
+        self.fp = fp
+        self.size = size
+        self.rows_written = 0
+        ifd_size = 2 + self._TAG_COUNT * 12 + 4
+        bits_offset = self._TAGS_OFFSET + ifd_size
+        data_offset = bits_offset + 6
+        data_size = size[0] * size[1] * 3
+        if data_offset + data_size > 0xffffffff:
+            raise ValueError("Image of size {} is too big for a TIFF file".format(size))
+        short, long = 3, 4
+        tags = [
+            (256, long, 1, size[0]),  # ImageWidth
+            (257, long, 1, size[1]),  # ImageLength
+            (258, short, 3, bits_offset),  # BitsPerSample, 8 8 8 at offset
+            (259, short, 1, 1),  # Compression: none
+            (262, short, 1, 2),  # PhotometricInterpretation: RGB
+            (273, long, 1, data_offset),  # StripOffsets: a single strip
+            (277, short, 1, 3),  # SamplesPerPixel
+            (278, long, 1, size[1]),  # RowsPerStrip
+            (279, long, 1, data_size),  # StripByteCounts
+            (284, short, 1, 1),  # PlanarConfiguration: chunky
+        ]
+        header = b"II*\x00" + struct.pack("<I", self._TAGS_OFFSET)
+        ifd = struct.pack("<H", len(tags))
+        for tag, tag_type, count, value in tags:
+            # Values that fit in 4 bytes go in the entry, left aligned. Others are an offset
+            value_bytes = struct.pack("<HH", value, 0) if tag_type == short and count == 1 else struct.pack("<I", value)
+            ifd += struct.pack("<HHI", tag, tag_type, count) + value_bytes
+        # No next directory
+        ifd += struct.pack("<I", 0)
+        self.fp.write(header + ifd + struct.pack("<HHH", 8, 8, 8))
+
+    def write_rows(self, rows):
+        """
+        Parameters
+        ----------
+        rows : numpy.ndarray
+            uint8 array of shape (rows, width, 3)
+        """
+        if rows.shape[1:] != (self.size[0], 3):
+            raise ValueError("Rows of shape {} don't match image width {}".format(rows.shape, self.size[0]))
+        self.fp.write(np.ascontiguousarray(rows, dtype=np.uint8).tobytes())
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        if self.rows_written != self.size[1]:
+            raise ValueError("Wrote {} rows of {}".format(self.rows_written, self.size[1]))
+
+
+BAND_WRITERS = {
+    "png": PNGBandWriter,
+    "tiff": TIFFBandWriter,
+}
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+"""
+Long-lived render service. Keeps a pool of warm worker processes and answers render requests with image bytes.
+
+Request: POST /render with a JSON object of `main.RenderOptions` fields as body. Optional "format" (one of
+`output.FORMATS`, PNG by default), "quality" and "compress_level" fields set the encoding.
+"preview": true answers a quick, low resolution stereogram, to show while the full one renders, i.e. as a job.
+Response: the encoded image on success. A JSON object with "code" and "text" on failure, like the CLI: 400 for invalid
+options or input files that can't be loaded, 413 for
+depthmap or pattern files over the pixel budget, refused before decoding them, or canvases over it once oversampled,
+and 503 for renders over the time limit.
+
+Requests render in a single process each: the pool renders requests in parallel. If a render process dies, i.e. out of
+memory, its requests fail and the pool is started again.
+"""
+
+import argparse
+import json
+import os
+import socketserver
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from assets import MAX_IMAGE_PIXELS, ImageTooLarge
+from cache import ResultCache
+from log import Log as log
+from main import RenderOptions, render_image, _HTTPCode
+from output import FORMATS, encoder_params
+from timing import TimeLimitExceeded, time_limit
+
+DEFAULT_PORT = 8642
+TIME_LIMIT = 60.0  # Seconds per render
+
+
+def _pop_encoding(fields):
+    """Takes the encoding fields out of a request, validated, as `main.render_image` keyword arguments"""
+    encoding = {"file_format": fields.pop("format", "png")}
+    for field in ["quality", "compress_level"]:
+        if field in fields:
+            encoding[field] = fields.pop(field)
+    encoder_params(**encoding)
+    return encoding
+
+
+def _render_image(options_dict, encoding, cache_dir, seconds):
+    """Worker process entry point. Renders and encodes, so only bytes travel back to the server process."""
+    # Tasks run in the main thread of the worker, where time limits apply
+    with time_limit(seconds):
+        return render_image(RenderOptions.from_dict(options_dict),
+                            result_cache=ResultCache(cache_dir) if cache_dir else None, **encoding)
+
+
+def _warm_up():
+    return os.getpid()
+
+
+def _start_pool(workers):
+    pool = ProcessPoolExecutor(max_workers=workers)
+    # Start every worker now, so the first requests don't pay for it
+    for future in [pool.submit(_warm_up) for _ in range(workers)]:
+        future.result()
+    return pool
+
+
+def _restart_pool(server, broken_pool):
+    """Replaces a pool whose process died. Every request it was rendering fails, and only the first one restarts it"""
+    with server.pool_lock:
+        if server.pool is broken_pool:
+            log.w("Restarting the render processes")
+            server.pool = _start_pool(server.workers)
+            broken_pool.shutdown(wait=False)
+
+
+class _RenderRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if self.path != "/render":
+            self._send_json(_HTTPCode.NOT_FOUND, "Unknown path '{}'".format(self.path))
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            fields = json.loads(body.decode("utf-8"))
+            if not isinstance(fields, dict):
+                raise ValueError("expected a JSON object")
+            encoding = _pop_encoding(fields)
+            options = RenderOptions.from_dict(fields)
+        except (ValueError, TypeError) as e:
+            self._send_json(_HTTPCode.BAD_REQUEST, "Invalid render options: {}".format(e))
+            return
+        # Requests can lower the pixel budget, not raise it
+        if options.max_pixels is None or options.max_pixels > self.server.max_pixels:
+            options.max_pixels = self.server.max_pixels
+        # A pool of their own inside a pool worker would multiply the processes
+        options.workers = 1
+        pool = self.server.pool
+        try:
+            image_bytes = pool.submit(_render_image, options.to_dict(), encoding, self.server.cache_dir,
+                                      self.server.time_limit).result()
+        except ImageTooLarge as e:
+            self._send_json(_HTTPCode.PAYLOAD_TOO_LARGE, "Image too large: {}".format(e))
+            return
+        except TimeLimitExceeded as e:
+            log.w("Render gave up: {}".format(e))
+            self._send_json(_HTTPCode.SERVICE_UNAVAILABLE, "Render gave up: {}".format(e))
+            return
+        except BrokenProcessPool as e:
+            log.e("Render process died: {}".format(e))
+            _restart_pool(self.server, pool)
+            self._send_json(_HTTPCode.INTERNAL_SERVER_ERROR, "Render failed: its process died")
+            return
+        except (ValueError, TypeError) as e:
+            # The request's fault, i.e. a depthmap that can't be loaded or an option of the wrong type
+            self._send_json(_HTTPCode.BAD_REQUEST, "Invalid render options: {}".format(e))
+            return
+        except Exception as e:
+            log.e("Render failed: {}".format(e))
+            self._send_json(_HTTPCode.INTERNAL_SERVER_ERROR, "Render failed: {}".format(e))
+            return
+        self._send(_HTTPCode.OK, FORMATS[encoding["file_format"]][1], image_bytes)
+
+    def _send_json(self, code, text):
+        self._send(code, "application/json", json.dumps({"code": code, "text": text}).encode("utf-8"))
+
+    def _send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        log.d("{} {}".format(self.address_string(), format % args))
+
+
+class _RenderHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _RenderUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, workers=None, cache_dir=None,
+          max_pixels=MAX_IMAGE_PIXELS, seconds=TIME_LIMIT):
+    """
+    Runs the render service until interrupted
+
+    Parameters
+    ----------
+    host : str
+        Address to listen on. Ignored if `socket_path` is set
+    port : int
+        TCP port to listen on. Ignored if `socket_path` is set
+    socket_path : str
+        Path of a Unix socket to listen on, instead of TCP
+    workers : int
+        Number of render processes. Defaults to the number of CPUs
+    cache_dir : str
+        Directory of a result cache shared by the workers. No cache if None
+    max_pixels : int
+        Most pixels a depthmap or pattern file of a request may take to decode, and its canvas to render. Requests can
+        only lower it
+    seconds : float
+        Time limit of each render. None for no limit
+    """
+    workers = workers or os.cpu_count()
+    pool = _start_pool(workers)
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _RenderUnixServer(socket_path, _RenderRequestHandler)
+        address = socket_path
+    else:
+        server = _RenderHTTPServer((host, port), _RenderRequestHandler)
+        address = "{}:{}".format(host, port)
+    server.pool = pool
+    server.pool_lock = threading.Lock()
+    server.workers = workers
+    server.cache_dir = cache_dir
+    server.max_pixels = max_pixels
+    server.time_limit = seconds
+    log.i("Render server listening on {} with {} workers".format(address, workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.shutdown()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def obtain_args():
+    arg_parser = argparse.ArgumentParser(description="Stereogramaxo render server")
+    arg_parser.add_argument("--host", help="Address to listen on", default="127.0.0.1")
+    arg_parser.add_argument("--port", help="TCP port to listen on", type=int, default=DEFAULT_PORT)
+    arg_parser.add_argument("--socket", help="Listen on this Unix socket instead of TCP")
+    arg_parser.add_argument("--workers", help="Number of render processes. Defaults to the number of CPUs", type=int)
+    arg_parser.add_argument("--cache-dir", help="Directory of a result cache shared by the workers")
+    arg_parser.add_argument("--max-pixels", help="Refuse depthmap and pattern files that would take more pixels than "
+                                                 "this to decode, reading only their header, and canvases bigger "
+                                                 "than this once oversampled",
+                            type=int, default=MAX_IMAGE_PIXELS)
+    arg_parser.add_argument("--time-limit", help="Seconds a render may take. 0 for no limit", type=float,
+                            default=TIME_LIMIT)
+    return arg_parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = obtain_args()
+    serve(args.host, args.port, args.socket, args.workers, args.cache_dir, args.max_pixels, args.time_limit or None)
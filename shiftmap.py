@@ -0,0 +1,143 @@
+"""Shift maps: how far every depthmap pixel shifts the pattern, computed once per depthmap and render settings."""
+
+import functools
+
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+
+# Fixed point precision of subpixel shifts
+SUBPIXEL_BITS = 8
+SUBPIXEL_MASK = (1 << SUBPIXEL_BITS) - 1
+SUBPIXEL_HALF = 1 << (SUBPIXEL_BITS - 1)
+
+SHIFT_MAP_VERSION = 1  # Of the saved format
+SHIFT_LUT_CACHE_SIZE = 64  # (depth factor, mode) pairs
+
+
+@functools.lru_cache(maxsize=SHIFT_LUT_CACHE_SIZE)
+def _shift_table(depth_factor, wall, subpixel):
+    if subpixel:
+        return tuple(int(round(gray/255.0*depth_factor*(1 << SUBPIXEL_BITS)))*(1 if wall else -1)
+                     for gray in range(256))
+    return tuple(int(gray/255.0*depth_factor*(1 if wall else -1)) for gray in range(256))
+
+
+def shift_lut(depth_factor, wall, subpixel=False):
+    """
+    Shift of each gray level. The float operations are done here, once per gray level, and every engine reads the same
+    integers.
+
+    Parameters
+    ----------
+    depth_factor : float
+        Maximum shift, in pixels, for a white depthmap pixel. Depends on the pattern width and main.SHIFT_RATIO
+    wall : bool
+        True for wall eyed mode, False for cross eyed mode, where shifts are negative
+    subpixel : bool
+        Shifts in fixed point with SUBPIXEL_BITS fractional bits, rounded. Else whole pixels, rounded towards zero
+
+    Returns
+    -------
+    tuple(int)
+        256 shifts
+    """
+    return _shift_table(float(depth_factor), bool(wall), bool(subpixel))
+
+
+class ShiftMap(object):
+    """
+    Shift of every pixel of a depthmap, from `shift_lut`, ready for the engines. int16, or int32 for subpixel shifts
+    of more than 127 pixels.
+
+    Maps are shared by the renders of the same depthmap and settings, so they must not be modified. They can be saved
+    and loaded again, i.e. to keep the maps of preset depthmaps.
+    """
+    def __init__(self, shifts, depth_factor, wall, subpixel=False):
+        """
+        Parameters
+        ----------
+        shifts : numpy.ndarray
+            Shift of every pixel, height x width
+        depth_factor : float
+            Maximum shift, in pixels, the shifts were computed with
+        wall : bool
+            View mode the shifts were computed for
+        subpixel : bool
+            Whether the shifts are in fixed point
+        """
+        self.shifts = shifts
+        self.depth_factor = float(depth_factor)
+        self.wall = bool(wall)
+        self.subpixel = bool(subpixel)
+
+    @classmethod
+    def from_depthmap(cls, dm, depth_factor, wall, subpixel=False):
+        """
+        Builds the map of a depthmap in a single table lookup per pixel
+
+        Parameters
+        ----------
+        dm : numpy.ndarray or PIL.Image.Image
+            Grayscale depthmap
+        depth_factor : float
+            Maximum shift, in pixels, for a white depthmap pixel
+        wall : bool
+            True for wall eyed mode, False for cross eyed mode
+        subpixel : bool
+            Shifts by fractions of a pixel, in fixed point
+
+        Returns
+        -------
+        ShiftMap
+        """
+        lut = shift_lut(depth_factor, wall, subpixel)
+        dtype = np.int16 if max(abs(lut[0]), abs(lut[-1])) <= np.iinfo(np.int16).max else np.int32
+        dm = np.asarray(dm, dtype=np.uint8)
+        return cls(np.array(lut, dtype=dtype)[dm], depth_factor, wall, subpixel)
+
+    @property
+    def size(self):
+        """(width, height), like PIL images"""
+        return self.shifts.shape[1], self.shifts.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.shifts.nbytes
+
+    def matches(self, depth_factor, wall, subpixel=False):
+        """Whether the map was computed with these settings"""
+        return (self.depth_factor, self.wall, self.subpixel) == (float(depth_factor), bool(wall), bool(subpixel))
+
+    def rows(self, top, bottom):
+        """Map of a band of rows. Shares the shifts with this map"""
+        return ShiftMap(self.shifts[top:bottom], self.depth_factor, self.wall, self.subpixel)
+
+    def save(self, fp):
+        """
+        Parameters
+        ----------
+        fp : str or file object
+            Where to write the map, as a NumPy .npz archive
+        """
+        np.savez(fp, version=SHIFT_MAP_VERSION, shifts=self.shifts, depth_factor=self.depth_factor,
+                 wall=self.wall, subpixel=self.subpixel)
+
+    @classmethod
+    def load(cls, fp):
+        """
+        Parameters
+        ----------
+        fp : str or file object
+            A map written by `save`
+
+        Returns
+        -------
+        ShiftMap
+        """
+        with np.load(fp, allow_pickle=False) as archive:
+            if int(archive["version"]) != SHIFT_MAP_VERSION:
+                raise ValueError("Shift map version {} is not supported, expected {}".format(
+                    int(archive["version"]), SHIFT_MAP_VERSION))
+            return cls(archive["shifts"], float(archive["depth_factor"]), bool(archive["wall"]),
+                       bool(archive["subpixel"]))
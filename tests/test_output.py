@@ -0,0 +1,22 @@
+import io
+import os
+
+from PIL import Image
+
+from main import RenderOptions, render_bands
+
+SHARK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "depthmaps", "shark.png")
+
+
+def _render_png_bands(compress_level):
+    fp = io.BytesIO()
+    render_bands(RenderOptions(depthmap=SHARK, seed=1, wall=True), fp, "png", band_height=64,
+                 compress_level=compress_level)
+    return fp.getvalue()
+
+
+def test_banded_png_honors_compress_level():
+    stored, compressed = _render_png_bands(0), _render_png_bands(9)
+    assert len(stored) > len(compressed)
+    # Only the encoding differs
+    assert Image.open(io.BytesIO(stored)).tobytes() == Image.open(io.BytesIO(compressed)).tobytes()
@@ -0,0 +1,93 @@
+"""Lightweight timing of the stages of a render, and time limits."""
+
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StageTimer(object):
+    """
+    Accumulates the wall time spent in each named stage. A stage entered many times, i.e. once per band, adds up.
+
+    Stages are reported in the order they were first entered.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._stages = {}  # name: [seconds, calls]
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block as part of a stage
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            entry = self._stages.setdefault(name, [0.0, 0])
+            entry[0] += elapsed
+            entry[1] += 1
+
+    def to_dict(self):
+        """
+        Returns
+        -------
+        dict
+            Machine readable breakdown: total seconds since the timer was created, and seconds and calls per stage
+        """
+        return {
+            "total_seconds": round(time.perf_counter() - self.started, 6),
+            "stages": {name: {"seconds": round(seconds, 6), "calls": calls}
+                       for name, (seconds, calls) in self._stages.items()},
+        }
+
+
+class _NullTimer(object):
+    """Stands in for a StageTimer when nobody asked for timings"""
+    @contextmanager
+    def stage(self, name):
+        yield
+
+
+NULL_TIMER = _NullTimer()
+
+
+class TimeLimitExceeded(Exception):
+    """A block ran for longer than its time limit"""
+
+
+@contextmanager
+def time_limit(seconds):
+    """
+    Interrupts the enclosed block with TimeLimitExceeded once it runs for more than `seconds`.
+
+    It uses SIGALRM, so it only applies in the main thread of a process, on Unix, i.e. the CLI or the worker processes
+    of a pool. Elsewhere the block runs without limit. A single long call into C code, i.e. decoding an image, finishes
+    before it is interrupted.
+
+    Parameters
+    ----------
+    seconds : float
+        Time limit. None for no limit
+    """
+    if seconds is None or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def interrupt(signum, frame):
+        raise TimeLimitExceeded("Took more than {}s".format(seconds))
+
+    previous_handler = signal.signal(signal.SIGALRM, interrupt)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)